@@ -1,26 +1,75 @@
 # app.py
 
-import firebase_admin
+import atexit
 import os
+import base64
 import json
 import uuid
-import razorpay
+import hashlib
 import random
-from firebase_admin import credentials, firestore, auth
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+from google.api_core.exceptions import AlreadyExists
+from flask import Flask, Response, render_template, request, redirect, url_for, session, jsonify, flash
+from markupsafe import escape
+from werkzeug.datastructures import MultiDict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta, timezone
+from cache import CollectionCache, DirectoryCache, TTLCache
+from slots import compile_schedule, FreeSlotIndex
+from notifications import NotificationOutbox, build_senders
+from jobs import JobQueue
+from payments import build_razorpay_client
+from datastore import DOCUMENT_ID, build_local_client, transactional
+from repositories import Repositories
+from instrumentation import Instrumentation, run_in_request_context
+from budgets import declare_budget, read_budget
+from assets import AssetManifest
+from clients import LazyClient, lazy_module
+from live import ChangeFeed, LiveUpdates, Subscriber
+from search import PRICE_FIELDS, PractitionerIndex, normalize
+
+# The Firestore SDK is imported on first use, so importing the app stays fast
+firestore = lazy_module('google.cloud.firestore')
 
 # Initialize Flask App
 app = Flask(__name__)
 app.secret_key = 'your_super_secret_key'
 
+# --- Instrumentation ---
+# Times Firestore, Firebase Auth, Razorpay, SMS/email and template rendering
+# per request: totals go out in a Server-Timing header and to /metrics
+# (Prometheus text, for admins or scrapers sending bearer METRICS_TOKEN).
+# INSTRUMENTATION_ENABLED=0 leaves every client unwrapped.
+instrumentation = Instrumentation(
+    enabled=os.environ.get('INSTRUMENTATION_ENABLED', '1') != '0',
+    metrics_token=os.environ.get('METRICS_TOKEN')
+)
+instrumentation.init_app(app)
+
+# --- Static Assets ---
+# Templates link static files through asset_url() / responsive_image(), which
+# point at the fingerprinted, resized and precompressed copies made by
+# build_assets.py and served from /assets with immutable cache headers.
+assets = AssetManifest()
+assets.init_app(app)
+
 # --- Razorpay Configuration ---
-app.config['RAZORPAY_KEY_ID'] = 
-app.config['RAZORPAY_KEY_SECRET'] = 
+app.config['RAZORPAY_KEY_ID'] = os.environ.get('RAZORPAY_KEY_ID', '')
+app.config['RAZORPAY_KEY_SECRET'] = os.environ.get('RAZORPAY_KEY_SECRET', '')
+app.config['RAZORPAY_WEBHOOK_SECRET'] = os.environ.get('RAZORPAY_WEBHOOK_SECRET', '')
+# An unpaid order is handed out again for this long before a new one is created
+app.config['RAZORPAY_ORDER_TTL'] = int(os.environ.get('RAZORPAY_ORDER_TTL', 3600))
+
 
-razorpay_client = razorpay.Client(
-    auth=(app.config['RAZORPAY_KEY_ID'], app.config['RAZORPAY_KEY_SECRET'])
-)
+
+def build_payments_client():
+    client = build_razorpay_client(app.config['RAZORPAY_KEY_ID'], app.config['RAZORPAY_KEY_SECRET'])
+    instrumentation.instrument_methods(client.order, 'razorpay', ['create', 'fetch'])
+    return client
+
+
+razorpay_client = LazyClient('razorpay', build_payments_client)
 
 # Use a default config if not running in the Canvas environment
 __firebase_config_str = os.environ.get('FIREBASE_CONFIG')
@@ -38,36 +87,1113 @@ firebase_config = json.loads(__firebase_config_str)
 # Get the absolute path to the service account key
 key_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serviceAccountKey.json')
 
-# Initialize Firebase Admin SDK
-db = None
-try:
-    cred = credentials.Certificate(key_path)
-    if not firebase_admin._apps:
-        firebase_app = firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    print("Firebase Admin SDK initialized successfully.")
-except Exception as e:
-    print(f"Warning: Could not initialize Firebase Admin SDK. Error: {e}")
-    if firebase_admin._apps:
-        db = firestore.client()
+# --- Datastore ---
+# DATASTORE_BACKEND=memory or sqlite swaps Firestore for a local store with
+# the same query API, so routes can be load-tested and profiled offline.
+# Nothing here connects at import: each client is a LazyClient built on first
+# use, and Firestore clients once per process (see get_app below).
+DATASTORE_BACKEND = os.environ.get('DATASTORE_BACKEND', 'firestore')
+# Local clients handle forks themselves; Firestore's gRPC channels must not cross one
+PER_PROCESS_CLIENTS = DATASTORE_BACKEND == 'firestore'
+
+
+def init_firebase():
+    """Initializes the Firebase Admin app once; returns it, or None if it could not be set up."""
+    # Imported here: the Admin SDK is only needed for auth calls and slows down every import of this module
+    import firebase_admin
+    from firebase_admin import credentials
+    try:
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(credentials.Certificate(key_path))
+            print("Firebase Admin SDK initialized successfully.")
+        return firebase_admin.get_app()
+    except Exception as e:
+        print(f"Warning: Could not initialize Firebase Admin SDK. Error: {e}")
+        return None
+
+
+def load_auth():
+    from firebase_admin import auth as firebase_auth
+    firebase.load()
+    return firebase_auth
+
+
+def build_datastore():
+    if DATASTORE_BACKEND != 'firestore':
+        client = build_local_client(DATASTORE_BACKEND, os.environ.get('DATASTORE_SQLITE_PATH', 'local.db'))
+        print(f"Using the local '{DATASTORE_BACKEND}' datastore.")
+    else:
+        firebase_app = firebase.load()
+        if firebase_app is None:
+            return None
+        # Not firestore.client(): that caches one client on the app, which a forked worker would inherit
+        client = firestore.Client(project=firebase_app.project_id,
+                                  credentials=firebase_app.credential.get_credential())
+    instrumentation.instrument_firestore(client)
+    return client
+
+
+def collection_ref(repository):
+    return LazyClient(repository, lambda: getattr(repos, repository).collection if repos else None,
+                      per_process=PER_PROCESS_CLIENTS)
+
+
+# The Admin app holds only credentials, so one per interpreter is enough
+firebase = LazyClient('firebase', init_firebase, per_process=False)
+auth = LazyClient('auth', load_auth, per_process=False)
+db = LazyClient('datastore', build_datastore, per_process=PER_PROCESS_CLIENTS)
+repos = LazyClient('repositories', lambda: Repositories(db) if db else None, per_process=PER_PROCESS_CLIENTS)
 
 # References to your collections
-if db:
-    users_ref = db.collection('users')
-    practitioners_ref = db.collection('practitioners')
-    sessions_ref = db.collection('sessions')
-    notifications_ref = db.collection('notifications')
-    feedback_ref = db.collection('feedback')
-    availability_ref = db.collection('practitioner_availability')
-else:
-    users_ref, practitioners_ref, sessions_ref, notifications_ref, feedback_ref, availability_ref = None, None, None, None, None, None
+users_ref = collection_ref('users')
+practitioners_ref = collection_ref('practitioners')
+sessions_ref = collection_ref('sessions')
+notifications_ref = collection_ref('notifications')
+feedback_ref = collection_ref('feedback')
+availability_ref = collection_ref('availability')
+# Firestore rejects batches of more than 500 writes
+MAX_BATCH_WRITES = 500
+
+# --- Directory Cache ---
+# Practitioner and patient profiles used for name lookups on the dashboard.
+# Kept per process; write routes push their changes into it directly.
+directory_cache = DirectoryCache(
+    maxsize=int(os.environ.get('DIRECTORY_CACHE_SIZE', 5000)),
+    ttl=int(os.environ.get('DIRECTORY_CACHE_TTL', 300))
+)
+
+
+def get_practitioner_map():
+    practitioner_map = directory_cache.get_listing('practitioners')
+    if practitioner_map is None:
+        practitioner_map = {doc.id: doc.to_dict() for doc in practitioners_ref.stream()}
+        directory_cache.set_listing('practitioners', practitioner_map)
+    return practitioner_map
+
+
+def lookup_profiles(directory, uids):
+    """
+    Resolves profile docs for just the given UIDs. Cached profiles are used
+    as-is; the rest are fetched with batched get_all calls and cached.
+    """
+    profiles, missing = {}, []
+    for uid in set(uids):
+        if not uid:
+            continue
+        data = directory_cache.get(directory, uid)
+        if data is not None:
+            profiles[uid] = data
+        else:
+            missing.append(uid)
+
+    repository = repos.users if directory == 'patients' else repos.practitioners
+    for uid, data in repository.get_many(missing).items():
+        directory_cache.put(directory, uid, data)
+        profiles[uid] = data
+    return profiles
+
+
+# --- Conditional GET ---
+# /therapists and /get_availability tag responses with an ETag built from the
+# cached data they are made from, so a client holding the current version gets
+# a bare 304 before anything is rendered or serialised. Tags come from content,
+# not per-process counters, so every worker hands out the same tag for the
+# same data and a cache refill that changes nothing keeps the tag.
+_template_versions = {}
+
+
+def content_tag(*parts):
+    encoded = json.dumps(parts, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:20]
+
+
+def template_version(*names):
+    """Fingerprint of the template sources, so a deploy that changes markup changes the tag."""
+    if names not in _template_versions or app.debug:
+        sources = [app.jinja_env.loader.get_source(app.jinja_env, name)[0] for name in names]
+        _template_versions[names] = content_tag(*sources)
+    return _template_versions[names]
+
+
+def conditional(response, etag):
+    response.set_etag(etag)
+    # Kept by the browser but revalidated on every use; never shared, since pages vary by login
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(etag):
+    """A 304 response when the client already holds `etag`, otherwise None."""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return conditional(app.response_class(status=304), etag)
+
+
+# --- Identity ---
+# Every login used to walk practitioners -> users -> practitioners to find a
+# role. Roles now live in the token's custom claims and in a user_roles/{uid}
+# index document, so a login costs at most one read, and decoded tokens and
+# roles are cached briefly to absorb login storms after a deploy.
+IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL', 300))
+token_cache = TTLCache(maxsize=10000, ttl=IDENTITY_CACHE_TTL)
+role_cache = TTLCache(maxsize=10000, ttl=IDENTITY_CACHE_TTL)
+
+
+def role_index_ref(uid):
+    return repos.roles.ref(uid)
+
+
+def decode_id_token(id_token):
+    """auth.verify_id_token with the result cached until it expires or the TTL runs out."""
+    key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+    decoded_token = token_cache.get(key)
+    if decoded_token is None:
+        with instrumentation.timed('auth', 'verify_id_token'):
+            decoded_token = auth.verify_id_token(id_token)
+        ttl = min(IDENTITY_CACHE_TTL, decoded_token.get('exp', 0) - time.time())
+        if ttl > 0:
+            token_cache.set(key, decoded_token, ttl=ttl)
+    return decoded_token
+
+
+def record_role(uid, role, batch=None):
+    """Stores the role in the index document (inside `batch` if given) and as a custom claim."""
+    role_data = {'role': role, 'updated_at': datetime.now(timezone.utc)}
+    if batch is not None:
+        batch.set(role_index_ref(uid), role_data)
+    else:
+        role_index_ref(uid).set(role_data)
+    role_cache.set(uid, role)
+    try:
+        # Picked up by the next token the client refreshes
+        with instrumentation.timed('auth', 'set_custom_user_claims'):
+            auth.set_custom_user_claims(uid, {'role': role})
+    except Exception as e:
+        print(f"Warning: Could not set role claim for {uid}. Error: {e}")
+
+
+def resolve_legacy_role(uid, decoded_token):
+    """
+    Finds the role of a user created before the role index, the way logins
+    used to, and backfills the index. Unknown users become patients.
+    """
+    practitioner_ref, user_ref = practitioners_ref.document(uid), users_ref.document(uid)
+    # get_all does not promise to return documents in the order requested
+    docs = {doc.reference.path: doc for doc in db.get_all([practitioner_ref, user_ref])}
+    practitioner_doc, user_doc = docs[practitioner_ref.path], docs[user_ref.path]
+    practitioner_data = practitioner_doc.to_dict() if practitioner_doc.exists else {}
+
+    if practitioner_data.get('role') == 'admin':
+        user_role = 'admin'
+    elif user_doc.exists:
+        user_role = user_doc.to_dict().get('role')
+    elif practitioner_doc.exists:
+        user_role = practitioner_data.get('role')
+    else:
+        patient_data = {
+            'email': decoded_token.get('email', 'N/A'),
+            'name': decoded_token.get('name', 'New User'),
+            'role': 'patient', 'created_at': datetime.now()
+        }
+        batch = db.batch()
+        batch.set(users_ref.document(uid), patient_data)
+        record_role(uid, 'patient', batch=batch)
+        batch.commit()
+        directory_cache.put('patients', uid, patient_data)
+        return 'patient'
+
+    if user_role:
+        record_role(uid, user_role)
+    return user_role
+
+
+@app.cli.command('backfill-roles')
+def backfill_roles():
+    """Writes the role index for every existing user: flask --app app backfill-roles"""
+    # Same precedence as resolve_legacy_role: admin, then users, then practitioners
+    roles = {doc.id: doc.to_dict().get('role') for doc in users_ref.select(['role']).stream()}
+    for doc in practitioners_ref.select(['role']).stream():
+        role = doc.to_dict().get('role')
+        if role == 'admin' or doc.id not in roles:
+            roles[doc.id] = role
+
+    items = [(uid, role) for uid, role in roles.items() if role]
+    now = datetime.now(timezone.utc)
+    for start in range(0, len(items), 500):
+        batch = db.batch()
+        for uid, role in items[start:start + 500]:
+            batch.set(role_index_ref(uid), {'role': role, 'updated_at': now})
+        batch.commit()
+    print(f"Backfilled roles for {len(items)} users.")
+
+
+def resolve_role(uid, decoded_token):
+    role = decoded_token.get('role') or role_cache.get(uid)
+    if role:
+        return role
+    role_doc = role_index_ref(uid).get()
+    if role_doc.exists:
+        role = role_doc.to_dict().get('role')
+        role_cache.set(uid, role)
+        return role
+    return resolve_legacy_role(uid, decoded_token)
+
+
+# --- Dashboard Fan-out ---
+# Bounded pool shared by all requests; independent Firestore reads for one
+# page are submitted together and collected with a per-query timeout.
+# A read that times out cannot be stopped once it has started, so it keeps
+# its worker until Firestore answers. When the pool has no room for a whole
+# fan-out, the request reads serially on its own thread instead of queueing
+# behind those reads.
+DASHBOARD_WORKERS = int(os.environ.get('DASHBOARD_WORKERS', 16))
+dashboard_executor = ThreadPoolExecutor(
+    max_workers=DASHBOARD_WORKERS,
+    thread_name_prefix='dashboard'
+)
+DASHBOARD_QUERY_TIMEOUT = float(os.environ.get('DASHBOARD_QUERY_TIMEOUT', 10))
+dashboard_in_flight = 0
+dashboard_in_flight_lock = threading.Lock()
+
+
+def reserve_dashboard_workers(count):
+    """Claims `count` pool workers, or returns False when the pool is too busy."""
+    global dashboard_in_flight
+    with dashboard_in_flight_lock:
+        if dashboard_in_flight + count > DASHBOARD_WORKERS:
+            return False
+        dashboard_in_flight += count
+        return True
+
+
+def release_dashboard_worker(future):
+    global dashboard_in_flight
+    with dashboard_in_flight_lock:
+        dashboard_in_flight -= 1
+
+
+def run_serial(loaders, deadline, timeout):
+    """run_parallel's fallback: each loader in turn, skipping the rest once the deadline passes."""
+    results = {}
+    for name, loader in loaders.items():
+        if time.monotonic() >= deadline:
+            results[name] = (None, TimeoutError(f"'{name}' query skipped, page took over {timeout}s"))
+            continue
+        try:
+            results[name] = (loader(), None)
+        except Exception as e:
+            results[name] = (None, e)
+    return results
+
+
+def run_parallel(loaders, timeout=None):
+    """
+    Runs each loader on the dashboard pool and returns {name: (result, error)}.
+    A loader that fails or does not finish within the timeout reports its
+    error instead of failing the whole page. If the pool cannot take every
+    loader at once, they run serially on the calling thread.
+    """
+    timeout = DASHBOARD_QUERY_TIMEOUT if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    if not reserve_dashboard_workers(len(loaders)):
+        print(f"Warning: Dashboard pool is busy; reading {len(loaders)} queries serially.")
+        return run_serial(loaders, deadline, timeout)
+
+    futures = {}
+    for name, loader in loaders.items():
+        futures[name] = dashboard_executor.submit(run_in_request_context(loader))
+        futures[name].add_done_callback(release_dashboard_worker)
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = (future.result(timeout=max(0, deadline - time.monotonic())), None)
+        except FutureTimeoutError:
+            results[name] = (None, TimeoutError(f"'{name}' query timed out after {timeout}s"))
+        except Exception as e:
+            results[name] = (None, e)
+    # Loaders still queued are dropped; running ones hold their worker, and their count, until they finish
+    for future in futures.values():
+        future.cancel()
+    return results
+
+
+# --- Pagination ---
+# Session, feedback and notification history is read one page at a time,
+# newest first. A cursor is the order_by value of the last item on a page.
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 20))
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(value, doc_id):
+    return base64.urlsafe_b64encode(json.dumps([value.isoformat(), doc_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Returns (value, doc_id) from a cursor made by encode_cursor()."""
+    try:
+        value, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return datetime.fromisoformat(value), str(doc_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor.")
+
+
+def fetch_page(query, order_field, cursor=None, limit=PAGE_SIZE, oldest_first=False):
+    """
+    Returns (docs, next_cursor) for one page of the query, newest first
+    unless oldest_first. One extra document is requested to learn whether
+    another page exists. The document id breaks ties, so documents sharing
+    a timestamp across a page boundary are neither skipped nor repeated;
+    ordering by it in the same direction needs no extra index.
+    """
+    direction = firestore.Query.ASCENDING if oldest_first else firestore.Query.DESCENDING
+    query = query.order_by(order_field, direction=direction).order_by(DOCUMENT_ID, direction=direction)
+    if cursor:
+        value, doc_id = decode_cursor(cursor)
+        query = query.start_after({order_field: value, DOCUMENT_ID: doc_id})
+    docs = list(query.limit(limit + 1).stream())
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(docs[-1].get(order_field), docs[-1].id)
+    return docs, next_cursor
+
+
+def page_args():
+    cursor = request.args.get('cursor') or None
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    return cursor, limit
+
+
+def count_query(query):
+    # Aggregation query: billed per 1000 index entries instead of per document
+    return query.count().get()[0][0].value
+
+
+def to_json_safe(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {k: to_json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_safe(v) for v in value]
+    return value
+
+
+def prepare_sessions(user_role, docs):
+    """
+    Turns session docs into dashboard rows: skips sessions without a date,
+    adds the doc id and, for patients, the payment/cancel/reschedule flags.
+    """
+    sessions_data = []
+    now_utc = datetime.now(timezone.utc)
+    for doc in docs:
+        session_item = doc.to_dict()
+        if not session_item.get('date'):
+            if user_role == 'practitioner':
+                print(f"Warning: Practitioner session document {doc.id} is missing a date and will be skipped.")
+            continue
+
+        session_item['doc_id'] = doc.id
+        if user_role == 'practitioner':
+            if not session_item.get('patient_uid'):
+                session_item['patient_name'] = 'N/A'
+        elif user_role == 'patient':
+            session_date = session_item.get('date')
+            session_status = session_item.get('status')
+
+            if session_status == 'payment_pending':
+                session_item['payment_deadline_passed'] = (session_date - now_utc) < timedelta(days=1)
+            
+            session_item['is_cancellable'] = False
+            if session_status == 'payment_pending' and (session_date - now_utc) > timedelta(days=3):
+                session_item['is_cancellable'] = True
+            
+            session_item['is_reschedulable'] = False
+            if session_status in ['payment_pending', 'scheduled'] and (session_date - now_utc) > timedelta(days=1):
+                session_item['is_reschedulable'] = True
+
+        sessions_data.append(session_item)
+    return sessions_data
+
+
+def attach_names(directory, *item_lists):
+    """
+    Adds patient_name or practitioner_name to every item, resolving all the
+    referenced UIDs across the given lists with a single lookup.
+    """
+    if directory == 'patients':
+        uid_field, name_field, default = 'patient_uid', 'patient_name', 'Unknown Patient'
+    else:
+        uid_field, name_field, default = 'practitioner_uid', 'practitioner_name', 'N/A'
+    items = [item for item_list in item_lists for item in item_list]
+    profiles = lookup_profiles(directory, [item.get(uid_field) for item in items])
+    for item in items:
+        if name_field not in item:
+            item[name_field] = profiles.get(item.get(uid_field), {}).get('name', default)
+
+
+def get_active_patients_count(practitioner_uid):
+    """
+    Distinct patients a practitioner has seen, kept as a set on
+    practitioner_stats/{uid} and extended by every booking.
+    """
+    stats_doc = repos.practitioner_stats.ref(practitioner_uid).get()
+    stats = stats_doc.to_dict() if stats_doc.exists else {}
+    if stats.get('backfilled'):
+        return len(stats.get('patient_uids', []))
+
+    # Stats written before `flask --app app backfill-practitioner-stats` has run: count from history
+    history = repos.sessions.patient_uids_for(practitioner_uid).stream()
+    patient_uids = {doc.get('patient_uid') for doc in history} - {None}
+    patient_uids.update(stats.get('patient_uids', []))
+    return len(patient_uids)
+
+
+def backfill_practitioner_stats():
+    """Builds practitioner_stats from every session for each practitioner; returns how many."""
+    patients_by_practitioner = {doc.id: set() for doc in practitioners_ref.select([]).stream()}
+    for doc in sessions_ref.select(['practitioner_uid', 'patient_uid']).stream():
+        session_data = doc.to_dict()
+        if session_data.get('practitioner_uid') in patients_by_practitioner and session_data.get('patient_uid'):
+            patients_by_practitioner[session_data['practitioner_uid']].add(session_data['patient_uid'])
+
+    items = list(patients_by_practitioner.items())
+    for start in range(0, len(items), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for practitioner_uid, patient_uids in items[start:start + MAX_BATCH_WRITES]:
+            stats = {'backfilled': True}
+            if patient_uids:
+                # ArrayUnion keeps patients added by bookings made while this ran
+                stats['patient_uids'] = firestore.ArrayUnion(sorted(patient_uids))
+            batch.set(repos.practitioner_stats.ref(practitioner_uid), stats, merge=True)
+        batch.commit()
+    return len(items)
+
+
+@app.cli.command('backfill-practitioner-stats')
+def backfill_practitioner_stats_command():
+    """Writes the distinct patient set of every practitioner: flask --app app backfill-practitioner-stats"""
+    print(f"Backfilled stats for {backfill_practitioner_stats()} practitioners.")
+
+
+# --- Therapist Search ---
+# /therapists and /api/therapists search an in-memory index of the cached
+# practitioner listing instead of sorting the whole directory per request.
+# The index follows the listing, so profile edits and approvals written
+# through directory_cache show up in the next search.
+THERAPISTS_PAGE_SIZE = int(os.environ.get('THERAPISTS_PAGE_SIZE', 12))
+# Profile fields shown in search results
+THERAPIST_FIELDS = ('name', 'verification_status', 'specialties', 'address', 'contact',
+                    'appointment_price', 'session_price')
+
+practitioner_index = PractitionerIndex()
+
+
+def search_filters(args):
+    """The search filters in a query string; raises ValueError for a malformed price."""
+    price_ranges = {}
+    for field in PRICE_FIELDS:
+        low, high = (args.get(f'{bound}_{field}', '').strip() for bound in ('min', 'max'))
+        if low or high:
+            try:
+                price_ranges[field] = (float(low) if low else None, float(high) if high else None)
+            except ValueError:
+                raise ValueError("Prices must be numbers.")
+    return {
+        'specialties': [name for name in args.getlist('specialty') if name.strip()],
+        'price_ranges': price_ranges,
+        'location': args.get('location', '').strip(),
+        'verified_only': args.get('verified') in ('1', 'true', 'on'),
+    }
+
+
+def decode_offset(cursor):
+    try:
+        return max(int(cursor or 0), 0)
+    except ValueError:
+        raise ValueError("Invalid cursor.")
+
+
+def search_therapists(practitioner_map, filters, offset, limit):
+    """Returns (results, total) for one page of the practitioners matching `filters`."""
+    practitioner_index.sync(practitioner_map)
+    page, total = practitioner_index.search(offset=offset, limit=limit, **filters)
+    return [{'doc_id': uid, **{field: data.get(field) for field in THERAPIST_FIELDS}} for uid, data in page], total
+
+
+# --- Availability ---
+# Recurring rules and overrides are compiled once per practitioner into slot
+# tuples (see slots.py). Upcoming bookings are cached separately with a short
+# TTL since other workers can book too; both are dropped by the routes that
+# change them. Date overrides are one document per practitioner and date
+# (repos.availability_overrides); compact_overrides() drops past dates and
+# moves the overrides map older availability documents still carry into them.
+# Cached schedules can be stale in other workers for up to the TTL, so a
+# booking re-reads the documents that decide its slot (slot_offered()).
+AVAILABILITY_DEFAULT_DAYS = 60
+AVAILABILITY_MAX_DAYS = int(os.environ.get('AVAILABILITY_MAX_DAYS', 180))
+schedule_cache = TTLCache(maxsize=2000, ttl=int(os.environ.get('SCHEDULE_CACHE_TTL', 600)))
+booked_cache = TTLCache(maxsize=2000, ttl=int(os.environ.get('BOOKED_CACHE_TTL', 30)))
+# Marks practitioners that have no availability document at all
+NO_SCHEDULE = object()
+
+
+def today_str():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+
+def override_map(override_docs, from_date=None):
+    """{date_str: times} from per-date override documents, leaving out dates before `from_date`."""
+    overrides = {}
+    for doc in override_docs:
+        data = doc.to_dict()
+        date_str = data.get('date')
+        if date_str and (from_date is None or date_str >= from_date):
+            overrides[date_str] = data.get('times') or []
+    return overrides
+
+
+def compile_availability(practitioner_uid, availability_doc, override_docs):
+    if not availability_doc.exists:
+        return NO_SCHEDULE
+    availability_data = availability_doc.to_dict()
+    override_docs = list(override_docs)
+    today = today_str()
+    if availability_data.get('overrides') or any((doc.to_dict().get('date') or '') < today for doc in override_docs):
+        # Past dates or an old overrides map are left over; tidy them up off the request path
+        job_queue.submit(f"compact-overrides:{practitioner_uid}", compact_overrides, practitioner_uid)
+    return compile_schedule(availability_data, override_map(override_docs, today))
+
+
+def get_compiled_schedule(practitioner_uid):
+    schedule = schedule_cache.get(practitioner_uid)
+    if schedule is None:
+        schedule = compile_availability(practitioner_uid, availability_ref.document(practitioner_uid).get(),
+                                        repos.availability_overrides.for_practitioner(practitioner_uid).stream())
+        schedule_cache.set(practitioner_uid, schedule)
+    return None if schedule is NO_SCHEDULE else schedule
+
+
+def slot_availability_refs(repositories, practitioner_uid, slot_datetime):
+    """The availability document and the slot date's override document, which together decide whether it is offered."""
+    return [repositories.availability.ref(practitioner_uid),
+            repositories.availability_overrides.ref_for(practitioner_uid, slot_datetime.strftime('%Y-%m-%d'))]
+
+
+def slot_offered(refs, docs, slot_datetime):
+    """Whether the documents read for slot_availability_refs() still offer a slot starting at `slot_datetime`."""
+    docs = {doc.reference.path: doc for doc in docs}
+    availability_doc, override_doc = (docs[ref.path] for ref in refs)
+    if not availability_doc.exists:
+        return False
+    schedule = compile_schedule(availability_doc.to_dict(), override_map([override_doc]) if override_doc.exists else None)
+    return slot_datetime.hour * 60 + slot_datetime.minute in schedule.slots_for(slot_datetime.date())
+
+
+def compact_overrides(practitioner_uid=None):
+    """
+    Deletes override documents for dates already past and moves upcoming
+    dates out of older availability documents' `overrides` map into their own
+    documents (one already written for a date wins), then removes the map.
+    For one practitioner, or for everyone when `practitioner_uid` is None.
+    Returns (deleted, migrated).
+    """
+    overrides_repo = repos.availability_overrides
+    today = today_str()
+    if practitioner_uid:
+        own = list(overrides_repo.for_practitioner(practitioner_uid).stream())
+        past = [doc for doc in own if (doc.to_dict().get('date') or '') < today]
+        availability_docs = [availability_ref.document(practitioner_uid).get()]
+    else:
+        own = None
+        past = list(overrides_repo.before(today).stream())
+        availability_docs = availability_ref.select(['overrides']).stream()
+
+    writes = [('delete', doc.reference) for doc in past]
+    migrated = 0
+    now = datetime.now(timezone.utc)
+    for availability_doc in availability_docs:
+        legacy = availability_doc.to_dict().get('overrides') if availability_doc.exists else None
+        if legacy is None:
+            continue
+        uid = availability_doc.id
+        upcoming = {date_str: times for date_str, times in legacy.items() if date_str >= today}
+        if upcoming:
+            existing = own if own is not None else overrides_repo.for_practitioner(uid).stream()
+            written = {doc.to_dict().get('date') for doc in existing}
+            for date_str, times in upcoming.items():
+                if date_str not in written:
+                    writes.append(('set', overrides_repo.ref_for(uid, date_str), {
+                        'practitioner_uid': uid, 'date': date_str, 'times': sorted(set(times or [])), 'updated_at': now
+                    }))
+                    migrated += 1
+        writes.append(('update', availability_doc.reference, {'overrides': firestore.DELETE_FIELD}))
+
+    for start in range(0, len(writes), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for kind, *args in writes[start:start + MAX_BATCH_WRITES]:
+            getattr(batch, kind)(*args)
+        batch.commit()
+    return len(past), migrated
+
+
+@app.cli.command('compact-overrides')
+def compact_overrides_command():
+    """Drops past availability overrides for every practitioner: flask --app app compact-overrides"""
+    deleted, migrated = compact_overrides()
+    print(f"Deleted {deleted} past overrides, moved {migrated} dates out of overrides maps.")
+
+
+def cached_booked_slots(practitioner_uid, days):
+    cached = booked_cache.get(practitioner_uid)
+    if cached is not None and cached[0] >= days:
+        return cached[1]
+    return None
+
+
+def upcoming_sessions_query(repositories, practitioner_uid, days):
+    start_of_today = datetime.now(timezone.utc)
+    return repositories.sessions.for_practitioner_between(
+        practitioner_uid, start_of_today, start_of_today + timedelta(days=days + 1))
+
+
+def collect_booked_slots(session_docs):
+    booked_slots = {}
+    for sess in session_docs:
+        sess_data = sess.to_dict()
+        if sess_data.get('date') and sess_data.get('status') != 'cancelled':
+            sess_date = sess_data['date']
+            booked_slots.setdefault(sess_date.strftime('%Y-%m-%d'), set()).add(sess_date.hour * 60 + sess_date.minute)
+    return booked_slots
+
+
+def get_booked_slots(practitioner_uid, days):
+    """{date_str: {minutes, ...}} of the non-cancelled sessions in the next `days` days."""
+    booked_slots = cached_booked_slots(practitioner_uid, days)
+    if booked_slots is None:
+        booked_slots = collect_booked_slots(upcoming_sessions_query(repos, practitioner_uid, days).stream())
+        booked_cache.set(practitioner_uid, (days, booked_slots))
+    return booked_slots
+
+
+def slot_reservation_ref(practitioner_uid, slot_datetime):
+    return repos.slot_reservations.ref_for(practitioner_uid, slot_datetime)
+
+
+# Sessions booked before slot reservations existed have no reservation
+# document. Until `flask --app app backfill-reservations` has written them,
+# bookings also look for such a session in the slot they claim.
+RESERVATION_BACKFILL_MARKER = '_backfill'
+reservations_backfilled = False
+
+
+def slot_taken(session_docs):
+    return any(doc.to_dict().get('status') != 'cancelled' for doc in session_docs)
+
+
+def legacy_slot_query(repositories, practitioner_uid, slot_datetime):
+    return repositories.sessions.for_practitioner_between(practitioner_uid, slot_datetime,
+                                                          slot_datetime + timedelta(minutes=1))
+
+
+def legacy_booking_exists(practitioner_uid, slot_datetime):
+    global reservations_backfilled
+    if not reservations_backfilled:
+        reservations_backfilled = repos.slot_reservations.ref(RESERVATION_BACKFILL_MARKER).get().exists
+    if reservations_backfilled:
+        return False
+    return slot_taken(legacy_slot_query(repos, practitioner_uid, slot_datetime).stream())
+
+
+def backfill_slot_reservations():
+    """Writes a reservation for every upcoming session, then marks the backfill done; returns how many."""
+    now = datetime.now(timezone.utc)
+    upcoming = [doc for doc in repos.sessions.starting_from(now).stream()
+                if doc.to_dict().get('status') != 'cancelled' and doc.to_dict().get('practitioner_uid')]
+    for start in range(0, len(upcoming), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for doc in upcoming[start:start + MAX_BATCH_WRITES]:
+            session_data = doc.to_dict()
+            batch.set(slot_reservation_ref(session_data['practitioner_uid'], session_data['date']), {
+                'practitioner_uid': session_data['practitioner_uid'], 'patient_uid': session_data.get('patient_uid'),
+                'session_id': doc.id, 'date': session_data['date'], 'created_at': now
+            })
+        batch.commit()
+    repos.slot_reservations.ref(RESERVATION_BACKFILL_MARKER).set({'completed_at': now, 'reservations': len(upcoming)})
+    return len(upcoming)
+
+
+@app.cli.command('backfill-reservations')
+def backfill_reservations():
+    """Writes slot reservations for sessions booked before they existed: flask --app app backfill-reservations"""
+    print(f"Backfilled reservations for {backfill_slot_reservations()} upcoming sessions.")
+
+
+def invalidate_availability(practitioner_uid, schedule=True):
+    if schedule:
+        schedule_cache.invalidate(practitioner_uid)
+    booked_cache.invalidate(practitioner_uid)
+    index = slot_index
+    if index is not None:
+        index.mark_stale(practitioner_uid)
+
+
+# --- Earliest Slot Search ---
+# Free slots of every verified practitioner over the default horizon, built
+# in one pass (one practitioner listing, batched availability reads and a
+# single upcoming-sessions query) and patched per practitioner afterwards.
+# One request rebuilds an expired index while the others keep using it.
+SLOT_INDEX_TTL = int(os.environ.get('SLOT_INDEX_TTL', 300))
+slot_index = None
+slot_index_rebuilding = False
+slot_index_lock = threading.Condition()
+
+
+def practitioner_slots(schedule, booked_slots, now):
+    if schedule is None:
+        return []
+    return schedule.free_datetimes(now.date(), AVAILABILITY_DEFAULT_DAYS, booked_slots, not_before=now)
+
+
+def build_slot_index(practitioner_uids):
+    index = FreeSlotIndex(ttl=SLOT_INDEX_TTL)
+    now = datetime.now(timezone.utc)
+
+    uids = list(practitioner_uids)
+    availability = repos.availability.get_many(uids)
+    overrides_by_practitioner = {}
+    for doc in repos.availability_overrides.from_date(now.strftime('%Y-%m-%d')).stream():
+        override_data = doc.to_dict()
+        overrides_by_practitioner.setdefault(override_data.get('practitioner_uid'), {})[override_data['date']] = override_data.get('times') or []
+    for uid in uids:
+        schedule_cache.set(uid, compile_schedule(availability[uid], overrides_by_practitioner.get(uid))
+                           if uid in availability else NO_SCHEDULE)
+
+    booked_by_practitioner = {}
+    upcoming = repos.sessions.between(now, now + timedelta(days=AVAILABILITY_DEFAULT_DAYS + 1)).stream()
+    for sess in upcoming:
+        sess_data = sess.to_dict()
+        if sess_data.get('date') and sess_data.get('status') != 'cancelled':
+            sess_date = sess_data['date']
+            booked_by_practitioner.setdefault(sess_data.get('practitioner_uid'), {})\
+                                  .setdefault(sess_date.strftime('%Y-%m-%d'), set())\
+                                  .add(sess_date.hour * 60 + sess_date.minute)
+
+    for uid in uids:
+        index.set_practitioner(uid, practitioner_slots(get_compiled_schedule(uid), booked_by_practitioner.get(uid), now))
+    return index
+
+
+def get_slot_index(verified_uids, wanted_uids):
+    """
+    Returns the slot index, rebuilding it for all verified practitioners once
+    it expires, with the wanted practitioners brought up to date. The build
+    runs outside the lock; callers arriving meanwhile get the expired index,
+    and wait only when there is none yet.
+    """
+    global slot_index, slot_index_rebuilding
+    with slot_index_lock:
+        slot_index_lock.wait_for(lambda: slot_index is not None or not slot_index_rebuilding)
+        index = slot_index
+        rebuild = (index is None or index.expired) and not slot_index_rebuilding
+        if rebuild:
+            slot_index_rebuilding = True
+
+    if rebuild:
+        index = None
+        try:
+            index = build_slot_index(verified_uids)
+        finally:
+            with slot_index_lock:
+                if index is not None:
+                    # Changes marked on the old index while this one was being read
+                    if slot_index is not None:
+                        for uid in slot_index.stale_uids():
+                            index.mark_stale(uid)
+                    slot_index = index
+                slot_index_rebuilding = False
+                slot_index_lock.notify_all()
+
+    # Practitioners whose schedule or bookings changed since the build
+    now = datetime.now(timezone.utc)
+    for uid in index.needs_refresh(wanted_uids):
+        booked_slots = get_booked_slots(uid, AVAILABILITY_DEFAULT_DAYS)
+        index.set_practitioner(uid, practitioner_slots(get_compiled_schedule(uid), booked_slots, now))
+    return index
+
+
+# --- Dashboard Fragments ---
+# /dashboard is a shell; each panel is rendered by /dashboard/fragments/<name>
+# the first time it is shown. Rendered HTML is cached per user, and writes
+# drop only the fragments that show the data they changed (their "topics").
+# The cache is per process, so other workers catch up after the TTL.
+fragment_cache = TTLCache(maxsize=int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000)),
+                          ttl=int(os.environ.get('FRAGMENT_CACHE_TTL', 300)))
+
+
+def unwrap_results(results):
+    """{name: value} from run_parallel results; raises the first loader error."""
+    for value, error in results.values():
+        if error is not None:
+            raise error
+    return {name: value for name, (value, _) in results.items()}
+
+
+def default_settings(settings_doc):
+    return settings_doc.to_dict() if settings_doc.exists else {'in-app': True, 'sms': False, 'email': False}
+
+
+def load_stats_fragment(user_role, user_id):
+    loaders = {
+        'sessions_count': lambda: count_query(repos.sessions.for_user(user_role, user_id)),
+        'notifications_count': lambda: count_query(repos.notifications.for_recipient(user_id)),
+    }
+    if user_role == 'practitioner':
+        loaders['active_patients_count'] = lambda: get_active_patients_count(user_id)
+    return unwrap_results(run_parallel(loaders))
+
+
+def load_sessions_fragment(user_role, user_id):
+    docs, cursor = fetch_page(repos.sessions.for_user(user_role, user_id), 'date')
+    sessions_data = prepare_sessions(user_role, docs)
+    attach_names('patients' if user_role == 'practitioner' else 'practitioners', sessions_data)
+    return {'sessions': sessions_data, 'next_cursors': {'sessions': cursor}}
+
+
+def load_notifications_fragment(user_role, user_id):
+    results = unwrap_results(run_parallel({
+        'settings': lambda: notifications_ref.document(user_id).get(),
+        'notifications': lambda: fetch_page(repos.notifications.for_recipient(user_id), 'created_at'),
+    }))
+    docs, cursor = results['notifications']
+    notifications = [item for item in (doc.to_dict() for doc in docs) if item.get('created_at')]
+    return {'user_settings': default_settings(results['settings']), 'notifications': notifications,
+            'next_cursors': {'notifications': cursor}}
+
+
+def load_feedback_fragment(user_role, user_id):
+    docs, cursor = fetch_page(repos.feedback.for_practitioner(user_id), 'created_at')
+    feedback_data = [doc.to_dict() for doc in docs]
+    attach_names('patients', feedback_data)
+    return {'feedback': feedback_data, 'next_cursors': {'feedback': cursor}}
+
+
+def load_availability_fragment(user_role, user_id):
+    availability_doc = availability_ref.document(user_id).get()
+    return {'availability': availability_doc.to_dict() if availability_doc.exists else {}}
+
+
+def load_journey_fragment(user_role, user_id):
+    return {'journeys': [prepare_journey(doc.to_dict()) for doc in repos.journeys.for_patient(user_id).stream()]}
+
+
+def load_schedule_fragment(user_role, user_id):
+    return {'therapists': [{'doc_id': doc_id, **data} for doc_id, data in get_practitioner_map().items()]}
+
+
+def load_profile_fragment(user_role, user_id):
+    profile_doc = (practitioners_ref if user_role == 'practitioner' else users_ref).document(user_id).get()
+    return {'user_profile': profile_doc.to_dict() if profile_doc.exists else {}}
+
+
+# Each fragment names the roles that see it, its template, the loader that
+# builds its context and the topics it shows. Shared fragments are the same
+# for every user and cached once.
+# `budget` is checked per fragment by check_budgets.py: a first page is
+# PAGE_SIZE + 1 documents plus the profiles of the people on it.
+DASHBOARD_FRAGMENTS = {
+    'stats': {'roles': ('patient', 'practitioner'), 'template': 'dashboard_stats.html',
+              'load': load_stats_fragment, 'topics': ('sessions', 'notifications'),
+              'budget': dict(gets=1, queries=2, commits=0, reads=3, writes=0)},
+    'sessions': {'roles': ('patient',), 'template': 'dashboard_patient_sessions.html',
+                 'load': load_sessions_fragment, 'topics': ('sessions',),
+                 'budget': dict(gets=1, queries=1, commits=0, reads=41, writes=0)},
+    'upcoming-sessions': {'roles': ('practitioner',), 'template': 'dashboard_practitioner_sessions.html',
+                          'load': load_sessions_fragment, 'topics': ('sessions',),
+                          'budget': dict(gets=1, queries=1, commits=0, reads=41, writes=0)},
+    'journey': {'roles': ('patient',), 'template': 'dashboard_journey.html',
+                'load': load_journey_fragment, 'topics': ('journeys',),
+                'budget': dict(gets=0, queries=1, commits=0, reads=10, writes=0)},
+    # The whole practitioner directory, loaded once per process and shared by every patient
+    'schedule-new': {'roles': ('patient',), 'template': 'dashboard_schedule.html',
+                     'load': load_schedule_fragment, 'topics': ('therapists',), 'shared': True,
+                     'budget': dict(gets=0, queries=1, commits=0, reads=50, writes=0)},
+    'comms': {'roles': ('patient',), 'template': 'dashboard_comms.html',
+              'load': load_notifications_fragment, 'topics': ('notifications', 'settings'),
+              'budget': dict(gets=1, queries=1, commits=0, reads=22, writes=0)},
+    'notifications': {'roles': ('practitioner',), 'template': 'dashboard_notifications.html',
+                      'load': load_notifications_fragment, 'topics': ('notifications', 'settings'),
+                      'budget': dict(gets=1, queries=1, commits=0, reads=22, writes=0)},
+    'availability': {'roles': ('practitioner',), 'template': 'dashboard_availability.html',
+                     'load': load_availability_fragment, 'topics': ('availability',),
+                     'budget': dict(gets=1, queries=0, commits=0, reads=1, writes=0)},
+    'feedback': {'roles': ('practitioner',), 'template': 'dashboard_feedback.html',
+                 'load': load_feedback_fragment, 'topics': ('feedback',),
+                 'budget': dict(gets=1, queries=1, commits=0, reads=41, writes=0)},
+    'profile': {'roles': ('patient', 'practitioner'), 'template': 'dashboard_profile.html',
+                'load': load_profile_fragment, 'topics': ('profile',),
+                'budget': dict(gets=1, queries=0, commits=0, reads=1, writes=0)},
+}
+for fragment_name, fragment_spec in DASHBOARD_FRAGMENTS.items():
+    declare_budget(f'dashboard_fragment:{fragment_name}', **fragment_spec['budget'])
+
+
+def fragment_key(name, user_id):
+    return (None, name) if DASHBOARD_FRAGMENTS[name].get('shared') else (user_id, name)
+
+
+def invalidate_fragments(user_ids, *topics):
+    """Drops the cached fragments of `user_ids` (a uid or a list) that show any of `topics`."""
+    if isinstance(user_ids, str) or user_ids is None:
+        user_ids = [user_ids]
+    for name, fragment in DASHBOARD_FRAGMENTS.items():
+        if set(fragment['topics']) & set(topics):
+            for user_id in user_ids:
+                fragment_cache.invalidate(fragment_key(name, user_id))
+    live_updates.publish(user_ids, topics)
+
+
+# --- Live Updates ---
+# Open dashboards get a Server-Sent Events stream. Each process keeps one
+# listener on recently updated sessions and one on new notifications, and
+# passes each change to the streams of the users it concerns. Session
+# writes set updated_at so that every change shows up in the listener.
+def session_changed(session_id, data):
+    return ([data.get('patient_uid'), data.get('practitioner_uid')],
+            {'id': session_id, 'status': data.get('status')})
+
+
+def notification_created(notification_id, data):
+    return ([data.get('recipient_id')],
+            {'id': notification_id, 'message': data.get('message'), 'type': data.get('type', 'info'),
+             'created_at': data['created_at'].isoformat()})
+
+
+# A stream holds a thread for its lifetime under sync or threaded WSGI
+# workers, so dashboards only open one where asgi.py sets LIVE_UPDATES (or
+# the environment does, for servers with async workers such as gevent).
+app.config['LIVE_UPDATES'] = os.environ.get('LIVE_UPDATES', '').lower() in ('1', 'true', 'yes')
+LIVE_WINDOW = int(os.environ.get('LIVE_WINDOW', 100))
+LIVE_POLL_INTERVAL = float(os.environ.get('LIVE_POLL_INTERVAL', 5))
+live_updates = LiveUpdates(
+    [ChangeFeed('sessions', lambda: repos.sessions.collection, 'updated_at', session_changed,
+                window=LIVE_WINDOW, poll_interval=LIVE_POLL_INTERVAL),
+     ChangeFeed('notifications', lambda: repos.notifications.collection, 'created_at', notification_created,
+                window=LIVE_WINDOW, poll_interval=LIVE_POLL_INTERVAL)],
+    # Changes made by other processes also drop this process's cached fragments
+    on_change=lambda user_ids, topic: invalidate_fragments(user_ids, topic),
+    heartbeat=int(os.environ.get('LIVE_HEARTBEAT', 20)),
+    lifetime=int(os.environ.get('LIVE_STREAM_SECONDS', 300)),
+)
+
+
+def event_stream_headers():
+    # X-Accel-Buffering stops nginx from holding events back in its buffer
+    return {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+# --- Notification Outbox ---
+# Handlers enqueue notifications; background workers batch the Firestore
+# writes and send SMS/email copies per the user's saved preferences.
+def resolve_contacts(uids):
+    contacts = lookup_profiles('practitioners', uids)
+    contacts.update(lookup_profiles('patients', set(uids) - set(contacts)))
+    return contacts
+
+
+sms_sender, email_sender = build_senders()
+instrumentation.instrument_methods(sms_sender, 'sms', ['send'])
+instrumentation.instrument_methods(email_sender, 'email', ['send'])
+notification_outbox = NotificationOutbox(
+    lambda: db, resolve_contacts, sms_sender, email_sender,
+    on_written=lambda recipient_ids: invalidate_fragments(list(recipient_ids), 'notifications'),
+    workers=int(os.environ.get('NOTIFICATION_WORKERS', 2)),
+    shutdown_timeout=float(os.environ.get('NOTIFICATION_SHUTDOWN_TIMEOUT', 10))
+)
+atexit.register(notification_outbox.close)
+
+
+# --- Background Jobs ---
+# Journey generation runs here instead of on the payment request; jobs are
+# keyed by session_id so repeated confirmations do not queue it twice.
+job_queue = JobQueue(workers=int(os.environ.get('JOB_WORKERS', 2)))
+atexit.register(job_queue.flush)
+
+# There are only a handful of therapy plan templates and they rarely change,
+# so the whole collection is kept in memory and refreshed by a listener.
+therapy_plan_cache = CollectionCache(lambda: repos.therapy_plans.collection)
+
+
+# --- Journey tasks ---
+# A journey's tasks are stored in a `task_map` keyed by their position in the
+# plan, so one task can be updated by field path without rewriting the rest,
+# and a `progress` summary is kept in step with every change.
+
+def build_task_map(tasks):
+    return {str(index): {**task, 'index': index} for index, task in enumerate(tasks)}
+
+
+def journey_progress(task_map):
+    completed = sum(1 for task in task_map.values() if task.get('status') == 'completed')
+    return {'completed': completed, 'total': len(task_map)}
+
+
+def prepare_journey(journey_data):
+    """Adds an ordered `tasks` list and `progress` for display, for older array-based journeys too."""
+    task_map = journey_data.get('task_map')
+    if task_map is None:
+        task_map = build_task_map(journey_data.get('tasks', []))
+    journey_data['tasks'] = sorted(task_map.values(), key=lambda task: task['index'])
+    journey_data.setdefault('progress', journey_progress(task_map))
+    return journey_data
+
+
+@transactional
+def complete_journey_tasks(transaction, journey_ref, user_id, task_indexes):
+    """
+    Marks the given tasks of a journey completed in one commit and returns how
+    many were not completed before. Raises LookupError, PermissionError or
+    ValueError for a missing journey, another patient's journey or an
+    unknown task index.
+    """
+    journey_doc = journey_ref.get(transaction=transaction)
+    if not journey_doc.exists:
+        raise LookupError("Journey not found")
+
+    journey_data = journey_doc.to_dict()
+    if journey_data.get('patient_uid') != user_id:
+        raise PermissionError("Forbidden")
+
+    task_map = journey_data.get('task_map')
+    legacy = task_map is None
+    if legacy:
+        task_map = build_task_map(journey_data.get('tasks', []))
+
+    if any(str(index) not in task_map for index in task_indexes):
+        raise ValueError("Invalid task index")
+    newly_completed = sorted({index for index in task_indexes if task_map[str(index)].get('status') != 'completed'})
+
+    if legacy:
+        # Journeys created before task_map: move the array over on first touch
+        for index in newly_completed:
+            task_map[str(index)]['status'] = 'completed'
+        transaction.update(journey_ref, {
+            'task_map': task_map, 'progress': journey_progress(task_map), 'tasks': firestore.DELETE_FIELD
+        })
+    elif newly_completed:
+        updates = {f'task_map.{index}.status': 'completed' for index in newly_completed}
+        updates['progress.completed'] = firestore.Increment(len(newly_completed))
+        transaction.update(journey_ref, updates)
+    return len(newly_completed)
 
 
 # NEW HELPER FUNCTION TO CREATE PATIENT JOURNEY
 def create_patient_journey(session_id):
     """
     Generates a personalized therapy journey for a patient based on a template.
-    Triggered after a session payment is confirmed.
+    Triggered after a session payment is confirmed. Safe to run more than
+    once for the same session; errors are re-raised so the job queue retries.
     """
     if not db:
         print("Database not available, skipping journey creation.")
@@ -86,14 +1212,12 @@ def create_patient_journey(session_id):
         patient_uid = session_data.get('patient_uid')
         
         # 1. Fetch the therapy plan template
-        plan_ref = db.collection('therapy_plans').document(therapy_type)
-        plan_doc = plan_ref.get()
+        plan_data = therapy_plan_cache.get(therapy_type)
         
-        if not plan_doc.exists:
+        if not plan_data:
             print(f"No therapy plan found for '{therapy_type}'.")
             return
 
-        plan_data = plan_doc.to_dict()
         tasks_template = plan_data.get('tasks', [])
         
         # 2. Generate personalized tasks with specific dates
@@ -108,20 +1232,27 @@ def create_patient_journey(session_id):
                 "status": "pending" # Initial status
             })
 
-        # 3. Save the new journey to the patient_journeys collection
-        journey_ref = db.collection('patient_journeys').document(session_id)
-        journey_ref.set({
+        # 3. Save the new journey to the patient_journeys collection. create()
+        # leaves an existing journey, and the patient's progress, untouched.
+        task_map = build_task_map(journey_tasks)
+        journey_ref = repos.journeys.ref(session_id)
+        journey_ref.create({
             "patient_uid": patient_uid,
             "session_id": session_id,
             "plan_name": plan_data.get('planName'),
             "therapy_type": therapy_type.capitalize(),
             "session_date": session_date,
-            "tasks": journey_tasks
+            "task_map": task_map,
+            "progress": journey_progress(task_map)
         })
+        invalidate_fragments(patient_uid, 'journeys')
         print(f"Successfully created journey for session {session_id}.")
 
+    except AlreadyExists:
+        print(f"Journey for session {session_id} already exists.")
     except Exception as e:
         print(f"Error creating patient journey for session {session_id}: {e}")
+        raise
 
 
 @app.route('/')
@@ -145,22 +1276,33 @@ def register():
             return render_template('register.html', error="Server configuration error: Database not available.")
         
         try:
-            user = auth.create_user(email=email, password=password)
+            with instrumentation.timed('auth', 'create_user'):
+                user = auth.create_user(email=email, password=password)
             if role == 'patient':
-                users_ref.document(user.uid).set({
+                patient_data = {
                     'email': email, 'name': name, 'number': number, 'role': 'patient', 'created_at': datetime.now()
-                })
+                }
+                batch = db.batch()
+                batch.set(users_ref.document(user.uid), patient_data)
+                record_role(user.uid, 'patient', batch=batch)
+                batch.commit()
+                directory_cache.put('patients', user.uid, patient_data)
             elif role == 'practitioner':
-                practitioners_ref.document(user.uid).set({
+                practitioner_data = {
                     'email': email, 'name': name, 'number': number, 'role': 'practitioner',
                     'created_at': datetime.now(), 
                     'verification_status': 'Pending Review',
                     'specialties': [], 'address': 'Not specified',
                     'contact': {'phone': number, 'email': email}, 
                     'appointment_price': 0, 'session_price': 0
-                })
+                }
+                batch = db.batch()
+                batch.set(practitioners_ref.document(user.uid), practitioner_data)
                 # Initialize availability document with new structure
-                availability_ref.document(user.uid).set({'recurring': {}, 'overrides': {}})
+                batch.set(availability_ref.document(user.uid), {'recurring': {}})
+                record_role(user.uid, 'practitioner', batch=batch)
+                batch.commit()
+                directory_cache.put('practitioners', user.uid, practitioner_data)
             return redirect(url_for('signin'))
         except Exception as e:
             return render_template('register.html', error=str(e))
@@ -171,6 +1313,7 @@ def signin():
     return render_template('signin.html', firebase_config=firebase_config)
 
 @app.route('/verify-token', methods=['POST'])
+@read_budget(gets=1, queries=0, commits=0, reads=1)
 def verify_token():
     id_token = request.json.get('idToken')
     if not id_token:
@@ -179,41 +1322,28 @@ def verify_token():
         return jsonify({"success": False, "error": "Server configuration error."}), 500
 
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = decode_id_token(id_token)
         uid = decoded_token['uid']
+        user_role = resolve_role(uid, decoded_token)
         
-        admin_doc = practitioners_ref.document(uid).get()
-        if admin_doc.exists and admin_doc.to_dict().get('role') == 'admin':
-            session['user_id'] = uid
-            session['user_role'] = 'admin'
-            return jsonify({"success": True, "redirect": url_for('admin_dashboard')})
-            
-        user_doc = users_ref.document(uid).get()
-        user_role = None
-        if user_doc.exists:
-            user_role = user_doc.to_dict().get('role')
-        else:
-            practitioner_doc = practitioners_ref.document(uid).get()
-            if practitioner_doc.exists:
-                user_role = practitioner_doc.to_dict().get('role')
-            else:
-                users_ref.document(uid).set({
-                    'email': decoded_token.get('email', 'N/A'),
-                    'name': decoded_token.get('name', 'New User'),
-                    'role': 'patient', 'created_at': datetime.now()
-                })
-                user_role = 'patient'
-        
-        if not user_role:
-            return jsonify({"success": False, "error": "User role not found."}), 401
-
-        session['user_id'] = uid
-        session['user_role'] = user_role
-        return jsonify({"success": True, "redirect": url_for('dashboard')})
+        return start_session(uid, user_role)
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 401
 
+
+def start_session(uid, user_role):
+    if not user_role:
+        return jsonify({"success": False, "error": "User role not found."}), 401
+
+    session['user_id'] = uid
+    session['user_role'] = user_role
+    if user_role == 'admin':
+        return jsonify({"success": True, "redirect": url_for('admin_dashboard')})
+    return jsonify({"success": True, "redirect": url_for('dashboard')})
+
+
 @app.route('/dashboard')
+@read_budget(gets=1, queries=0, commits=0, reads=1)
 def dashboard():
     if 'user_id' not in session:
         return redirect(url_for('signin'))
@@ -223,132 +1353,124 @@ def dashboard():
     if user_role == 'admin':
         return redirect(url_for('admin_dashboard'))
 
+    # Only the shell is rendered here; every panel loads from dashboard_fragment
+    user_profile = {}
     if not db:
         flash("Database access is currently unavailable.", "error")
-        return render_template('dashboard.html', sessions=[], notifications=[], user_role=user_role, user_id=user_id, user_settings={}, user_profile={}, firebase_config=firebase_config, feedback=[], availability={}, journeys=[])
+    else:
+        try:
+            user_profile = lookup_profiles(profile_directory(user_role), [user_id]).get(user_id, {})
+        except Exception as e:
+            flash(f"Error fetching user data: {e}", "error")
+    return render_dashboard(user_role, user_id, user_profile)
+
+
+def profile_directory(user_role):
+    return 'practitioners' if user_role == 'practitioner' else 'patients'
+
 
+def render_dashboard(user_role, user_id, user_profile):
+    return render_template('dashboard.html',
+                           user_role=user_role,
+                           user_id=user_id,
+                           user_profile=user_profile,
+                           fragment_topics={name: fragment['topics'] for name, fragment in DASHBOARD_FRAGMENTS.items()},
+                           page_size=PAGE_SIZE)
+
+
+@app.route('/dashboard/fragments/<name>')
+# Budgets are declared per fragment in DASHBOARD_FRAGMENTS
+def dashboard_fragment(name):
+    if 'user_id' not in session:
+        return "Unauthorized", 403
+    user_role, user_id = session.get('user_role'), session.get('user_id')
+    fragment = DASHBOARD_FRAGMENTS.get(name)
+    if fragment is None or user_role not in fragment['roles']:
+        return "Not found", 404
+    if not db:
+        return '<p class="fragment-status">Database access is currently unavailable.</p>', 503
+
+    key = fragment_key(name, user_id)
+    html = fragment_cache.get(key)
+    if html is None:
+        try:
+            context = fragment['load'](user_role, user_id)
+        except Exception as e:
+            return (f'<p class="fragment-status">Could not load this section: {escape(str(e))}. '
+                    f'<a href="#" class="fragment-retry">Try again</a></p>'), 500
+        html = render_template(fragment['template'], user_role=user_role, user_id=user_id,
+                               page_size=PAGE_SIZE, **context)
+        fragment_cache.set(key, html)
+    return html
+
+
+@app.route('/dashboard/events')
+def dashboard_events():
+    if 'user_id' not in session:
+        return "Unauthorized", 403
+    if not app.config['LIVE_UPDATES']:
+        # 204 tells EventSource not to reconnect
+        return '', 204
+    if not db:
+        return "Database access is currently unavailable.", 503
+    subscriber = Subscriber(session['user_id'])
+    return Response(live_updates.stream(subscriber), mimetype='text/event-stream', headers=event_stream_headers())
+
+
+@app.route('/api/sessions')
+@read_budget(gets=1, queries=1, commits=0, reads=45)
+def api_sessions():
+    if 'user_id' not in session or session.get('user_role') not in ('patient', 'practitioner'):
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+    user_role, user_id = session['user_role'], session['user_id']
     try:
-        practitioners_docs = practitioners_ref.stream()
-        practitioner_map = {doc.id: doc.to_dict() for doc in practitioners_docs}
-        
-        patient_docs = users_ref.where('role', '==', 'patient').stream()
-        patient_map = {doc.id: doc.to_dict() for doc in patient_docs}
-        
-        therapists_data = [{'doc_id': doc_id, **data} for doc_id, data in practitioner_map.items()]
+        cursor, limit = page_args()
+        docs, next_cursor = fetch_page(repos.sessions.for_user(user_role, user_id), 'date', cursor, limit)
+        sessions_data = prepare_sessions(user_role, docs)
+        attach_names('patients' if user_role == 'practitioner' else 'practitioners', sessions_data)
+        return jsonify({"success": True, "items": to_json_safe(sessions_data), "next_cursor": next_cursor})
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
     except Exception as e:
-        flash(f"Error fetching user data: {e}", "error")
-        practitioner_map, patient_map, therapists_data = {}, {}, []
+        return jsonify({"success": False, "error": str(e)}), 500
 
-    user_settings_doc = notifications_ref.document(user_id).get()
-    user_settings = user_settings_doc.to_dict() if user_settings_doc.exists else {'in-app': True, 'sms': False, 'email': False}
 
-    user_profile = {}
-    if user_role == 'patient':
-        user_doc = users_ref.document(user_id).get()
-        if user_doc.exists:
-            user_profile = user_doc.to_dict()
-    elif user_role == 'practitioner':
-        practitioner_doc = practitioners_ref.document(user_id).get()
-        if practitioner_doc.exists:
-            user_profile = practitioner_doc.to_dict()
+@app.route('/api/feedback')
+@read_budget(gets=1, queries=1, commits=0, reads=45)
+def api_feedback():
+    if 'user_id' not in session or session.get('user_role') != 'practitioner':
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+    try:
+        cursor, limit = page_args()
+        docs, next_cursor = fetch_page(repos.feedback.for_practitioner(session['user_id']), 'created_at', cursor, limit)
+        feedback_data = [doc.to_dict() for doc in docs]
+        attach_names('patients', feedback_data)
+        return jsonify({"success": True, "items": to_json_safe(feedback_data), "next_cursor": next_cursor})
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
 
-    sessions_data, notifications, feedback_data, active_patients_count, availability_data, journeys_data = [], [], [], 0, {}, []
 
+@app.route('/api/notifications')
+@read_budget(gets=0, queries=1, commits=0, reads=21)
+def api_notifications():
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
     try:
-        if user_role == 'practitioner':
-            availability_doc = availability_ref.document(user_id).get()
-            if availability_doc.exists:
-                availability_data = availability_doc.to_dict()
-
-            all_sessions_query = sessions_ref.where('practitioner_uid', '==', user_id).order_by('date', direction=firestore.Query.DESCENDING).stream()
-            active_patient_uids = set()
-            for doc in all_sessions_query:
-                session_item = doc.to_dict()
-                if not session_item.get('date'):
-                    print(f"Warning: Practitioner session document {doc.id} is missing a date and will be skipped.")
-                    continue
-                
-                session_item['doc_id'] = doc.id
-                patient_uid = session_item.get('patient_uid')
-                if patient_uid:
-                    active_patient_uids.add(patient_uid)
-                    patient_info = patient_map.get(patient_uid, {})
-                    session_item['patient_name'] = patient_info.get('name', 'Unknown Patient')
-                else:
-                    session_item['patient_name'] = 'N/A'
-                
-                sessions_data.append(session_item)
-            active_patients_count = len(active_patient_uids)
-
-            feedback_query = feedback_ref.where('practitioner_uid', '==', user_id).order_by('created_at', direction=firestore.Query.DESCENDING).stream()
-            for doc in feedback_query:
-                fb = doc.to_dict()
-                patient_info = patient_map.get(fb.get('patient_uid'), {})
-                fb['patient_name'] = patient_info.get('name', 'Unknown Patient')
-                feedback_data.append(fb)
-            
-        elif user_role == 'patient':
-            patient_sessions_query = sessions_ref.where('patient_uid', '==', user_id).order_by('date', direction=firestore.Query.DESCENDING).stream()
-            now_utc = datetime.now(timezone.utc)
-            for doc in patient_sessions_query:
-                session_item = doc.to_dict()
-                if not session_item.get('date'):
-                    continue
-
-                session_item['doc_id'] = doc.id
-                practitioner_info = practitioner_map.get(session_item.get('practitioner_uid'), {})
-                session_item['practitioner_name'] = practitioner_info.get('name', 'N/A')
-                
-                session_date = session_item.get('date')
-                session_status = session_item.get('status')
-
-                if session_status == 'payment_pending':
-                    session_item['payment_deadline_passed'] = (session_date - now_utc) < timedelta(days=1)
-                
-                session_item['is_cancellable'] = False
-                if session_status == 'payment_pending' and (session_date - now_utc) > timedelta(days=3):
-                    session_item['is_cancellable'] = True
-                
-                session_item['is_reschedulable'] = False
-                if session_status in ['payment_pending', 'scheduled'] and (session_date - now_utc) > timedelta(days=1):
-                    session_item['is_reschedulable'] = True
-                
-                sessions_data.append(session_item)
-
-            # Fetch active patient journeys
-            try:
-                active_journeys_query = db.collection('patient_journeys') \
-                                          .where('patient_uid', '==', user_id).stream()
-                for doc in active_journeys_query:
-                    journeys_data.append(doc.to_dict())
-            except Exception as e:
-                flash(f"Could not load therapy journeys: {e}", "error")
-
-        notifications_query = notifications_ref.where('recipient_id', '==', user_id).order_by('created_at', direction=firestore.Query.DESCENDING).stream()
-        for doc in notifications_query:
-            notification_item = doc.to_dict()
-            if notification_item.get('created_at'):
-                notifications.append(notification_item)
-
+        cursor, limit = page_args()
+        docs, next_cursor = fetch_page(repos.notifications.for_recipient(session['user_id']), 'created_at', cursor, limit)
+        notifications = [item for item in (doc.to_dict() for doc in docs) if item.get('created_at')]
+        return jsonify({"success": True, "items": to_json_safe(notifications), "next_cursor": next_cursor})
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
     except Exception as e:
-        flash(f"An error occurred while fetching dashboard data: {e}", "error")
-
-    return render_template('dashboard.html', 
-                           sessions=sessions_data, 
-                           notifications=notifications, 
-                           user_role=user_role, 
-                           user_id=user_id, 
-                           user_settings=user_settings, 
-                           therapists=therapists_data, 
-                           user_profile=user_profile, 
-                           firebase_config=firebase_config,
-                           feedback=feedback_data,
-                           active_patients_count=active_patients_count,
-                           availability=availability_data,
-                           journeys=journeys_data)
+        return jsonify({"success": False, "error": str(e)}), 500
 
 
 @app.route('/schedule_session_patient', methods=['POST'])
+# The first booking in a process also reads the reservation backfill marker
+@read_budget(gets=4, queries=0, commits=2, reads=5, writes=4)
 def schedule_session_patient():
     if 'user_id' not in session or session.get('user_role') != 'patient':
         return redirect(url_for('signin'))
@@ -356,49 +1478,89 @@ def schedule_session_patient():
         flash('Database is not available.', 'error')
         return redirect(url_for('dashboard'))
     try:
-        practitioner_uid = request.form['therapist-uid']
-        therapy_type = request.form['therapy-type']
-        session_date = request.form['session-date']
-        session_time = request.form['session-time']
-
-        session_datetime_obj = datetime.strptime(f"{session_date} {session_time}", "%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc)
-
-        existing_session_query = sessions_ref.where('practitioner_uid', '==', practitioner_uid)\
-                                             .where('date', '==', session_datetime_obj).limit(1).stream()
-        if len(list(existing_session_query)) > 0:
-            flash('This time slot has just been booked. Please select another time.', 'error')
+        practitioner_uid, therapy_type, session_datetime_obj = parse_booking_form()
+        practitioner_data = lookup_profiles('practitioners', [practitioner_uid]).get(practitioner_uid)
+        if not practitioner_data:
+            flash('Practitioner not found.', 'error')
             return redirect(url_for('dashboard'))
 
-        if therapy_type == 'auto':
-            therapies = ['Virechana', 'Nasya', 'Basti', 'Vamana', 'Raktamokshana']
-            therapy_type = random.choice(therapies)
-
-        practitioner_doc = practitioners_ref.document(practitioner_uid).get()
-        practitioner_data = practitioner_doc.to_dict()
-        appointment_price = practitioner_data.get('appointment_price', 0)
-        session_price = practitioner_data.get('session_price', 0)
-
-        sessions_ref.add({
-            'patient_uid': session['user_id'], 'practitioner_uid': practitioner_uid,
-            'therapy': therapy_type, 'date': session_datetime_obj,
-            'status': 'payment_pending', 'payment_status': 'pending',
-            'amount_due': appointment_price,
-            'appointment_price': appointment_price,
-            'session_price': session_price,
-            'created_at': datetime.now(timezone.utc)
-        })
-
-        notifications_ref.add({
-            'recipient_id': practitioner_uid, 'message': f"A new session has been requested by a patient.",
-            'type': 'new_request', 'read': False, 'created_at': datetime.now(timezone.utc)
-        })
-        flash('Your appointment request has been sent! Please pay the confirmation fee to confirm.', 'success')
+        refs = slot_availability_refs(repos, practitioner_uid, session_datetime_obj)
+        if not slot_offered(refs, db.get_all(refs), session_datetime_obj):
+            return slot_not_offered(practitioner_uid)
+        if legacy_booking_exists(practitioner_uid, session_datetime_obj):
+            raise AlreadyExists("Slot held by a session without a reservation")
+        batch = db.batch()
+        add_booking_writes(repos, batch, practitioner_uid, practitioner_data, therapy_type, session_datetime_obj)
+        batch.commit()
+        return booking_requested(practitioner_uid)
+    except AlreadyExists:
+        flash('This time slot has just been booked. Please select another time.', 'error')
         return redirect(url_for('dashboard'))
     except Exception as e:
         flash(f"An error occurred: {str(e)}", 'error')
         return redirect(url_for('dashboard'))
 
+
+def parse_booking_form():
+    practitioner_uid = request.form['therapist-uid']
+    therapy_type = request.form['therapy-type']
+    session_date = request.form['session-date']
+    session_time = request.form['session-time']
+
+    session_datetime_obj = datetime.strptime(f"{session_date} {session_time}", "%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc)
+
+    if therapy_type == 'auto':
+        therapies = ['Virechana', 'Nasya', 'Basti', 'Vamana', 'Raktamokshana']
+        therapy_type = random.choice(therapies)
+    return practitioner_uid, therapy_type, session_datetime_obj
+
+
+def add_booking_writes(repositories, batch, practitioner_uid, practitioner_data, therapy_type, session_datetime_obj):
+    """Adds the writes for a booking request by the signed-in patient to `batch`."""
+    appointment_price = practitioner_data.get('appointment_price', 0)
+    session_price = practitioner_data.get('session_price', 0)
+
+    # The reservation create() fails if the slot is already taken, so the
+    # whole booking is a single commit with no check-then-add race.
+    now_utc = datetime.now(timezone.utc)
+    new_session_ref = repositories.sessions.ref()
+    batch.create(repositories.slot_reservations.ref_for(practitioner_uid, session_datetime_obj), {
+        'practitioner_uid': practitioner_uid, 'patient_uid': session['user_id'],
+        'session_id': new_session_ref.id, 'date': session_datetime_obj, 'created_at': now_utc
+    })
+    batch.set(new_session_ref, {
+        'patient_uid': session['user_id'], 'practitioner_uid': practitioner_uid,
+        'therapy': therapy_type, 'date': session_datetime_obj,
+        'status': 'payment_pending', 'payment_status': 'pending',
+        'amount_due': appointment_price,
+        'appointment_price': appointment_price,
+        'session_price': session_price,
+        'created_at': now_utc,
+        'updated_at': now_utc
+    })
+    batch.set(repositories.practitioner_stats.ref(practitioner_uid), {
+        'patient_uids': firestore.ArrayUnion([session['user_id']])
+    }, merge=True)
+
+
+def slot_not_offered(practitioner_uid):
+    # This worker's cached schedule was stale too
+    invalidate_availability(practitioner_uid)
+    flash('This time is no longer available. Please select another time.', 'error')
+    return redirect(url_for('dashboard'))
+
+
+def booking_requested(practitioner_uid):
+    invalidate_availability(practitioner_uid, schedule=False)
+    invalidate_fragments([session['user_id'], practitioner_uid], 'sessions')
+
+    notification_outbox.enqueue(practitioner_uid, "A new session has been requested by a patient.", 'new_request')
+
+    flash('Your appointment request has been sent! Please pay the confirmation fee to confirm.', 'success')
+    return redirect(url_for('dashboard'))
+
 @app.route('/create_order', methods=['POST'])
+@read_budget(gets=1, queries=0, commits=1, reads=1, writes=1)
 def create_order():
     if 'user_id' not in session or session.get('user_role') != 'patient':
         return jsonify({"success": False, "error": "Unauthorized"}), 403
@@ -410,21 +1572,88 @@ def create_order():
         if not session_doc.exists:
             return jsonify({"success": False, "error": "Session not found"}), 404
         session_data = session_doc.to_dict()
+        if session_data.get('payment_status') == 'paid':
+            return jsonify({"success": False, "error": "This session has already been paid for."}), 400
         amount_due = session_data.get('amount_due', 0)
         if amount_due <= 0:
             return jsonify({"success": False, "error": "No payment is due for this session."}), 400
-        order_data = {
-            'amount': int(amount_due * 100), 'currency': 'INR', 'receipt': f'receipt_{session_id}'
-        }
-        order = razorpay_client.order.create(data=order_data)
+        amount = int(amount_due * 100)
+
+        # Hand out the session's open order again rather than creating a new one per click
+        now = datetime.now(timezone.utc)
+        order_info = session_data.get('razorpay_order') or {}
+        if order_info.get('amount') != amount or not order_info.get('expires_at') or order_info['expires_at'] <= now:
+            order_data = {
+                'amount': amount, 'currency': 'INR', 'receipt': f'receipt_{session_id}',
+                'notes': {'session_id': session_id}
+            }
+            order = razorpay_client.order.create(data=order_data)
+            order_info = {
+                'id': order['id'], 'amount': order['amount'], 'created_at': now,
+                'expires_at': now + timedelta(seconds=app.config['RAZORPAY_ORDER_TTL'])
+            }
+            sessions_ref.document(session_id).update({'razorpay_order': order_info})
+
         return jsonify({
-            "success": True, "order_id": order['id'], "amount": order['amount'],
+            "success": True, "order_id": order_info['id'], "amount": order_info['amount'],
             "key_id": app.config['RAZORPAY_KEY_ID']
         })
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+
+@transactional
+def mark_session_paid(transaction, session_ref, payment_id):
+    """Marks the session paid and scheduled. Returns its data, or None if it was already paid."""
+    session_doc = session_ref.get(transaction=transaction)
+    if not session_doc.exists:
+        raise LookupError(f"Session {session_ref.id} not found")
+    session_data = session_doc.to_dict()
+    if session_data.get('payment_status') == 'paid':
+        return None
+    transaction.update(session_ref, {
+        'status': 'scheduled', 'payment_status': 'paid', 'payment_id': payment_id,
+        'updated_at': datetime.now(timezone.utc)
+    })
+    return session_data
+
+
+def confirm_session_payment(session_id, payment_id):
+    """Shared by the browser callback and the webhook; running it twice is harmless."""
+    session_data = mark_session_paid(db.transaction(), sessions_ref.document(session_id), payment_id)
+    if session_data:
+        invalidate_fragments([session_data.get('patient_uid'), session_data.get('practitioner_uid')], 'sessions')
+    # Generate the journey in the background
+    job_queue.submit(f"journey:{session_id}", create_patient_journey, session_id)
+
+
+def confirm_order_payment(order_id, payment_id, session_id=None):
+    """
+    Confirms the session an order was created for, as reported by a webhook,
+    and returns its id. `session_id` comes from the order's notes; without
+    it the session is looked up by order id, which only finds the order it
+    holds now, not one it replaced. Raises LookupError if no session matches.
+    """
+    if not session_id:
+        session_docs = list(repos.sessions.by_order_id(order_id).stream())
+        if not session_docs:
+            raise LookupError(f"No session found for Razorpay order {order_id}")
+        session_id = session_docs[0].id
+    confirm_session_payment(session_id, payment_id)
+    return session_id
+
+
+def razorpay_notes(payload):
+    """The notes create_order set, from the payment or the order entity; Razorpay sends [] for none."""
+    for entity in ('payment', 'order'):
+        notes = payload.get(entity, {}).get('entity', {}).get('notes')
+        if isinstance(notes, dict) and notes:
+            return notes
+    return {}
+
+
 @app.route('/verify_payment', methods=['POST'])
+@read_budget(gets=2, queries=1, commits=2, reads=10, writes=2)
 def verify_payment():
     if 'user_id' not in session:
         return jsonify({"success": False, "error": "Unauthorized"}), 403
@@ -437,25 +1666,76 @@ def verify_payment():
             'razorpay_signature': data['razorpay_signature']
         }
         razorpay_client.utility.verify_payment_signature(params_dict)
-        session_ref = sessions_ref.document(session_id)
-        session_ref.update({
-            'status': 'scheduled', 'payment_status': 'paid', 'payment_id': data['razorpay_payment_id']
-        })
-        
-        # Trigger the journey creation
-        create_patient_journey(session_id)
-        
+        confirm_session_payment(session_id, data['razorpay_payment_id'])
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": "Payment verification failed"}), 400
 
+
+@app.route('/razorpay_webhook', methods=['POST'])
+@read_budget(gets=3, queries=2, commits=3, reads=10, writes=3)
+def razorpay_webhook():
+    """
+    Confirms payments server-side, so a session is scheduled even when the
+    browser never returns from checkout. Razorpay retries deliveries, so each
+    event id is recorded once it has been handled and repeats are
+    acknowledged without work. Confirmation runs before the response: a
+    failure answers 500, and a payment matching no session 404, and Razorpay
+    delivers the event again. The session comes from the order's notes, so
+    a payment through an order the session has since replaced still finds it.
+    """
+    webhook_secret = app.config['RAZORPAY_WEBHOOK_SECRET']
+    if not webhook_secret:
+        # An empty key would accept bodies anyone can sign
+        print("Error: RAZORPAY_WEBHOOK_SECRET is not set; refusing Razorpay webhook.")
+        return jsonify({"success": False, "error": "Webhook not configured"}), 503
+    body = request.get_data(as_text=True)
+    try:
+        razorpay_client.utility.verify_webhook_signature(
+            body, request.headers.get('X-Razorpay-Signature'), webhook_secret)
+    except Exception:
+        return jsonify({"success": False, "error": "Invalid signature"}), 400
+
+    event = json.loads(body)
+    if event.get('event') not in ('payment.captured', 'order.paid'):
+        return jsonify({"success": True, "ignored": True})
+    payload = event.get('payload', {})
+    payment = payload.get('payment', {}).get('entity', {})
+    order_id, payment_id = payment.get('order_id'), payment.get('id')
+    if not order_id or not payment_id:
+        return jsonify({"success": False, "error": "Missing payment details"}), 400
+
+    event_id = request.headers.get('X-Razorpay-Event-Id') or f"{event['event']}:{payment_id}"
+    event_ref = repos.payment_events.ref(event_id)
+    try:
+        if event_ref.get().exists:
+            return jsonify({"success": True, "duplicate": True})
+        # Marking an already paid session again is a no-op, so a delivery racing this one is harmless
+        session_id = confirm_order_payment(order_id, payment_id, razorpay_notes(payload).get('session_id'))
+        event_ref.set({
+            'event': event['event'], 'order_id': order_id, 'payment_id': payment_id,
+            'session_id': session_id, 'handled_at': datetime.now(timezone.utc)
+        })
+    except LookupError as e:
+        # Money was captured for a session we cannot find: left unrecorded so retries keep it visible
+        print(f"Error: Razorpay event {event_id} for payment {payment_id} matches no session: {e}")
+        return jsonify({"success": False, "error": "Session not found"}), 404
+    except Exception as e:
+        print(f"Error handling Razorpay event {event_id}: {e}")
+        # A non-2xx response makes Razorpay deliver the event again later
+        return jsonify({"success": False, "error": str(e)}), 500
+    return jsonify({"success": True})
+
 @app.route('/complete_session', methods=['POST'])
+@read_budget(gets=0, queries=0, commits=1, writes=1)
 def complete_session():
     if 'user_id' not in session or session.get('user_role') != 'practitioner':
         return "Unauthorized", 403
     session_id = request.form.get('session_id')
     try:
-        sessions_ref.document(session_id).update({'status': 'completed'})
+        sessions_ref.document(session_id).update({'status': 'completed', 'updated_at': datetime.now(timezone.utc)})
+        # The patient is not known here without a read; the sessions listener tells their dashboard
+        invalidate_fragments(session['user_id'], 'sessions')
         flash("Session marked as complete.", "success")
         return redirect(url_for('dashboard'))
     except Exception as e:
@@ -463,6 +1743,7 @@ def complete_session():
         return redirect(url_for('dashboard'))
 
 @app.route('/cancel_session_patient', methods=['POST'])
+@read_budget(gets=1, queries=0, commits=1, reads=1, writes=2)
 def cancel_session_patient():
     if 'user_id' not in session or session.get('user_role') != 'patient':
         flash("Unauthorized access.", "error")
@@ -489,7 +1770,12 @@ def cancel_session_patient():
         return redirect(url_for('dashboard'))
 
     try:
-        session_ref.update({'status': 'cancelled'})
+        batch = db.batch()
+        batch.update(session_ref, {'status': 'cancelled', 'updated_at': datetime.now(timezone.utc)})
+        batch.delete(slot_reservation_ref(session_data.get('practitioner_uid'), session_data.get('date')))
+        batch.commit()
+        invalidate_availability(session_data.get('practitioner_uid'), schedule=False)
+        invalidate_fragments([session['user_id'], session_data.get('practitioner_uid')], 'sessions')
         flash("Your appointment request has been cancelled.", "success")
     except Exception as e:
         flash(f"An error occurred: {e}", "error")
@@ -502,6 +1788,7 @@ def logout():
     return redirect(url_for('home'))
 
 @app.route('/save_notifications', methods=['POST'])
+@read_budget(gets=0, queries=0, commits=1, writes=1)
 def save_notifications():
     if 'user_id' not in session:
         return redirect(url_for('signin'))
@@ -512,17 +1799,22 @@ def save_notifications():
         'in-app': 'in-app' in request.form, 'sms': 'sms' in request.form, 'email': 'email' in request.form
     }
     notifications_ref.document(session['user_id']).set(user_settings, merge=True)
+    invalidate_fragments(session['user_id'], 'settings')
     flash("Notification preferences saved.", "success")
     return redirect(url_for('dashboard'))
 
 @app.route('/update_profile', methods=['POST'])
+@read_budget(gets=0, queries=0, commits=1, writes=1)
 def update_profile():
     if 'user_id' not in session:
         return jsonify({"success": False, "error": "Unauthorized"}), 403
     user_id, user_role, data = session['user_id'], session['user_role'], request.json
     try:
         if user_role == 'patient':
-            users_ref.document(user_id).update({'name': data.get('name'), 'number': data.get('number')})
+            updates = {'name': data.get('name'), 'number': data.get('number')}
+            users_ref.document(user_id).update(updates)
+            directory_cache.update('patients', user_id, updates)
+            invalidate_fragments(user_id, 'profile')
         elif user_role == 'practitioner':
             updates = {
                 'name': data.get('name'), 'number': data.get('number'),
@@ -532,12 +1824,17 @@ def update_profile():
                 'session_price': int(data.get('session_price', 0)),
                 'contact.phone': data.get('number')
             }
-            practitioners_ref.document(user_id).update({k: v for k, v in updates.items() if v is not None})
+            updates = {k: v for k, v in updates.items() if v is not None}
+            practitioners_ref.document(user_id).update(updates)
+            directory_cache.update('practitioners', user_id, updates)
+            invalidate_fragments(user_id, 'profile')
+            invalidate_fragments(None, 'therapists')
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/update_recurring_availability', methods=['POST'])
+@read_budget(gets=0, queries=0, commits=1, writes=1)
 def update_recurring_availability():
     if 'user_id' not in session or session.get('user_role') != 'practitioner':
         return jsonify({"success": False, "error": "Unauthorized"}), 403
@@ -545,11 +1842,14 @@ def update_recurring_availability():
     recurring_data = request.json
     try:
         availability_ref.document(user_id).set({'recurring': recurring_data}, merge=True)
+        invalidate_availability(user_id)
+        invalidate_fragments(user_id, 'availability')
         return jsonify({"success": True, "message": "Recurring schedule updated."})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/update_date_override', methods=['POST'])
+@read_budget(gets=0, queries=0, commits=1, writes=1)
 def update_date_override():
     if 'user_id' not in session or session.get('user_role') != 'practitioner':
         return jsonify({"success": False, "error": "Unauthorized"}), 403
@@ -559,81 +1859,94 @@ def update_date_override():
     times_str = data.get('times', '')
     times_list = sorted(list(set([t.strip() for t in times_str.split(',') if t.strip()])))
     try:
-        availability_ref.document(user_id).update({
-            f'overrides.{date_str}': times_list
+        datetime.strptime(date_str or '', '%Y-%m-%d')
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid date."}), 400
+    try:
+        repos.availability_overrides.ref_for(user_id, date_str).set({
+            'practitioner_uid': user_id, 'date': date_str, 'times': times_list,
+            'updated_at': datetime.now(timezone.utc)
         })
+        invalidate_availability(user_id)
+        invalidate_fragments(user_id, 'availability')
         return jsonify({"success": True, "message": f"Availability for {date_str} has been overridden."})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+def requested_days():
+    return min(max(request.args.get('days', AVAILABILITY_DEFAULT_DAYS, type=int), 1), AVAILABILITY_MAX_DAYS)
+
+
+def availability_response(schedule, booked_slots, days):
+    today = datetime.now(timezone.utc).date()
+    etag = content_tag(schedule.version, today, days,
+                       {date_str: sorted(minutes) for date_str, minutes in booked_slots.items()})
+    cached_response = not_modified(etag)
+    if cached_response:
+        return cached_response
+    return conditional(jsonify({"success": True, "slots": schedule.expand(today, days, booked_slots)}), etag)
+
+
 @app.route('/get_availability/<practitioner_uid>')
+@read_budget(gets=1, queries=2, commits=0, reads=30)
 def get_availability(practitioner_uid):
     if 'user_id' not in session:
         return jsonify({"success": False, "error": "Unauthorized"}), 403
+    days = requested_days()
     try:
-        availability_doc = availability_ref.document(practitioner_uid).get()
-        if not availability_doc.exists:
+        schedule = get_compiled_schedule(practitioner_uid)
+        if schedule is None:
             return jsonify({"success": True, "slots": {}})
-        
-        availability_data = availability_doc.to_dict()
-        recurring_rules = availability_data.get('recurring', {})
-        overrides = availability_data.get('overrides', {})
-
-        booked_slots = {}
-        start_of_today = datetime.now(timezone.utc)
-        sessions_query = sessions_ref.where('practitioner_uid', '==', practitioner_uid)\
-                                   .where('date', '>=', start_of_today).stream()
-        for sess in sessions_query:
-            sess_data = sess.to_dict()
-            if sess_data.get('date') and sess_data.get('status') != 'cancelled':
-                sess_date = sess_data['date'].strftime('%Y-%m-%d')
-                sess_time = sess_data['date'].strftime('%H:%M')
-                if sess_date not in booked_slots:
-                    booked_slots[sess_date] = []
-                booked_slots[sess_date].append(sess_time)
-
-        final_slots = {}
-        today = datetime.now(timezone.utc).date()
-        for i in range(60): 
-            current_date = today + timedelta(days=i)
-            date_str = current_date.strftime('%Y-%m-%d')
-            day_name = current_date.strftime('%A').lower()
-            
-            day_slots = []
-
-            if date_str in overrides:
-                day_slots = overrides.get(date_str, [])
-            elif day_name in recurring_rules:
-                rule = recurring_rules[day_name]
-                try: 
-                    start_str = rule.get('start')
-                    end_str = rule.get('end')
-                    if start_str and end_str:
-                        start_time = datetime.strptime(start_str, '%H:%M').time()
-                        end_time = datetime.strptime(end_str, '%H:%M').time()
-                        interval = int(rule.get('interval') or 60)
-                        
-                        current_slot_time = datetime.combine(current_date, start_time)
-                        while current_slot_time.time() < end_time:
-                            day_slots.append(current_slot_time.strftime('%H:%M'))
-                            current_slot_time += timedelta(minutes=interval)
-                except (ValueError, TypeError) as e:
-                    print(f"Warning: Skipping recurring rule for {day_name} due to malformed data: {rule}. Error: {e}")
-                    pass
-            
-            if day_slots:
-                booked_for_day = booked_slots.get(date_str, [])
-                available_day_slots = [slot for slot in day_slots if slot not in booked_for_day]
-                
-                if available_day_slots:
-                    final_slots[date_str] = available_day_slots
-
-        return jsonify({"success": True, "slots": final_slots})
+        return availability_response(schedule, get_booked_slots(practitioner_uid, days), days)
     except Exception as e:
         print(f"Error in get_availability for {practitioner_uid}: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+# A cold call builds the shared slot index from every booking in the window
+@app.route('/search_slots')
+@read_budget(gets=1, queries=3, commits=0, reads=400)
+def search_slots():
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+    therapy = normalize(request.args.get('therapy'))
+    max_price = request.args.get('max_price', type=int)
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    try:
+        today = datetime.now(timezone.utc).date()
+        start = datetime.strptime(request.args['from'], '%Y-%m-%d').date() if request.args.get('from') else today
+        end = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if request.args.get('to') else start + timedelta(days=14)
+    except ValueError:
+        return jsonify({"success": False, "error": "Dates must be in YYYY-MM-DD format."}), 400
+    try:
+        verified = {uid: data for uid, data in get_practitioner_map().items() if data.get('verification_status') == 'Verified'}
+        candidates = {}
+        for uid, data in verified.items():
+            # Compared the way the search index compares them
+            if therapy and therapy != 'auto' and therapy not in {normalize(name) for name in data.get('specialties') or []}:
+                continue
+            if max_price is not None and (data.get('appointment_price') or 0) > max_price:
+                continue
+            candidates[uid] = data
+
+        index = get_slot_index(verified.keys(), candidates.keys())
+        window_start = datetime.combine(start, datetime.min.time(), tzinfo=timezone.utc)
+        window_end = datetime.combine(end + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+        matches = []
+        for slot, uid in index.earliest(candidates.keys(), window_start, window_end, limit):
+            data = candidates[uid]
+            matches.append({
+                'practitioner_uid': uid, 'practitioner_name': data.get('name'),
+                'date': slot.strftime('%Y-%m-%d'), 'time': slot.strftime('%H:%M'),
+                'appointment_price': data.get('appointment_price', 0),
+                'session_price': data.get('session_price', 0)
+            })
+        return jsonify({"success": True, "slots": matches})
+    except Exception as e:
+        print(f"Error in search_slots: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @app.route('/reschedule/<session_id>')
+@read_budget(gets=3, queries=0, commits=0, reads=3)
 def reschedule_session(session_id):
     if 'user_id' not in session or session.get('user_role') != 'patient':
         return redirect(url_for('signin'))
@@ -662,6 +1975,8 @@ def reschedule_session(session_id):
                            firebase_config=firebase_config)
 
 @app.route('/update_rescheduled_session', methods=['POST'])
+# Reads the reservation backfill marker too if no booking in this process has yet
+@read_budget(gets=4, queries=0, commits=1, reads=5, writes=4)
 def update_rescheduled_session():
     if 'user_id' not in session or session.get('user_role') != 'patient':
         return redirect(url_for('signin'))
@@ -674,7 +1989,7 @@ def update_rescheduled_session():
     session_ref = sessions_ref.document(session_id)
     
     try:
-        @firestore.transactional
+        @transactional
         def reschedule_transaction(transaction):
             session_doc = session_ref.get(transaction=transaction)
             if not session_doc.exists:
@@ -683,88 +1998,237 @@ def update_rescheduled_session():
             session_data = session_doc.to_dict()
             practitioner_uid = session_data['practitioner_uid']
             old_datetime = session_data['date']
-
-            availability_ref_tran = db.collection('practitioner_availability').document(practitioner_uid)
-            availability_doc = availability_ref_tran.get(transaction=transaction)
+            refs = slot_availability_refs(repos, practitioner_uid, new_datetime)
+            if not slot_offered(refs, db.get_all(refs, transaction=transaction), new_datetime):
+                return practitioner_uid, False
+            if legacy_booking_exists(practitioner_uid, new_datetime):
+                raise AlreadyExists("Slot held by a session without a reservation")
+
+            old_date_str = old_datetime.strftime('%Y-%m-%d')
+            override_ref = repos.availability_overrides.ref_for(practitioner_uid, old_date_str)
+            override_doc = override_ref.get(transaction=transaction)
             
             transaction.update(session_ref, {
                 'date': new_datetime,
-                'rescheduled': True
+                'rescheduled': True,
+                'updated_at': datetime.now(timezone.utc)
+            })
+            # Move the slot claim; create() fails the commit if the new slot is taken
+            transaction.create(slot_reservation_ref(practitioner_uid, new_datetime), {
+                'practitioner_uid': practitioner_uid, 'patient_uid': session_data.get('patient_uid'),
+                'session_id': session_id, 'date': new_datetime, 'created_at': datetime.now(timezone.utc)
             })
+            transaction.delete(slot_reservation_ref(practitioner_uid, old_datetime))
 
-            if availability_doc.exists:
-                overrides = availability_doc.to_dict().get('overrides', {})
-                old_date_str = old_datetime.strftime('%Y-%m-%d')
-                old_time_str = old_datetime.strftime('%H:%M')
-                
-                if old_date_str in overrides:
-                    if old_time_str not in overrides[old_date_str]:
-                        overrides[old_date_str].append(old_time_str)
-                        overrides[old_date_str].sort()
-                else:
-                    overrides[old_date_str] = [old_time_str]
-                transaction.update(availability_ref_tran, {'overrides': overrides})
+            # Reopen the freed slot on a date with custom hours; other dates follow the recurring rule
+            if override_doc.exists:
+                times = set(override_doc.to_dict().get('times') or [])
+                times.add(old_datetime.strftime('%H:%M'))
+                transaction.update(override_ref, {'times': sorted(times), 'updated_at': datetime.now(timezone.utc)})
+            return practitioner_uid, True
 
         transaction = db.transaction()
-        reschedule_transaction(transaction)
+        practitioner_uid, moved = reschedule_transaction(transaction)
+        invalidate_availability(practitioner_uid)
+        if not moved:
+            flash("This time is no longer available. Please select another time.", "error")
+            return redirect(url_for('reschedule_session', session_id=session_id))
+        invalidate_fragments([session['user_id'], practitioner_uid], 'sessions')
+        invalidate_fragments(practitioner_uid, 'availability')
         
         flash("Appointment rescheduled successfully!", "success")
         return redirect(url_for('dashboard'))
 
+    except AlreadyExists:
+        flash("This time slot has just been booked. Please select another time.", "error")
+        return redirect(url_for('reschedule_session', session_id=session_id))
     except Exception as e:
         flash(f"An error occurred during rescheduling: {e}", "error")
         return redirect(url_for('reschedule_session', session_id=session_id))
 
+# --- Admin Review Queue ---
+# Pending practitioners are listed a page at a time, oldest registration
+# first. The header counts come from aggregation queries (billed per 1000
+# index entries, not per document), cached briefly and adjusted in place by
+# approvals so that the redirect after each approval does not count again.
+ADMIN_COUNTS_TTL = int(os.environ.get('ADMIN_COUNTS_TTL', 60))
+admin_counts_cache = TTLCache(maxsize=1, ttl=ADMIN_COUNTS_TTL)
+
+
+def admin_count_loaders():
+    return {
+        'pending': lambda: count_query(repos.practitioners.pending_review()),
+        'verified': lambda: count_query(repos.practitioners.verified()),
+        'sessions': lambda: count_query(repos.sessions.collection),
+    }
+
+
+@transactional
+def approve_pending(transaction, practitioner_refs):
+    """Verifies those of the practitioners still pending review; returns their ids."""
+    approved = []
+    for doc in db.get_all(practitioner_refs, field_paths=['verification_status'], transaction=transaction):
+        if doc.exists and doc.to_dict().get('verification_status') == 'Pending Review':
+            transaction.update(doc.reference, {'verification_status': 'Verified'})
+            approved.append(doc.id)
+    return approved
+
+
+def approve_practitioners(practitioner_ids):
+    """
+    Marks pending practitioners verified, up to MAX_BATCH_WRITES per
+    transaction, and returns how many changed. Ids that are unknown or
+    already verified are skipped, so the cached pending count only drops
+    for approvals that happened.
+    """
+    practitioner_ids = list(dict.fromkeys(practitioner_ids))
+    approved = []
+    try:
+        for start in range(0, len(practitioner_ids), MAX_BATCH_WRITES):
+            chunk = practitioner_ids[start:start + MAX_BATCH_WRITES]
+            approved.extend(approve_pending(db.transaction(), [practitioners_ref.document(uid) for uid in chunk]))
+    finally:
+        # Batches committed before a failure still count
+        for practitioner_id in approved:
+            directory_cache.update('practitioners', practitioner_id, {'verification_status': 'Verified'})
+        if approved:
+            invalidate_fragments(approved, 'profile')
+            counts = admin_counts_cache.get('counts')
+            if counts is not None:
+                admin_counts_cache.set('counts', dict(counts, pending=max(counts['pending'] - len(approved), 0),
+                                                      verified=counts['verified'] + len(approved)))
+    return len(approved)
+
+
 @app.route('/admin')
+@read_budget(gets=0, queries=4, commits=0, reads=25)
 def admin_dashboard():
     if 'user_id' not in session or session.get('user_role') != 'admin':
         flash('You are not authorized to view this page.', 'error')
         return redirect(url_for('signin'))
 
-    pending_practitioners = []
-    docs = practitioners_ref.where('verification_status', '==', 'Pending Review').stream()
-    for doc in docs:
-        practitioner_data = doc.to_dict()
-        practitioner_data['doc_id'] = doc.id
-        pending_practitioners.append(practitioner_data)
-    
-    return render_template('admin.html', practitioners=pending_practitioners)
+    cursor = request.args.get('cursor') or None
+    loaders = {'page': lambda: fetch_page(repos.practitioners.pending_review(), 'created_at', cursor, oldest_first=True)}
+    counts = admin_counts_cache.get('counts')
+    if counts is None:
+        loaders.update(admin_count_loaders())
+    try:
+        results = unwrap_results(run_parallel(loaders))
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('admin_dashboard'))
+    except Exception as e:
+        flash(f'Error loading the review queue: {e}', 'error')
+        return render_template('admin.html', practitioners=[], counts=counts or {}, cursor=cursor, next_cursor=None)
+
+    docs, next_cursor = results.pop('page')
+    if counts is None:
+        counts = results
+        admin_counts_cache.set('counts', counts)
+    pending_practitioners = [{'doc_id': doc.id, **doc.to_dict()} for doc in docs]
+    return render_template('admin.html', practitioners=pending_practitioners, counts=counts,
+                           cursor=cursor, next_cursor=next_cursor)
 
 @app.route('/admin/approve/<practitioner_id>', methods=['POST'])
+@read_budget(gets=1, queries=0, commits=1, reads=1, writes=1)
 def approve_practitioner(practitioner_id):
     if 'user_id' not in session or session.get('user_role') != 'admin':
         return redirect(url_for('signin'))
     
     try:
-        practitioners_ref.document(practitioner_id).update({
-            'verification_status': 'Verified'
-        })
-        flash('Practitioner approved successfully!', 'success')
+        if approve_practitioners([practitioner_id]):
+            flash('Practitioner approved successfully!', 'success')
+        else:
+            flash('This practitioner is not pending review.', 'error')
     except Exception as e:
         flash(f'Error approving practitioner: {e}', 'error')
         
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('admin_dashboard', cursor=request.form.get('cursor') or None))
+
+
+@app.route('/admin/approve', methods=['POST'])
+@read_budget(gets=1, queries=0, commits=1, reads=25, writes=25)
+def approve_practitioners_bulk():
+    if 'user_id' not in session or session.get('user_role') != 'admin':
+        return redirect(url_for('signin'))
+
+    practitioner_ids = [uid for uid in request.form.getlist('practitioner_ids') if uid]
+    if not practitioner_ids:
+        flash('Select at least one practitioner to approve.', 'error')
+    else:
+        try:
+            approved = approve_practitioners(practitioner_ids)
+            flash(f"{approved} practitioner{'' if approved == 1 else 's'} approved.", 'success')
+        except Exception as e:
+            flash(f'Error approving practitioners: {e}', 'error')
+
+    return redirect(url_for('admin_dashboard', cursor=request.form.get('cursor') or None))
 
 @app.route('/privacy-policy')
 def privacy_policy():
     return render_template('privacy_policy.html')
 
 @app.route('/therapists')
+@read_budget(gets=0, queries=1, commits=0, reads=25)
 def therapists():
     if not db:
         return "Database is not available.", 500
     try:
-        all_practitioners = practitioners_ref.stream()
-        therapists_data = [{'doc_id': doc.id, **doc.to_dict()} for doc in all_practitioners]
-        
-        therapists_data.sort(key=lambda x: x.get('verification_status') != 'Verified')
-        
-        return render_template('therapists.html', therapists=therapists_data)
+        return therapists_response(get_practitioner_map())
     except Exception as e:
         return f"An error occurred: {str(e)}", 500
 
+
+def therapists_response(practitioner_map):
+    etag = content_tag(directory_cache.listing_version('practitioners'), request.query_string, 'user_id' in session,
+                       template_version('therapists.html', 'base.html'), assets.version)
+    cached_response = not_modified(etag)
+    if cached_response:
+        return cached_response
+
+    try:
+        filters = search_filters(request.args)
+    except ValueError as e:
+        flash(f"{e} Showing all practitioners instead.", "error")
+        filters = search_filters(MultiDict())
+    page = max(request.args.get('page', 1, type=int), 1)
+    therapists_data, total = search_therapists(practitioner_map, filters, (page - 1) * THERAPISTS_PAGE_SIZE,
+                                               THERAPISTS_PAGE_SIZE)
+
+    return conditional(app.make_response(render_template(
+        'therapists.html', therapists=therapists_data, total=total, page=page,
+        pages=max((total + THERAPISTS_PAGE_SIZE - 1) // THERAPISTS_PAGE_SIZE, 1),
+        filters=filters, specialties=practitioner_index.specialties(),
+        # Filter arguments carried over by the page links
+        query_args={name: values for name, values in request.args.lists() if name != 'page'}
+    )), etag)
+
+
+@app.route('/api/therapists')
+@read_budget(gets=0, queries=1, commits=0, reads=25)
+def api_therapists():
+    if not db:
+        return jsonify({"success": False, "error": "Database is not available."}), 500
+    try:
+        practitioner_map = get_practitioner_map()
+        etag = content_tag(directory_cache.listing_version('practitioners'), request.query_string)
+        cached_response = not_modified(etag)
+        if cached_response:
+            return cached_response
+        filters = search_filters(request.args)
+        cursor, limit = page_args()
+        offset = decode_offset(cursor)
+        items, total = search_therapists(practitioner_map, filters, offset, limit)
+        next_cursor = str(offset + limit) if offset + limit < total else None
+        return conditional(jsonify({"success": True, "items": items, "total": total, "next_cursor": next_cursor}), etag)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
 # NEW ROUTE TO UPDATE TASK STATUS
 @app.route('/update_task_status', methods=['POST'])
+@read_budget(gets=1, queries=0, commits=1, reads=1, writes=1)
 def update_task_status():
     if 'user_id' not in session or session.get('user_role') != 'patient':
         return jsonify({"success": False, "error": "Unauthorized"}), 403
@@ -776,28 +2240,96 @@ def update_task_status():
     if journey_id is None or task_index is None:
         return jsonify({"success": False, "error": "Missing data"}), 400
 
-    try:
-        journey_ref = db.collection('patient_journeys').document(journey_id)
-        journey_doc = journey_ref.get()
+    return complete_tasks_response(journey_id, [task_index])
 
-        if not journey_doc.exists:
-            return jsonify({"success": False, "error": "Journey not found"}), 404
 
-        # Security check to ensure the user owns this journey
-        journey_data = journey_doc.to_dict()
-        if journey_data.get('patient_uid') != session['user_id']:
-            return jsonify({"success": False, "error": "Forbidden"}), 403
+@app.route('/update_task_status/batch', methods=['POST'])
+@read_budget(gets=1, queries=0, commits=1, reads=1, writes=1)
+def update_task_status_batch():
+    if 'user_id' not in session or session.get('user_role') != 'patient':
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
 
-        tasks = journey_data.get('tasks', [])
-        if 0 <= task_index < len(tasks):
-            tasks[task_index]['status'] = 'completed'
-            journey_ref.update({'tasks': tasks})
-            return jsonify({"success": True, "message": "Task updated"})
-        else:
-            return jsonify({"success": False, "error": "Invalid task index"}), 400
+    data = request.json or {}
+    journey_id = data.get('journey_id')
+    task_indexes = data.get('task_indexes')
 
+    if journey_id is None or not isinstance(task_indexes, list) or not task_indexes:
+        return jsonify({"success": False, "error": "Missing data"}), 400
+
+    return complete_tasks_response(journey_id, task_indexes)
+
+
+def complete_tasks_response(journey_id, task_indexes):
+    if not all(isinstance(index, int) and not isinstance(index, bool) for index in task_indexes):
+        return jsonify({"success": False, "error": "Invalid task index"}), 400
+
+    try:
+        journey_ref = repos.journeys.ref(journey_id)
+        updated = complete_journey_tasks(db.transaction(), journey_ref, session['user_id'], task_indexes)
+        invalidate_fragments(session['user_id'], 'journeys')
+        return jsonify({"success": True, "message": "Task updated", "updated": updated})
+    except LookupError as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    except PermissionError as e:
+        return jsonify({"success": False, "error": str(e)}), 403
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+# --- Application Entry Point ---
+# Servers load the app with get_app(), e.g. `gunicorn "app:get_app()"`. The
+# routes are registered on the module-level `app` at import, so this is not a
+# factory: every call returns that same instance. With WARM_UP=1 it opens the
+# backend connections, once per process, before the worker takes traffic. A
+# master that preloads the app must not warm up itself, since its channels
+# would be rebuilt in every worker anyway: call warm_up() from the server's
+# post-fork hook instead.
+WARM_UP_TEMPLATES = ('base.html', 'home.html', 'dashboard.html', 'therapists.html')
+# An unreachable backend should delay a worker's start, not block it
+WARM_UP_TIMEOUT = float(os.environ.get('WARM_UP_TIMEOUT', 10))
+
+
+def ping_datastore():
+    try:
+        if db:
+            repos.roles.ref('_warm_up').get()
+    except Exception as e:
+        print(f"Warning: Datastore warm-up failed: {e}")
+
+
+def warm_up():
+    """Creates this process' clients and opens the Firestore channel with one lookup."""
+    started = time.perf_counter()
+    razorpay_client.load()
+    auth.load()
+    # A plain thread rather than a pool: pool threads started here would not survive a later fork
+    ping = threading.Thread(target=ping_datastore, name='warm-up', daemon=True)
+    ping.start()
+    ping.join(WARM_UP_TIMEOUT)
+    if ping.is_alive():
+        print(f"Warning: Datastore did not answer within {WARM_UP_TIMEOUT}s, starting anyway.")
+    for name in WARM_UP_TEMPLATES:
+        try:
+            app.jinja_env.get_template(name)
+        except Exception as e:
+            print(f"Warning: Could not precompile template {name}: {e}")
+    print(f"Process {os.getpid()} warmed up in {time.perf_counter() - started:.2f}s")
+
+
+warmed_up_pid = None
+
+
+def get_app(warm=None):
+    """Returns the app singleton, warming this process up first if `warm` (default: WARM_UP=1)."""
+    global warmed_up_pid
+    if warm is None:
+        warm = os.environ.get('WARM_UP') == '1'
+    if warm and warmed_up_pid != os.getpid():
+        warm_up()
+        warmed_up_pid = os.getpid()
+    return app
+
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
\ No newline at end of file
+    get_app().run(debug=True, host='0.0.0.0')
\ No newline at end of file
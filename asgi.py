@@ -0,0 +1,540 @@
+# asgi.py
+"""
+ASGI entry point, serving the same URLs as the WSGI app:
+
+    uvicorn asgi:application --workers 4
+    hypercorn asgi:application --workers 4
+
+The I/O-heavy routes (verify_token, dashboard, get_availability,
+schedule_session_patient, therapists) and the dashboard's live event stream
+run as coroutines on the event loop and
+read Firestore through its AsyncClient, so one worker keeps many of them in
+flight without a thread each, and independent reads are gathered. Every other
+route is handed to the Flask app as it is through a2wsgi's WSGIMiddleware, on
+ASGI_WSGI_THREADS threads (default 32). Both kinds run in
+Flask's request context, so sessions, flash messages, url_for and the
+before/after-request hooks (Server-Timing included) behave the same.
+
+The memory and SQLite datastores have no async client; with them the same
+coroutines run each read on a worker thread.
+"""
+
+import asyncio
+import io
+import os
+import time
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from flask import Response, flash, jsonify, redirect, request, session, url_for
+from google.api_core.exceptions import AlreadyExists
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+import app as app_module
+from clients import lazy_module
+from live import RECONNECT_DELAY_MS
+from repositories import Repositories
+
+firestore = lazy_module('google.cloud.firestore')
+flask_app = app_module.app
+# Event streams wait on the loop here rather than holding a thread each
+flask_app.config['LIVE_UPDATES'] = True
+# Threads for the routes that are still plain Flask views
+WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))
+
+
+# --- Async datastore ---
+
+class AsyncDatastore:
+    """
+    Runs repository reads and commits without blocking the event loop.
+
+    On Firestore, `repos` is built over an AsyncClient, so the repository query
+    methods hand back async queries that are awaited here, and each call is
+    recorded with the instrumentation under the same RPC names as the sync
+    client's. gRPC's asyncio channels belong to the loop that opened them, so
+    one client is kept per event loop. With a local datastore the sync
+    repositories are used and each call runs on a worker thread.
+
+    The app's sync clients (Firebase Admin, the datastore) are built by
+    available() on a worker thread, never on the loop: the lifespan startup
+    calls it, and views check it instead of `app.db`.
+    """
+
+    def __init__(self):
+        self.native = app_module.DATASTORE_BACKEND == 'firestore'
+        self._loop = None
+        self._client = None
+        self._repos = None
+        self._available = None
+
+    async def available(self):
+        """Whether a datastore is configured in this process, building the sync clients first if needed."""
+        if self._available is None or self._available[0] != os.getpid():
+            self._available = (os.getpid(), await asyncio.to_thread(lambda: bool(app_module.db and app_module.repos)))
+        return self._available[1]
+
+    def _connect(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Already built by available() at startup, so this does no I/O
+            firebase_app = app_module.firebase.load()
+            if firebase_app is None:
+                raise RuntimeError("Firebase Admin SDK is not initialized.")
+            self._client = firestore.AsyncClient(project=firebase_app.project_id,
+                                                 credentials=firebase_app.credential.get_credential())
+            self._repos = Repositories(self._client)
+            self._loop = loop
+        return self._client
+
+    @property
+    def repos(self):
+        if not self.native:
+            return app_module.repos
+        self._connect()
+        return self._repos
+
+    def batch(self):
+        return self._connect().batch() if self.native else app_module.db.batch()
+
+    def _record(self, operation, started, reads=0, writes=0):
+        app_module.instrumentation.record('firestore', operation, time.perf_counter() - started, reads, writes)
+
+    async def get(self, ref):
+        if not self.native:
+            return await asyncio.to_thread(ref.get)
+        started = time.perf_counter()
+        doc = await ref.get()
+        self._record('batch_get_documents', started, reads=1)
+        return doc
+
+    async def get_all(self, refs):
+        if not refs:
+            return []
+        if not self.native:
+            return await asyncio.to_thread(lambda: list(app_module.db.get_all(refs)))
+        started = time.perf_counter()
+        docs = [doc async for doc in self._connect().get_all(refs)]
+        self._record('batch_get_documents', started, reads=len(docs))
+        return docs
+
+    async def stream(self, query):
+        if not self.native:
+            return await asyncio.to_thread(lambda: list(query.stream()))
+        started = time.perf_counter()
+        docs = [doc async for doc in query.stream()]
+        # Firestore bills an empty result as one read
+        self._record('run_query', started, reads=max(1, len(docs)))
+        return docs
+
+    async def commit(self, batch):
+        if not self.native:
+            return await asyncio.to_thread(batch.commit)
+        started, writes = time.perf_counter(), len(batch)
+        try:
+            return await batch.commit()
+        finally:
+            self._record('commit', started, writes=writes)
+
+    async def ping(self):
+        await self.get(self.repos.roles.ref('_warm_up'))
+
+
+store = AsyncDatastore()
+
+
+# --- Async reads ---
+# Counterparts of the helpers in app.py of the same names; they share its caches.
+
+async def lookup_profiles(directory, uids):
+    profiles, missing = {}, []
+    for uid in set(uids):
+        if not uid:
+            continue
+        data = app_module.directory_cache.get(directory, uid)
+        if data is not None:
+            profiles[uid] = data
+        else:
+            missing.append(uid)
+
+    repository = store.repos.users if directory == 'patients' else store.repos.practitioners
+    for doc in await store.get_all([repository.ref(uid) for uid in missing]):
+        if doc.exists:
+            profiles[doc.id] = doc.to_dict()
+            app_module.directory_cache.put(directory, doc.id, profiles[doc.id])
+    return profiles
+
+
+async def get_practitioner_map():
+    practitioner_map = app_module.directory_cache.get_listing('practitioners')
+    if practitioner_map is None:
+        docs = await store.stream(store.repos.practitioners.collection)
+        practitioner_map = {doc.id: doc.to_dict() for doc in docs}
+        app_module.directory_cache.set_listing('practitioners', practitioner_map)
+    return practitioner_map
+
+
+async def get_compiled_schedule(practitioner_uid):
+    schedule = app_module.schedule_cache.get(practitioner_uid)
+    if schedule is None:
+        availability_doc, override_docs = await asyncio.gather(
+            store.get(store.repos.availability.ref(practitioner_uid)),
+            store.stream(store.repos.availability_overrides.for_practitioner(practitioner_uid)))
+        schedule = app_module.compile_availability(practitioner_uid, availability_doc, override_docs)
+        app_module.schedule_cache.set(practitioner_uid, schedule)
+    return None if schedule is app_module.NO_SCHEDULE else schedule
+
+
+async def get_booked_slots(practitioner_uid, days):
+    booked_slots = app_module.cached_booked_slots(practitioner_uid, days)
+    if booked_slots is None:
+        query = app_module.upcoming_sessions_query(store.repos, practitioner_uid, days)
+        booked_slots = app_module.collect_booked_slots(await store.stream(query))
+        app_module.booked_cache.set(practitioner_uid, (days, booked_slots))
+    return booked_slots
+
+
+async def resolve_role(uid, decoded_token):
+    role = decoded_token.get('role') or app_module.role_cache.get(uid)
+    if role:
+        return role
+    role_doc = await store.get(store.repos.roles.ref(uid))
+    if role_doc.exists:
+        role = role_doc.to_dict().get('role')
+        app_module.role_cache.set(uid, role)
+        return role
+    # Accounts from before the role index are rare and get written to, so the sync path handles them
+    return await asyncio.to_thread(app_module.resolve_legacy_role, uid, decoded_token)
+
+
+# --- Live updates ---
+
+class AsyncSubscriber:
+    """
+    live.Subscriber for a stream served on the event loop: listener threads
+    hand events to the loop, so an open stream holds no thread.
+    """
+
+    def __init__(self, user_id, maxsize=100):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The loop has closed and the stream with it
+            pass
+
+    def _put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def drain(self, timeout, settle):
+        try:
+            events = [await asyncio.wait_for(self.events.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        await asyncio.sleep(settle)
+        while not self.events.empty():
+            events.append(self.events.get_nowait())
+        return events
+
+
+async def event_stream(hub, subscriber):
+    """LiveUpdates.stream() for an AsyncSubscriber."""
+    # The first subscriber starts the listeners, which may wait on the network
+    await asyncio.to_thread(hub.subscribe, subscriber)
+    try:
+        yield f"retry: {RECONNECT_DELAY_MS}\n\n"
+        deadline = time.monotonic() + hub.lifetime
+        while time.monotonic() < deadline:
+            yield hub.format(subscriber, await subscriber.drain(hub.heartbeat, hub.settle))
+    finally:
+        hub.unsubscribe(subscriber)
+
+
+class StreamingResponse(Response):
+    """A response whose body is an async generator of str, sent by AsgiApp as it is produced."""
+
+    def __init__(self, chunks, **kwargs):
+        super().__init__(**kwargs)
+        self.chunks = chunks
+
+
+# --- Async views ---
+
+async def verify_token():
+    id_token = request.json.get('idToken')
+    if not id_token:
+        return jsonify({"success": False, "error": "No ID token provided."}), 400
+    if not await store.available():
+        return jsonify({"success": False, "error": "Server configuration error."}), 500
+
+    try:
+        # Signature checks are CPU work and the first one fetches Google's keys
+        decoded_token = await asyncio.to_thread(app_module.decode_id_token, id_token)
+        uid = decoded_token['uid']
+        return app_module.start_session(uid, await resolve_role(uid, decoded_token))
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 401
+
+
+async def dashboard():
+    if 'user_id' not in session:
+        return redirect(url_for('signin'))
+
+    user_role, user_id = session.get('user_role'), session.get('user_id')
+
+    if user_role == 'admin':
+        return redirect(url_for('admin_dashboard'))
+
+    user_profile = {}
+    if not await store.available():
+        flash("Database access is currently unavailable.", "error")
+    else:
+        try:
+            profiles = await lookup_profiles(app_module.profile_directory(user_role), [user_id])
+            user_profile = profiles.get(user_id, {})
+        except Exception as e:
+            flash(f"Error fetching user data: {e}", "error")
+    return app_module.render_dashboard(user_role, user_id, user_profile)
+
+
+async def get_availability(practitioner_uid):
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+    days = app_module.requested_days()
+    try:
+        schedule, booked_slots = await asyncio.gather(get_compiled_schedule(practitioner_uid),
+                                                      get_booked_slots(practitioner_uid, days))
+        if schedule is None:
+            return jsonify({"success": True, "slots": {}})
+        return app_module.availability_response(schedule, booked_slots, days)
+    except Exception as e:
+        print(f"Error in get_availability for {practitioner_uid}: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+async def legacy_booking_exists(practitioner_uid, slot_datetime):
+    """app.legacy_booking_exists() through the async client."""
+    if not app_module.reservations_backfilled:
+        marker = await store.get(store.repos.slot_reservations.ref(app_module.RESERVATION_BACKFILL_MARKER))
+        app_module.reservations_backfilled = marker.exists
+    if app_module.reservations_backfilled:
+        return False
+    return app_module.slot_taken(await store.stream(
+        app_module.legacy_slot_query(store.repos, practitioner_uid, slot_datetime)))
+
+
+async def schedule_session_patient():
+    if 'user_id' not in session or session.get('user_role') != 'patient':
+        return redirect(url_for('signin'))
+    if not await store.available():
+        flash('Database is not available.', 'error')
+        return redirect(url_for('dashboard'))
+    try:
+        practitioner_uid, therapy_type, session_datetime_obj = app_module.parse_booking_form()
+        practitioner_data = (await lookup_profiles('practitioners', [practitioner_uid])).get(practitioner_uid)
+        if not practitioner_data:
+            flash('Practitioner not found.', 'error')
+            return redirect(url_for('dashboard'))
+
+        refs = app_module.slot_availability_refs(store.repos, practitioner_uid, session_datetime_obj)
+        if not app_module.slot_offered(refs, await store.get_all(refs), session_datetime_obj):
+            return app_module.slot_not_offered(practitioner_uid)
+        if await legacy_booking_exists(practitioner_uid, session_datetime_obj):
+            raise AlreadyExists("Slot held by a session without a reservation")
+        batch = store.batch()
+        app_module.add_booking_writes(store.repos, batch, practitioner_uid, practitioner_data,
+                                      therapy_type, session_datetime_obj)
+        await store.commit(batch)
+        return app_module.booking_requested(practitioner_uid)
+    except AlreadyExists:
+        flash('This time slot has just been booked. Please select another time.', 'error')
+        return redirect(url_for('dashboard'))
+    except Exception as e:
+        flash(f"An error occurred: {str(e)}", 'error')
+        return redirect(url_for('dashboard'))
+
+
+async def therapists():
+    if not await store.available():
+        return "Database is not available.", 500
+    try:
+        return app_module.therapists_response(await get_practitioner_map())
+    except Exception as e:
+        return f"An error occurred: {str(e)}", 500
+
+
+async def dashboard_events():
+    if 'user_id' not in session:
+        return "Unauthorized", 403
+    if not await store.available():
+        return "Database access is currently unavailable.", 503
+    subscriber = AsyncSubscriber(session['user_id'])
+    return StreamingResponse(event_stream(app_module.live_updates, subscriber), mimetype='text/event-stream',
+                             headers=app_module.event_stream_headers())
+
+
+# {endpoint: coroutine view}; the URL rules themselves stay in app.py
+ASYNC_VIEWS = {
+    'verify_token': verify_token,
+    'dashboard': dashboard,
+    'dashboard_events': dashboard_events,
+    'get_availability': get_availability,
+    'schedule_session_patient': schedule_session_patient,
+    'therapists': therapists,
+}
+
+
+# --- ASGI adapter ---
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return bytes(body)
+
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class AsgiApp:
+    """
+    Routes each request by the Flask URL map: endpoints in `async_views` are
+    awaited on the loop in a Flask request context; everything else goes to
+    the Flask app through a2wsgi's WSGIMiddleware, on its thread pool.
+    """
+
+    def __init__(self, flask_app, async_views, wsgi_threads):
+        self.flask_app = flask_app
+        self.async_views = async_views
+        self.wsgi = WSGIMiddleware(flask_app, workers=wsgi_threads)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            # No websocket routes; the middleware closes them
+            return await self.wsgi(scope, receive, send)
+
+        # Matching needs only the method, path and host; the body is left for whoever handles the request
+        view = self.async_views.get(self.match_endpoint(build_environ(scope, io.BytesIO())))
+        if view is None:
+            return await self.wsgi(scope, receive, send)
+
+        body = await read_body(receive)
+        environ = build_environ(scope, io.BytesIO(body))
+        # The body is already whole, chunked uploads included
+        environ['CONTENT_LENGTH'] = str(len(body))
+        response = await self.dispatch(view, environ)
+        if isinstance(response, StreamingResponse):
+            return await self.stream(response, receive, send)
+        # Werkzeug's own finishing (HEAD, 304 bodies, Content-Length), as when Flask serves it
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        try:
+            body = b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': encode_headers(headers),
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def stream(self, response, receive, send):
+        """Sends a StreamingResponse as it is produced, until it ends or the client goes away."""
+        async def pump():
+            await send({'type': 'http.response.start', 'status': response.status_code,
+                        'headers': encode_headers(response.headers.to_wsgi_list())})
+            async for chunk in response.chunks:
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        pumping = asyncio.ensure_future(pump())
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            done, _ = await asyncio.wait({pumping, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if pumping in done:
+                pumping.result()
+        finally:
+            # Cancelling the pump runs the stream's cleanup, which unsubscribes it
+            for task in (pumping, disconnected):
+                task.cancel()
+            await asyncio.gather(pumping, disconnected, return_exceptions=True)
+            await response.chunks.aclose()
+
+    def match_endpoint(self, environ):
+        try:
+            endpoint, _ = self.flask_app.url_map.bind_to_environ(environ).match()
+            return endpoint
+        except (HTTPException, RequestRedirect):
+            # 404s, 405s and slash redirects are left to Flask
+            return None
+
+    async def dispatch(self, view, environ):
+        """Flask's wsgi_app / full_dispatch_request, with the view awaited instead of called."""
+        flask = self.flask_app
+        ctx = flask.request_context(environ)
+        error = None
+        try:
+            try:
+                ctx.push()
+                try:
+                    rv = flask.preprocess_request()
+                    if rv is None:
+                        rv = await view(**request.view_args)
+                except Exception as e:
+                    rv = flask.handle_user_exception(e)
+                return flask.finalize_request(rv)
+            except Exception as e:
+                error = e
+                return flask.handle_exception(e)
+        finally:
+            ctx.pop(error)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    # Builds the sync clients off the loop, warming them up when WARM_UP=1
+                    await store.available()
+                    await asyncio.to_thread(app_module.get_app)
+                    if os.environ.get('WARM_UP') == '1' and store.native:
+                        await self.warm_up()
+                    await send({'type': 'lifespan.startup.complete'})
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+            elif message['type'] == 'lifespan.shutdown':
+                self.wsgi.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def warm_up(self):
+        try:
+            await asyncio.wait_for(store.ping(), app_module.WARM_UP_TIMEOUT)
+        except Exception as e:
+            print(f"Warning: Async datastore warm-up failed: {e!r}")
+
+
+application = AsgiApp(flask_app, ASYNC_VIEWS, WSGI_THREADS)
@@ -0,0 +1,146 @@
+# assets.py
+
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import abort, request, send_from_directory, url_for
+from markupsafe import Markup, escape
+from werkzeug.security import safe_join
+
+# Fingerprinted files never change under the same name, so browsers and CDNs may keep them for a year
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Precompressed copies tried in this order, as (Content-Encoding, file suffix)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# <source> elements are emitted for these, best first; the <img> fallback keeps the original format
+MODERN_FORMATS = ('image/avif', 'image/webp')
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class AssetManifest:
+    """
+    Serves the output of build_assets.py: content-hashed copies of everything
+    under static/, resized AVIF/WebP/JPEG variants of the images and gzip /
+    brotli copies of text assets, all described by static/dist/manifest.json.
+
+    Templates use asset_url('style.css') for a fingerprinted URL and
+    responsive_image('images/x.jpg', alt, sizes=...) for a <picture> with a
+    srcset per format. Without a build (local development) both fall back to
+    the plain /static URLs, so nothing breaks before build_assets.py has run.
+    """
+
+    def __init__(self, url_prefix='/assets'):
+        self.url_prefix = url_prefix
+        self.dist_folder = None
+        self.entries = {}
+        # Fingerprint of the manifest, '' without a build; pages linking assets include it in their ETags
+        self.version = ''
+        self._mtime = None
+        self._auto_reload = False
+
+    def init_app(self, app):
+        self.dist_folder = os.path.join(app.static_folder, 'dist')
+        self._auto_reload = app.debug
+        self.load()
+        app.add_url_rule(f'{self.url_prefix}/<path:filename>', 'assets', self.serve)
+        app.jinja_env.globals.update(asset_url=self.url, responsive_image=self.picture)
+
+    # --- Manifest ---
+
+    def load(self):
+        path = os.path.join(self.dist_folder, MANIFEST_NAME)
+        try:
+            mtime = os.path.getmtime(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.entries = json.loads(data)
+            self.version = hashlib.sha256(data).hexdigest()[:10]
+            self._mtime = mtime
+        except FileNotFoundError:
+            self.entries, self.version, self._mtime = {}, '', None
+        except Exception as e:
+            print(f"Error loading asset manifest {path}: {e}")
+            self.entries, self.version, self._mtime = {}, '', None
+
+    def entry(self, filename):
+        if self._auto_reload:
+            # Pick up a rebuild without restarting the dev server
+            path = os.path.join(self.dist_folder, MANIFEST_NAME)
+            mtime = os.path.getmtime(path) if os.path.exists(path) else None
+            if mtime != self._mtime:
+                self.load()
+        return self.entries.get(filename)
+
+    # --- Template helpers ---
+
+    def url(self, filename):
+        """Fingerprinted URL of a static file, or its /static URL when it has not been built."""
+        entry = self.entry(filename)
+        if entry is None:
+            return url_for('static', filename=filename)
+        return f"{self.url_prefix}/{entry['file']}"
+
+    def srcset(self, variants):
+        return ', '.join(f"{self.url_prefix}/{file} {width}w" for file, width in variants)
+
+    def picture(self, filename, alt, sizes='100vw', css_class=None, lazy=True):
+        """
+        <picture> for an image: one <source> per modern format and an <img> in
+        the original format, each with a width-descriptor srcset so phones
+        download a small rendition. Width and height are set from the source
+        image so the page does not shift while it loads. Images above the fold
+        should pass lazy=False.
+        """
+        entry = self.entry(filename)
+        attributes = [f'alt="{escape(alt)}"']
+        if css_class:
+            attributes.append(f'class="{escape(css_class)}"')
+        if lazy:
+            attributes.append('loading="lazy" decoding="async"')
+        else:
+            attributes.append('fetchpriority="high"')
+
+        if entry is None or not entry.get('variants'):
+            return Markup(f'<img src="{escape(self.url(filename))}" {" ".join(attributes)}>')
+
+        variants = entry['variants']
+        sizes = escape(sizes)
+        sources = [f'<source type="{media_type}" srcset="{self.srcset(variants[media_type])}" sizes="{sizes}">'
+                   for media_type in MODERN_FORMATS if variants.get(media_type)]
+        fallback = variants[entry['type']]
+        # Largest fallback rendition is the src for browsers without srcset support
+        img = (f'<img src="{self.url_prefix}/{fallback[-1][0]}" srcset="{self.srcset(fallback)}" sizes="{sizes}" '
+               f'width="{entry["width"]}" height="{entry["height"]}" {" ".join(attributes)}>')
+        return Markup('<picture>' + ''.join(sources) + img + '</picture>')
+
+    # --- Serving ---
+
+    def serve(self, filename):
+        """
+        Serves a built file with immutable cache headers, swapping in its
+        brotli or gzip copy when the client accepts one.
+        """
+        if not self.dist_folder or filename == MANIFEST_NAME:
+            abort(404)
+        path = safe_join(self.dist_folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+
+        encoding = None
+        for candidate, suffix in ENCODINGS:
+            if request.accept_encodings[candidate] and os.path.isfile(path + suffix):
+                encoding = candidate
+                filename += suffix
+                break
+
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        response = send_from_directory(self.dist_folder, filename, mimetype=mimetype, max_age=31536000)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
@@ -0,0 +1,378 @@
+# benchmark.py
+"""
+Route-level load test. Seeds a local datastore with synthetic data, drives
+concurrent scripted users through the Flask app with its test client and
+reports throughput, latency percentiles and backend calls per route.
+
+    python benchmark.py --scale medium --concurrency 16 --requests 2000
+    python benchmark.py --backend sqlite --output results/today.json
+    python benchmark.py --compare results/before.json --output results/after.json
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+SCALES = {
+    'small': dict(practitioners=20, patients=200, sessions_per_patient=3, feedback_per_practitioner=10, notifications_per_user=5),
+    'medium': dict(practitioners=100, patients=2000, sessions_per_patient=5, feedback_per_practitioner=30, notifications_per_user=10),
+    'large': dict(practitioners=500, patients=20000, sessions_per_patient=8, feedback_per_practitioner=60, notifications_per_user=20),
+}
+
+THERAPIES = ['Virechana', 'Nasya', 'Basti', 'Vamana', 'Raktamokshana']
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday']
+CALL_KINDS = ['reads', 'writes', 'get', 'get_all', 'query', 'count', 'commit']
+
+# Firestore accepts at most 500 writes per batch
+SEED_BATCH_SIZE = 500
+
+
+# --- Seeding ---
+
+class BatchWriter:
+    def __init__(self, db):
+        self.db = db
+        self.batch = db.batch()
+        self.pending = 0
+
+    def set(self, ref, data):
+        self.batch.set(ref, data)
+        self.pending += 1
+        if self.pending == SEED_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.batch.commit()
+            self.batch, self.pending = self.db.batch(), 0
+
+
+def seed(repos, rng, practitioners, patients, sessions_per_patient, feedback_per_practitioner, notifications_per_user):
+    """Writes the synthetic data set and returns (practitioner_uids, patient_uids)."""
+    writer = BatchWriter(repos.client)
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    practitioner_uids = [f'bench-pr-{i}' for i in range(practitioners)]
+    patient_uids = [f'bench-pa-{i}' for i in range(patients)]
+
+    for i, uid in enumerate(practitioner_uids):
+        writer.set(repos.practitioners.ref(uid), {
+            'name': f'Practitioner {i}', 'email': f'{uid}@example.com', 'number': f'90000{i:05d}',
+            'role': 'practitioner', 'created_at': now,
+            'verification_status': 'Verified' if rng.random() < 0.8 else 'Pending Review',
+            'specialties': rng.sample(THERAPIES, rng.randint(1, 3)),
+            'address': rng.choice(['Pune', 'Mumbai', 'Delhi', 'Bengaluru', 'Kochi']),
+            'contact': {'phone': f'90000{i:05d}', 'email': f'{uid}@example.com'},
+            'appointment_price': rng.choice([300, 500, 800, 1200]), 'session_price': rng.choice([1000, 1500, 2500]),
+        })
+        start = rng.choice([8, 9, 10])
+        writer.set(repos.availability.ref(uid), {
+            'recurring': {
+                day: {'start': f'{start:02d}:00', 'end': f'{start + 8:02d}:00', 'interval': rng.choice(['30', '60'])}
+                for day in rng.sample(WEEKDAYS, rng.randint(3, 6))
+            },
+        })
+        # A few days with custom hours, one document per date
+        for day in rng.sample(range(1, 30), rng.randint(0, 3)):
+            date_str = (now + timedelta(days=day)).strftime('%Y-%m-%d')
+            writer.set(repos.availability_overrides.ref_for(uid, date_str), {
+                'practitioner_uid': uid, 'date': date_str, 'updated_at': now,
+                'times': sorted(rng.sample(['09:00', '10:00', '11:00', '14:00', '15:00', '16:00'], 3)),
+            })
+        writer.set(repos.roles.ref(uid), {'role': 'practitioner', 'updated_at': now})
+
+    for i, uid in enumerate(patient_uids):
+        writer.set(repos.users.ref(uid), {
+            'name': f'Patient {i}', 'email': f'{uid}@example.com', 'number': f'80000{i:05d}',
+            'role': 'patient', 'created_at': now,
+        })
+        writer.set(repos.roles.ref(uid), {'role': 'patient', 'updated_at': now})
+        for _ in range(sessions_per_patient):
+            practitioner_uid = rng.choice(practitioner_uids)
+            date = now + timedelta(days=rng.randint(-60, 30), hours=rng.randint(0, 8))
+            writer.set(repos.sessions.ref(), {
+                'patient_uid': uid, 'practitioner_uid': practitioner_uid, 'therapy': rng.choice(THERAPIES),
+                'date': date, 'status': rng.choice(['scheduled', 'payment_pending', 'completed', 'cancelled']),
+                'appointment_price': 500, 'session_price': 1500, 'amount_due': 500, 'created_at': date - timedelta(days=2),
+            })
+
+    for uid in practitioner_uids:
+        for _ in range(feedback_per_practitioner):
+            writer.set(repos.feedback.ref(), {
+                'patient_uid': rng.choice(patient_uids), 'practitioner_uid': uid,
+                'feedback_text': 'Felt much better after the session.', 'rating': rng.randint(3, 5),
+                'created_at': now - timedelta(days=rng.randint(0, 90)),
+            })
+
+    for uid in practitioner_uids + patient_uids:
+        for j in range(notifications_per_user):
+            writer.set(repos.notifications.ref(), {
+                'recipient_id': uid, 'message': f'Notification {j}', 'type': 'info', 'read': rng.random() < 0.5,
+                'created_at': now - timedelta(hours=rng.randint(0, 24 * 30)),
+            })
+
+    writer.flush()
+    return practitioner_uids, patient_uids
+
+
+# --- Scenarios ---
+
+def login(app, uid, role):
+    client = app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = uid
+        flask_session['user_role'] = role
+    return client
+
+
+def load_dashboard(client, first_tab):
+    """The dashboard shell plus the fragments the browser fetches straight away."""
+    responses = [client.get('/dashboard'), client.get('/dashboard/fragments/stats'),
+                 client.get(f'/dashboard/fragments/{first_tab}')]
+    return max(responses, key=lambda response: response.status_code)
+
+
+def patient_dashboard(env, rng):
+    return 'GET /dashboard (patient)', load_dashboard(env.patient_client(rng), 'sessions')
+
+
+def practitioner_dashboard(env, rng):
+    return 'GET /dashboard (practitioner)', load_dashboard(env.practitioner_client(rng), 'upcoming-sessions')
+
+
+def get_availability(env, rng):
+    uid = rng.choice(env.practitioner_uids)
+    return 'GET /get_availability/<uid>', env.patient_client(rng).get(f'/get_availability/{uid}')
+
+
+def therapists(env, rng):
+    return 'GET /therapists', env.patient_client(rng).get('/therapists')
+
+
+def therapist_search(env, rng):
+    query = f'specialty={rng.choice(THERAPIES)}&verified=1&max_appointment_price={rng.choice([500, 800, 1200])}'
+    return 'GET /therapists?<filters>', env.patient_client(rng).get(f'/therapists?{query}')
+
+
+def schedule_session(env, rng):
+    # Random future slots; some land on taken or unavailable times, as real traffic does
+    day = datetime.now(timezone.utc).date() + timedelta(days=rng.randint(1, 30))
+    form = {
+        'therapist-uid': rng.choice(env.practitioner_uids), 'therapy-type': rng.choice(THERAPIES),
+        'session-date': day.isoformat(), 'session-time': f'{rng.randint(9, 16):02d}:00',
+    }
+    return 'POST /schedule_session_patient', env.patient_client(rng).post('/schedule_session_patient', data=form)
+
+
+# (scenario, weight) pairs: a patient-heavy mix of reads with some bookings
+SCENARIOS = [
+    (patient_dashboard, 30),
+    (practitioner_dashboard, 15),
+    (get_availability, 30),
+    (therapists, 10),
+    (therapist_search, 5),
+    (schedule_session, 10),
+]
+
+
+class Environment:
+    def __init__(self, app_module, practitioner_uids, patient_uids):
+        self.app_module = app_module
+        self.practitioner_uids = practitioner_uids
+        self.patient_uids = patient_uids
+
+    def patient_client(self, rng):
+        return login(self.app_module.app, rng.choice(self.patient_uids), 'patient')
+
+    def practitioner_client(self, rng):
+        return login(self.app_module.app, rng.choice(self.practitioner_uids), 'practitioner')
+
+    def settle(self):
+        """Waits for background notification and job work so its calls are counted."""
+        self.app_module.notification_outbox.flush()
+        self.app_module.job_queue.flush()
+
+
+# --- Measurement ---
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure_calls(env, db, scenarios, repeats, rng):
+    """
+    Runs each scenario on its own, one request at a time, and returns the
+    average backend calls per request. Concurrent runs cannot attribute
+    calls to routes, so this pass does it separately.
+    """
+    per_route = {}
+    for scenario, _ in scenarios:
+        totals = defaultdict(int)
+        route = None
+        for _ in range(repeats):
+            env.settle()
+            before = db.snapshot_calls()
+            route, _response = scenario(env, rng)
+            env.settle()
+            after = db.snapshot_calls()
+            for kind in CALL_KINDS:
+                totals[kind] += after[kind] - before[kind]
+        per_route[route] = {kind: totals[kind] / repeats for kind in CALL_KINDS}
+    return per_route
+
+
+def run_load(env, scenarios, concurrency, total_requests, seed_value):
+    """Drives `total_requests` weighted scenario runs across `concurrency` threads."""
+    rng = random.Random(seed_value)
+    functions, weights = zip(*scenarios)
+    plan = rng.choices(functions, weights=weights, k=total_requests)
+    results = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    def worker(worker_id, jobs):
+        worker_rng = random.Random(seed_value * 1000 + worker_id)
+        for scenario in jobs:
+            started = time.perf_counter()
+            route, response = scenario(env, worker_rng)
+            elapsed = time.perf_counter() - started
+            with lock:
+                results[route].append(elapsed)
+                if response.status_code >= 500:
+                    errors[route] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for worker_id in range(concurrency):
+            executor.submit(worker, worker_id, plan[worker_id::concurrency])
+    wall_time = time.perf_counter() - started
+    return results, errors, wall_time
+
+
+def summarize(results, errors, wall_time, calls):
+    routes = {}
+    for route, latencies in sorted(results.items()):
+        latencies = sorted(latencies)
+        routes[route] = {
+            'requests': len(latencies),
+            'errors': errors.get(route, 0),
+            'throughput_rps': len(latencies) / wall_time if wall_time else 0.0,
+            'mean_ms': statistics.fmean(latencies) * 1000,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'calls_per_request': calls.get(route, {}),
+        }
+    total = sum(len(latencies) for latencies in results.values())
+    return {'total_requests': total, 'wall_time_s': wall_time,
+            'throughput_rps': total / wall_time if wall_time else 0.0, 'routes': routes}
+
+
+# --- Reporting ---
+
+def print_report(summary, baseline=None):
+    header = f"{'route':<34}{'reqs':>7}{'err':>5}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'reads/req':>11}{'calls/req':>11}"
+    print(header)
+    print('-' * len(header))
+    for route, stats in summary['routes'].items():
+        calls = stats['calls_per_request']
+        backend_calls = sum(calls.get(kind, 0) for kind in ('get', 'get_all', 'query', 'count', 'commit'))
+        print(f"{route:<34}{stats['requests']:>7}{stats['errors']:>5}{stats['throughput_rps']:>9.1f}"
+              f"{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}"
+              f"{calls.get('reads', 0):>11.1f}{backend_calls:>11.1f}")
+        if baseline and route in baseline['routes']:
+            before = baseline['routes'][route]
+            before_reads = before['calls_per_request'].get('reads', 0)
+            print(f"{'  vs baseline':<34}{'':>7}{'':>5}{change(before['throughput_rps'], stats['throughput_rps']):>9}"
+                  f"{change(before['p50_ms'], stats['p50_ms']):>9}{change(before['p95_ms'], stats['p95_ms']):>9}"
+                  f"{change(before['p99_ms'], stats['p99_ms']):>9}{change(before_reads, calls.get('reads', 0)):>11}")
+    print('-' * len(header))
+    print(f"{summary['total_requests']} requests in {summary['wall_time_s']:.2f}s, {summary['throughput_rps']:.1f} req/s")
+
+
+def change(before, after):
+    if not before:
+        return 'n/a'
+    return f"{(after - before) / before * 100:+.0f}%"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--practitioners', type=int, help='overrides the scale preset')
+    parser.add_argument('--patients', type=int, help='overrides the scale preset')
+    parser.add_argument('--sessions-per-patient', type=int, help='overrides the scale preset')
+    parser.add_argument('--backend', choices=['memory', 'sqlite'], default='memory')
+    parser.add_argument('--sqlite-path', default='benchmark.db')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--calibration-repeats', type=int, default=5,
+                        help='single-request runs per route used to count backend calls')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the results as JSON to this path')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    volumes = dict(SCALES[args.scale])
+    for key in ('practitioners', 'patients', 'sessions_per_patient'):
+        if getattr(args, key) is not None:
+            volumes[key] = getattr(args, key)
+
+    # The app picks its backends at import time
+    os.environ['DATASTORE_BACKEND'] = args.backend
+    os.environ['DATASTORE_SQLITE_PATH'] = args.sqlite_path
+    os.environ.setdefault('RAZORPAY_CLIENT', 'fake')
+    os.environ.setdefault('NOTIFICATION_SMS_SENDER', 'memory')
+    os.environ.setdefault('NOTIFICATION_EMAIL_SENDER', 'memory')
+    if args.backend == 'sqlite' and os.path.exists(args.sqlite_path):
+        os.remove(args.sqlite_path)
+    import app as app_module
+
+    rng = random.Random(args.seed)
+    print(f"Seeding {args.backend} datastore: {volumes}")
+    started = time.perf_counter()
+    practitioner_uids, patient_uids = seed(app_module.repos, rng, **volumes)
+    # As after the migrations, so requests skip their fallbacks for data written before them
+    app_module.backfill_slot_reservations()
+    app_module.backfill_practitioner_stats()
+    print(f"Seeded in {time.perf_counter() - started:.1f}s")
+
+    env = Environment(app_module, practitioner_uids, patient_uids)
+    calls = measure_calls(env, app_module.db, SCENARIOS, args.calibration_repeats, rng)
+    results, errors, wall_time = run_load(env, SCENARIOS, args.concurrency, args.requests, args.seed)
+    env.settle()
+
+    summary = summarize(results, errors, wall_time, calls)
+    summary['config'] = {'scale': args.scale, 'volumes': volumes, 'backend': args.backend,
+                         'concurrency': args.concurrency, 'requests': args.requests, 'seed': args.seed,
+                         'started_at': datetime.now(timezone.utc).isoformat()}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(summary, baseline)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        print(f"Results written to {args.output}")
+    return 0 if not any(errors.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# budgets.py
+
+import os
+import traceback
+
+# Datastore call kinds grouped the way budgets are written
+GET_KINDS = ('get', 'get_all')
+QUERY_KINDS = ('query', 'count')
+LIMITS = ('gets', 'queries', 'commits', 'reads', 'writes')
+
+# Frames from these files are skipped when reporting where a call was made
+_INTERNAL_FILES = ('datastore.py', 'budgets.py', 'instrumentation.py', 'repositories.py', 'threading.py')
+
+# {endpoint: Budget}, filled in by @read_budget
+ROUTE_BUDGETS = {}
+
+
+class Budget:
+    """
+    The most datastore work one request to a route may do, counted the way
+    Firestore bills it: `gets` document lookups (get / get_all calls),
+    `queries` queries and aggregations, `commits` write batches, and `reads` /
+    `writes` documents read and written. Limits left as None are not checked.
+    """
+
+    def __init__(self, gets=None, queries=None, commits=None, reads=None, writes=None):
+        self.gets = gets
+        self.queries = queries
+        self.commits = commits
+        self.reads = reads
+        self.writes = writes
+
+    def violations(self, usage):
+        """Returns a message for every limit the usage exceeds."""
+        return [f"{limit}: {usage[limit]} > {getattr(self, limit)}"
+                for limit in LIMITS
+                if getattr(self, limit) is not None and usage[limit] > getattr(self, limit)]
+
+    def __repr__(self):
+        limits = ', '.join(f"{limit}={getattr(self, limit)}" for limit in LIMITS if getattr(self, limit) is not None)
+        return f"Budget({limits})"
+
+
+def read_budget(**limits):
+    """
+    Declares the datastore budget for a view; put it under @app.route. The
+    view itself is returned unchanged, so the budget costs nothing at request
+    time. check_budgets.py runs each budgeted route against seeded data and
+    fails when one goes over.
+    """
+    def decorator(view):
+        ROUTE_BUDGETS[view.__name__] = Budget(**limits)
+        return view
+    return decorator
+
+
+def declare_budget(name, **limits):
+    """
+    Declares a budget for part of a route checked on its own, named
+    'endpoint:part' (one dashboard fragment, say), where a single budget
+    for the whole route would have to allow for its most expensive part.
+    """
+    ROUTE_BUDGETS[name] = Budget(**limits)
+
+
+def call_site(stack):
+    """The innermost frame outside the datastore layer, as 'file:line in function'."""
+    for frame in reversed(stack):
+        if os.path.basename(frame.filename) not in _INTERNAL_FILES:
+            return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+    return '?'
+
+
+class CallTrace:
+    """
+    Datastore listener that records each call with the place it was made from.
+    Attach it with client.listeners.append(trace) and read usage() afterwards.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, kind, collection_path, reads, writes, seconds):
+        self.calls.append((kind, collection_path, reads, writes, call_site(traceback.extract_stack()[:-1])))
+
+    def clear(self):
+        self.calls = []
+
+    def usage(self):
+        return {
+            'gets': sum(1 for call in self.calls if call[0] in GET_KINDS),
+            'queries': sum(1 for call in self.calls if call[0] in QUERY_KINDS),
+            'commits': sum(1 for call in self.calls if call[0] == 'commit'),
+            'reads': sum(call[2] for call in self.calls),
+            'writes': sum(call[3] for call in self.calls),
+        }
+
+    def format(self):
+        return '\n'.join(f"{kind:<8} {collection_path:<28} reads={reads:<5} writes={writes:<4} {site}"
+                         for kind, collection_path, reads, writes, site in self.calls)
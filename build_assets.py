@@ -0,0 +1,215 @@
+# build_assets.py
+"""
+Builds static/dist, which assets.py serves under /assets: a content-hashed
+copy of every file in static/, resized AVIF / WebP / original-format
+renditions of each JPEG and PNG, gzip and brotli copies of text assets, and
+manifest.json tying the original names to the built ones. Run it as part of
+every deploy; the app picks the manifest up at startup.
+
+    python build_assets.py
+    python build_assets.py --static path/to/static --widths 320,640,1280
+
+Image renditions need Pillow (AVIF also needs a Pillow built with libavif,
+otherwise only WebP is made) and brotli copies need the brotli package.
+Whatever is missing is reported and skipped; the hashed copies and gzip are
+always built.
+"""
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from assets import MANIFEST_NAME
+
+# Rendition widths in pixels; an image is never enlarged, its own width is the largest rendition
+DEFAULT_WIDTHS = (160, 320, 640, 960, 1280, 1920)
+
+IMAGE_TYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png'}
+
+# media type: (Pillow format, extension, save options)
+IMAGE_FORMATS = {
+    'image/avif': ('AVIF', '.avif', dict(quality=50, speed=6)),
+    'image/webp': ('WEBP', '.webp', dict(quality=75, method=6)),
+    'image/jpeg': ('JPEG', '.jpg', dict(quality=80, optimize=True, progressive=True)),
+    'image/png': ('PNG', '.png', dict(optimize=True)),
+}
+
+# Text assets worth precompressing; images are already compressed
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.map')
+
+HASH_LENGTH = 10
+
+
+# --- Writing ---
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def hashed_name(relative, data, ext=None, label=''):
+    """'images/logo.png' -> 'images/logo-160w.<hash>.webp' for label='-160w', ext='.webp'."""
+    stem, original_ext = os.path.splitext(relative)
+    return f"{stem}{label}.{fingerprint(data)}{ext or original_ext}".replace(os.sep, '/')
+
+
+def write(dist, name, data):
+    path = os.path.join(dist, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def precompress(dist, name, data):
+    """Writes name.gz and name.br beside the file when they come out smaller."""
+    written = []
+    # mtime=0 keeps the output byte-for-byte reproducible between builds
+    compressed = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        compressed.append(('.br', brotli.compress(data, quality=11)))
+    for suffix, payload in compressed:
+        if len(payload) < len(data):
+            write(dist, name + suffix, payload)
+            written.append((suffix, len(payload)))
+    return written
+
+
+# --- Images ---
+
+def image_formats():
+    formats = ['image/webp']
+    try:
+        if features.check('avif'):
+            formats.insert(0, 'image/avif')
+    except Exception:
+        pass
+    return formats
+
+
+def encode(image, media_type):
+    pillow_format, _, options = IMAGE_FORMATS[media_type]
+    if pillow_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, pillow_format, **options)
+    return buffer.getvalue()
+
+
+def build_image(dist, relative, data, media_type, widths, formats):
+    """Resizes one image to each width in each format; returns its manifest fields."""
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+
+    targets = [width for width in widths if width < image.width]
+    if image.width <= max(widths):
+        targets.append(image.width)
+
+    variants = {}
+    for target in targets:
+        height = round(image.height * target / image.width)
+        resized = image if target == image.width else image.resize((target, height), Image.LANCZOS)
+        for variant_type in formats + [media_type]:
+            encoded = encode(resized, variant_type)
+            name = hashed_name(relative, encoded, IMAGE_FORMATS[variant_type][1], f'-{target}w')
+            write(dist, name, encoded)
+            variants.setdefault(variant_type, []).append((name, target, len(encoded)))
+
+    return {
+        'type': media_type,
+        'width': image.width,
+        'height': image.height,
+        'variants': {variant_type: [[name, width] for name, width, _ in renditions]
+                     for variant_type, renditions in variants.items()},
+    }, variants
+
+
+# --- Build ---
+
+def static_files(static):
+    for root, dirs, files in os.walk(static):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and os.path.join(root, d) != os.path.join(static, 'dist'))
+        for filename in sorted(files):
+            if not filename.startswith('.'):
+                path = os.path.join(root, filename)
+                yield path, os.path.relpath(path, static).replace(os.sep, '/')
+
+
+def build(static, widths):
+    dist = os.path.join(static, 'dist')
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    os.makedirs(dist)
+
+    make_images = Image is not None
+    formats = image_formats() if make_images else []
+    if not make_images:
+        print("Pillow is not installed: images are fingerprinted but not resized")
+    if brotli is None:
+        print("brotli is not installed: only gzip copies are written")
+
+    manifest = {}
+    for path, relative in static_files(static):
+        with open(path, 'rb') as f:
+            data = f.read()
+        name = hashed_name(relative, data)
+        write(dist, name, data)
+        entry = {'file': name}
+        ext = os.path.splitext(relative)[1].lower()
+
+        if ext in COMPRESSIBLE:
+            compressed = precompress(dist, name, data)
+            sizes = ', '.join(f"{suffix} {size:,} B" for suffix, size in compressed)
+            print(f"{relative:<40} {len(data):>10,} B  ->  {sizes or 'not compressible'}")
+        elif ext in IMAGE_TYPES and make_images:
+            try:
+                fields, variants = build_image(dist, relative, data, IMAGE_TYPES[ext], widths, formats)
+                entry.update(fields)
+                sizes = ', '.join(f"{variant_type.split('/')[1]} {renditions[0][2]:,}-{renditions[-1][2]:,} B"
+                                  for variant_type, renditions in variants.items())
+                print(f"{relative:<40} {len(data):>10,} B  ->  {sizes}")
+            except Exception as e:
+                print(f"Error resizing {relative}, serving it unresized: {e}")
+        manifest[relative] = entry
+
+    with open(os.path.join(dist, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(f"Built {len(manifest)} assets into {dist}")
+    return manifest
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--static', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'),
+                        help='static folder to build from; output goes to its dist/ subfolder')
+    parser.add_argument('--widths', default=','.join(str(width) for width in DEFAULT_WIDTHS),
+                        help='comma-separated rendition widths in pixels')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.isdir(args.static):
+        print(f"No static folder at {args.static}")
+        return 1
+    widths = sorted(int(width) for width in args.widths.split(',') if width.strip())
+    build(args.static, widths)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
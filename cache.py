@@ -0,0 +1,205 @@
+# cache.py
+
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A small thread-safe in-process cache with per-entry expiry and LRU eviction.
+    Values are kept for `ttl` seconds; once `maxsize` entries are stored the
+    least recently used one is dropped to make room.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+def _apply_fields(data, fields):
+    # Mirrors Firestore's update() semantics for dotted field paths
+    for path, value in fields.items():
+        target = data
+        parts = path.split('.')
+        for part in parts[:-1]:
+            if not isinstance(target.get(part), dict):
+                target[part] = {}
+            target = target[part]
+        target[parts[-1]] = value
+
+
+class DirectoryCache:
+    """
+    Write-through cache of the practitioner and patient directories.
+
+    Each directory ('practitioners', 'patients') is cached both as a full
+    listing {uid: profile} and as individual profile entries, so the dashboard
+    can render name lookups without streaming the collections again. Routes that
+    change a profile call put()/update() with the data they just wrote, which
+    keeps the cached copies in sync without another read.
+
+    listing_version() fingerprints a cached listing for use in ETags. It only
+    changes when the content does, including across workers and refills.
+    """
+
+    def __init__(self, maxsize=5000, ttl=300):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.RLock()
+
+    def get_listing(self, directory):
+        return self._cache.get(('listing', directory))
+
+    def set_listing(self, directory, docs):
+        self._cache.set(('listing', directory), docs)
+
+    def listing_version(self, directory):
+        """Content hash of the cached listing, or None when it is not cached."""
+        with self._lock:
+            listing = self.get_listing(directory)
+            if listing is None:
+                return None
+            # Listings are replaced rather than mutated, so the hash holds while the object does
+            cached = self._cache.get(('version', directory))
+            if cached is None or cached[0] is not listing:
+                encoded = json.dumps(listing, sort_keys=True, default=str).encode('utf-8')
+                cached = (listing, hashlib.sha1(encoded).hexdigest()[:16])
+                self._cache.set(('version', directory), cached)
+            return cached[1]
+
+    def get(self, directory, uid):
+        data = self._cache.get((directory, uid))
+        if data is None:
+            listing = self.get_listing(directory)
+            if listing is not None:
+                data = listing.get(uid)
+        return data
+
+    def put(self, directory, uid, data):
+        with self._lock:
+            data = dict(data)
+            self._cache.set((directory, uid), data)
+            listing = self.get_listing(directory)
+            if listing is not None:
+                # Copy-on-write so readers iterating the old listing are unaffected
+                listing = dict(listing)
+                listing[uid] = data
+                self.set_listing(directory, listing)
+
+    def update(self, directory, uid, fields):
+        with self._lock:
+            data = self.get(directory, uid)
+            if data is None:
+                # Nothing cached to write through to; a later read fills it in
+                self.invalidate(directory)
+                return
+            data = copy.deepcopy(data)
+            _apply_fields(data, fields)
+            self.put(directory, uid, data)
+
+    def remove(self, directory, uid):
+        with self._lock:
+            self._cache.invalidate((directory, uid))
+            listing = self.get_listing(directory)
+            if listing is not None and uid in listing:
+                listing = dict(listing)
+                del listing[uid]
+                self.set_listing(directory, listing)
+
+    def invalidate(self, directory=None):
+        if directory is None:
+            self._cache.clear()
+        else:
+            self._cache.invalidate(('listing', directory))
+
+
+class CollectionCache:
+    """
+    Keeps a small, rarely changing Firestore collection (such as
+    therapy_plans) in memory as {doc_id: data}.
+
+    The collection is read once on first use. A snapshot listener then
+    replaces the cached copy whenever a document changes. If the listener
+    cannot be started the copy is simply re-read after `ttl` seconds.
+    """
+
+    def __init__(self, get_collection, ttl=3600):
+        self.get_collection = get_collection
+        self.ttl = ttl
+        self._docs = None
+        self._loaded_at = 0
+        self._watch = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self, doc_id, default=None):
+        return self.all().get(doc_id, default)
+
+    def all(self):
+        with self._lock:
+            # Listener threads do not survive a fork; each process opens its own
+            if self._pid != os.getpid():
+                self._docs, self._watch, self._pid = None, None, os.getpid()
+            listening = self._watch is not None
+            if self._docs is None or (not listening and time.monotonic() - self._loaded_at > self.ttl):
+                self._load()
+            return self._docs
+
+    def _load(self):
+        collection = self.get_collection()
+        self._docs = {doc.id: doc.to_dict() for doc in collection.stream()}
+        self._loaded_at = time.monotonic()
+        if self._watch is None:
+            try:
+                self._watch = collection.on_snapshot(self._on_snapshot)
+            except Exception as e:
+                print(f"Warning: Could not watch {collection.id}, falling back to a {self.ttl}s refresh. Error: {e}")
+
+    def _on_snapshot(self, docs, changes, read_time):
+        self._docs = {doc.id: doc.to_dict() for doc in docs}
+        self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._docs = None
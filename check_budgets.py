@@ -0,0 +1,439 @@
+# check_budgets.py
+"""
+Checks every route's datastore budget (declared with @read_budget in app.py).
+Seeds a local datastore, runs each route once with cold caches and once warm,
+and fails when either run does more gets, queries, commits, reads or writes
+than its budget allows, printing the call trace of the offending request.
+
+    python check_budgets.py
+    python check_budgets.py --backend sqlite --route get_availability --verbose
+
+Budgets are sized for BUDGET_VOLUMES, which has enough patients that a route
+scanning the users, sessions or notifications collections goes over.
+Background work a request starts (notifications, journey generation) is
+waited for and counted towards the route.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from benchmark import THERAPIES, Environment, login, seed
+
+BUDGET_VOLUMES = dict(practitioners=20, patients=300, sessions_per_patient=3,
+                      feedback_per_practitioner=10, notifications_per_user=5)
+
+# Endpoints that do not touch the datastore, or need a live Firebase Auth backend.
+# The live event stream only reads through the shared listeners in live.py.
+UNCHECKED_ENDPOINTS = {'home', 'register', 'signin', 'logout', 'privacy_policy', 'metrics', 'static', 'assets',
+                       'dashboard_events'}
+
+
+class BudgetEnvironment(Environment):
+    def __init__(self, app_module, practitioner_uids, patient_uids):
+        super().__init__(app_module, practitioner_uids, patient_uids)
+        self.repos = app_module.repos
+        self.counter = 0
+        self.clients = {}
+
+    def client_for(self, uid, role):
+        """A signed-in test client, reused for the same user until the next scenario."""
+        if (uid, role) not in self.clients:
+            self.clients[uid, role] = login(self.app_module.app, uid, role)
+        return self.clients[uid, role]
+
+    def patient_client(self, rng):
+        return self.client_for(rng.choice(self.patient_uids), 'patient')
+
+    def practitioner_client(self, rng):
+        return self.client_for(rng.choice(self.practitioner_uids), 'practitioner')
+
+    def next_id(self, prefix):
+        self.counter += 1
+        return f"{prefix}-{self.counter}"
+
+    def clear_caches(self):
+        app_module = self.app_module
+        app_module.directory_cache.invalidate()
+        app_module.token_cache.clear()
+        app_module.role_cache.clear()
+        app_module.schedule_cache.clear()
+        app_module.booked_cache.clear()
+        app_module.therapy_plan_cache.invalidate()
+        app_module.fragment_cache.clear()
+        app_module.admin_counts_cache.clear()
+
+    def new_session(self, patient_uid, practitioner_uid, days_ahead=10, **fields):
+        """Books a fresh slot directly in the datastore and returns the session id."""
+        date = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) \
+            + timedelta(days=days_ahead, hours=self.counter % 8, minutes=self.counter % 60)
+        session_id = self.next_id('budget-session')
+        batch = self.repos.client.batch()
+        batch.set(self.repos.sessions.ref(session_id), {
+            'patient_uid': patient_uid, 'practitioner_uid': practitioner_uid, 'therapy': 'Basti', 'date': date,
+            'status': 'payment_pending', 'payment_status': 'pending', 'amount_due': 500,
+            'appointment_price': 500, 'session_price': 1500, 'created_at': datetime.now(timezone.utc), **fields
+        })
+        batch.set(self.repos.slot_reservations.ref_for(practitioner_uid, date), {
+            'practitioner_uid': practitioner_uid, 'patient_uid': patient_uid, 'session_id': session_id, 'date': date
+        })
+        batch.commit()
+        return session_id
+
+
+def seed_therapy_plans(repos):
+    for therapy in THERAPIES:
+        repos.therapy_plans.ref(therapy.lower()).set({
+            'planName': f'{therapy} plan',
+            'tasks': [{'title': f'Day {day}', 'description': 'Follow the diet chart.', 'day_offset': day}
+                      for day in range(-2, 5)]
+        })
+
+
+# --- Scenarios ---
+# Each takes (env, rng), does any setup and returns a function that makes the
+# one request being measured.
+
+def patient_and_practitioner(env, rng):
+    return rng.choice(env.patient_uids), rng.choice(env.practitioner_uids)
+
+
+def verify_token_request(env, rng):
+    uid = rng.choice(env.patient_uids)
+    id_token = env.next_id('budget-token')
+    # Stands in for a token Firebase Auth already verified, so the role lookup is what gets measured
+    env.app_module.token_cache.set(hashlib.sha256(id_token.encode('utf-8')).hexdigest(),
+                                   {'uid': uid, 'exp': time.time() + 3600})
+    client = env.app_module.app.test_client()
+    return lambda: client.post('/verify-token', json={'idToken': id_token})
+
+
+def patient_dashboard_request(env, rng):
+    client = env.patient_client(rng)
+    return lambda: client.get('/dashboard')
+
+
+def practitioner_dashboard_request(env, rng):
+    client = env.practitioner_client(rng)
+    return lambda: client.get('/dashboard')
+
+
+def fragment_request(role, name):
+    def scenario(env, rng):
+        client = env.patient_client(rng) if role == 'patient' else env.practitioner_client(rng)
+        return lambda: client.get(f'/dashboard/fragments/{name}')
+    return scenario
+
+
+DASHBOARD_FRAGMENTS = [
+    ('patient', 'stats'), ('patient', 'sessions'), ('patient', 'journey'), ('patient', 'schedule-new'),
+    ('patient', 'comms'), ('patient', 'profile'),
+    ('practitioner', 'stats'), ('practitioner', 'upcoming-sessions'), ('practitioner', 'availability'),
+    ('practitioner', 'feedback'), ('practitioner', 'notifications'), ('practitioner', 'profile'),
+]
+
+
+def api_sessions_request(env, rng):
+    client = env.patient_client(rng)
+    return lambda: client.get('/api/sessions?limit=20')
+
+
+def api_feedback_request(env, rng):
+    client = env.practitioner_client(rng)
+    return lambda: client.get('/api/feedback?limit=20')
+
+
+def api_notifications_request(env, rng):
+    client = env.patient_client(rng)
+    return lambda: client.get('/api/notifications?limit=20')
+
+
+def schedule_session_request(env, rng):
+    day = datetime.now(timezone.utc).date() + timedelta(days=rng.randint(31, 60))
+    # The cold and warm runs pick the same day; the counter gives each its own slot
+    env.next_id('slot')
+    form = {'therapist-uid': rng.choice(env.practitioner_uids), 'therapy-type': rng.choice(THERAPIES),
+            'session-date': day.isoformat(), 'session-time': f'{9 + env.counter % 8:02d}:00'}
+    client = env.patient_client(rng)
+    return lambda: client.post('/schedule_session_patient', data=form)
+
+
+def create_order_request(env, rng):
+    patient_uid, practitioner_uid = patient_and_practitioner(env, rng)
+    session_id = env.new_session(patient_uid, practitioner_uid)
+    client = env.client_for(patient_uid, 'patient')
+    return lambda: client.post('/create_order', json={'session_id': session_id})
+
+
+def verify_payment_request(env, rng):
+    patient_uid, practitioner_uid = patient_and_practitioner(env, rng)
+    session_id = env.new_session(patient_uid, practitioner_uid)
+    razorpay_client = env.app_module.razorpay_client
+    order_id = razorpay_client.order.create(data={'amount': 50000})['id']
+    payment_id = env.next_id('pay')
+    payload = {'session_id': session_id, 'razorpay_order_id': order_id, 'razorpay_payment_id': payment_id,
+               'razorpay_signature': razorpay_client.sign_payment(order_id, payment_id)}
+    client = env.client_for(patient_uid, 'patient')
+    return lambda: client.post('/verify_payment', json=payload)
+
+
+def razorpay_webhook_request(env, rng):
+    patient_uid, practitioner_uid = patient_and_practitioner(env, rng)
+    order_id = env.next_id('order')
+    session_id = env.new_session(patient_uid, practitioner_uid, razorpay_order={'id': order_id, 'amount': 50000})
+    payment_id = env.next_id('pay')
+    body = json.dumps({'event': 'payment.captured', 'payload': {'payment': {'entity': {
+        'id': payment_id, 'order_id': order_id, 'notes': {'session_id': session_id}}}}})
+    signature = env.app_module.razorpay_client.sign_webhook(body, env.app_module.app.config['RAZORPAY_WEBHOOK_SECRET'])
+    client = env.app_module.app.test_client()
+    return lambda: client.post('/razorpay_webhook', data=body, content_type='application/json',
+                               headers={'X-Razorpay-Signature': signature})
+
+
+def complete_session_request(env, rng):
+    patient_uid, practitioner_uid = patient_and_practitioner(env, rng)
+    session_id = env.new_session(patient_uid, practitioner_uid, status='scheduled', payment_status='paid')
+    client = env.client_for(practitioner_uid, 'practitioner')
+    return lambda: client.post('/complete_session', data={'session_id': session_id})
+
+
+def cancel_session_request(env, rng):
+    patient_uid, practitioner_uid = patient_and_practitioner(env, rng)
+    session_id = env.new_session(patient_uid, practitioner_uid)
+    client = env.client_for(patient_uid, 'patient')
+    return lambda: client.post('/cancel_session_patient', data={'session_id': session_id})
+
+
+def save_notifications_request(env, rng):
+    client = env.patient_client(rng)
+    return lambda: client.post('/save_notifications', data={'in-app': 'on', 'email': 'on'})
+
+
+def update_profile_request(env, rng):
+    client = env.patient_client(rng)
+    return lambda: client.post('/update_profile', json={'name': 'Renamed Patient', 'number': '8000011111'})
+
+
+def update_recurring_availability_request(env, rng):
+    client = env.practitioner_client(rng)
+    recurring = {'monday': {'start': '09:00', 'end': '17:00', 'interval': '60'}}
+    return lambda: client.post('/update_recurring_availability', json=recurring)
+
+
+def update_date_override_request(env, rng):
+    day = datetime.now(timezone.utc).date() + timedelta(days=rng.randint(1, 30))
+    client = env.practitioner_client(rng)
+    return lambda: client.post('/update_date_override', json={'date': day.isoformat(), 'times': '10:00, 11:00'})
+
+
+def get_availability_request(env, rng):
+    uid = rng.choice(env.practitioner_uids)
+    client = env.patient_client(rng)
+    return lambda: client.get(f'/get_availability/{uid}')
+
+
+def search_slots_request(env, rng):
+    client = env.patient_client(rng)
+    return lambda: client.get(f'/search_slots?therapy={rng.choice(THERAPIES)}')
+
+
+def therapists_request(env, rng):
+    client = env.patient_client(rng)
+    return lambda: client.get('/therapists')
+
+
+def therapist_search_request(env, rng):
+    client = env.patient_client(rng)
+    return lambda: client.get(f'/api/therapists?specialty={rng.choice(THERAPIES)}&location=pu&max_session_price=2500')
+
+
+def reschedule_request(env, rng):
+    patient_uid, practitioner_uid = patient_and_practitioner(env, rng)
+    session_id = env.new_session(patient_uid, practitioner_uid)
+    client = env.client_for(patient_uid, 'patient')
+    return lambda: client.get(f'/reschedule/{session_id}')
+
+
+def update_rescheduled_session_request(env, rng):
+    patient_uid, practitioner_uid = patient_and_practitioner(env, rng)
+    session_id = env.new_session(patient_uid, practitioner_uid)
+    day = datetime.now(timezone.utc).date() + timedelta(days=rng.randint(61, 90))
+    form = {'session_id': session_id, 'session-date': day.isoformat(), 'session-time': f'{9 + env.counter % 8:02d}:00'}
+    client = env.client_for(patient_uid, 'patient')
+    return lambda: client.post('/update_rescheduled_session', data=form)
+
+
+def admin_dashboard_request(env, rng):
+    client = env.client_for('budget-admin', 'admin')
+    return lambda: client.get('/admin')
+
+
+def approve_practitioner_request(env, rng):
+    uid = rng.choice(env.practitioner_uids)
+    client = env.client_for('budget-admin', 'admin')
+    return lambda: client.post(f'/admin/approve/{uid}')
+
+
+def approve_practitioners_bulk_request(env, rng):
+    client = env.client_for('budget-admin', 'admin')
+    return lambda: client.post('/admin/approve', data={'practitioner_ids': env.practitioner_uids})
+
+
+def journey_for(env, rng):
+    patient_uid, practitioner_uid = patient_and_practitioner(env, rng)
+    session_id = env.new_session(patient_uid, practitioner_uid, status='scheduled', payment_status='paid')
+    env.app_module.create_patient_journey(session_id)
+    return session_id, env.client_for(patient_uid, 'patient')
+
+
+def update_task_status_request(env, rng):
+    journey_id, client = journey_for(env, rng)
+    return lambda: client.post('/update_task_status', json={'journey_id': journey_id, 'task_index': 0})
+
+
+def update_task_status_batch_request(env, rng):
+    journey_id, client = journey_for(env, rng)
+    return lambda: client.post('/update_task_status/batch', json={'journey_id': journey_id, 'task_indexes': [0, 1, 2]})
+
+
+# (endpoint, label, scenario)
+BUDGET_SCENARIOS = [
+    ('verify_token', 'POST /verify-token', verify_token_request),
+    ('dashboard', 'GET /dashboard (patient)', patient_dashboard_request),
+    ('dashboard', 'GET /dashboard (practitioner)', practitioner_dashboard_request),
+    *[(f'dashboard_fragment:{name}', f'GET /dashboard/fragments/{name} ({role})', fragment_request(role, name))
+      for role, name in DASHBOARD_FRAGMENTS],
+    ('api_sessions', 'GET /api/sessions', api_sessions_request),
+    ('api_feedback', 'GET /api/feedback', api_feedback_request),
+    ('api_notifications', 'GET /api/notifications', api_notifications_request),
+    ('schedule_session_patient', 'POST /schedule_session_patient', schedule_session_request),
+    ('create_order', 'POST /create_order', create_order_request),
+    ('verify_payment', 'POST /verify_payment', verify_payment_request),
+    ('razorpay_webhook', 'POST /razorpay_webhook', razorpay_webhook_request),
+    ('complete_session', 'POST /complete_session', complete_session_request),
+    ('cancel_session_patient', 'POST /cancel_session_patient', cancel_session_request),
+    ('save_notifications', 'POST /save_notifications', save_notifications_request),
+    ('update_profile', 'POST /update_profile', update_profile_request),
+    ('update_recurring_availability', 'POST /update_recurring_availability', update_recurring_availability_request),
+    ('update_date_override', 'POST /update_date_override', update_date_override_request),
+    ('get_availability', 'GET /get_availability/<uid>', get_availability_request),
+    ('search_slots', 'GET /search_slots', search_slots_request),
+    ('therapists', 'GET /therapists', therapists_request),
+    ('api_therapists', 'GET /api/therapists', therapist_search_request),
+    ('reschedule_session', 'GET /reschedule/<session_id>', reschedule_request),
+    ('update_rescheduled_session', 'POST /update_rescheduled_session', update_rescheduled_session_request),
+    ('admin_dashboard', 'GET /admin', admin_dashboard_request),
+    ('approve_practitioner', 'POST /admin/approve/<uid>', approve_practitioner_request),
+    ('approve_practitioners_bulk', 'POST /admin/approve', approve_practitioners_bulk_request),
+    ('update_task_status', 'POST /update_task_status', update_task_status_request),
+    ('update_task_status_batch', 'POST /update_task_status/batch', update_task_status_batch_request),
+]
+
+
+# --- Checking ---
+
+def measure(env, trace, scenario, rng, cold):
+    """Runs one request and returns (status_code, usage, formatted call trace)."""
+    env.settle()
+    if cold:
+        env.clear_caches()
+    send = scenario(env, rng)
+    env.settle()
+    trace.clear()
+    response = send()
+    env.settle()
+    return response.status_code, trace.usage(), trace.format()
+
+
+def format_usage(usage):
+    return ' '.join(f"{limit}={usage[limit]}" for limit in ('gets', 'queries', 'commits', 'reads', 'writes'))
+
+
+def check(env, trace, budgets, scenarios, rng, verbose=False):
+    """Prints one line per scenario and run; returns the number of failures."""
+    failures = 0
+    for endpoint, label, scenario in scenarios:
+        budget = budgets.get(endpoint)
+        if budget is None:
+            print(f"FAIL  {label}: no @read_budget declared for '{endpoint}'")
+            failures += 1
+            continue
+        # Both runs make the same choices, so the warm run meets the caches the cold run filled
+        scenario_seed = rng.random()
+        env.clients.clear()
+        for cold in (True, False):
+            status, usage, calls = measure(env, trace, scenario, random.Random(scenario_seed), cold)
+            run = 'cold' if cold else 'warm'
+            problems = budget.violations(usage)
+            if status >= 500:
+                problems.append(f"status {status}")
+            print(f"{'FAIL' if problems else 'ok':<5} {label:<56} {run}  {format_usage(usage)}")
+            if problems:
+                failures += 1
+                print(f"      over {budget}: {'; '.join(problems)}")
+            if problems or verbose:
+                print('\n'.join(f"        {line}" for line in calls.splitlines()) or '        (no datastore calls)')
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=['memory', 'sqlite'], default='memory')
+    parser.add_argument('--sqlite-path', default='budgets.db')
+    parser.add_argument('--route', action='append', help='only check this endpoint (repeatable)')
+    parser.add_argument('--verbose', action='store_true', help='print the call trace of every request')
+    parser.add_argument('--seed', type=int, default=7)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # The app picks its backends at import time
+    os.environ['DATASTORE_BACKEND'] = args.backend
+    os.environ['DATASTORE_SQLITE_PATH'] = args.sqlite_path
+    os.environ['RAZORPAY_CLIENT'] = 'fake'
+    os.environ.setdefault('RAZORPAY_KEY_SECRET', 'budget-secret')
+    os.environ.setdefault('RAZORPAY_WEBHOOK_SECRET', 'budget-webhook-secret')
+    os.environ.setdefault('NOTIFICATION_SMS_SENDER', 'memory')
+    os.environ.setdefault('NOTIFICATION_EMAIL_SENDER', 'memory')
+    if args.backend == 'sqlite' and os.path.exists(args.sqlite_path):
+        os.remove(args.sqlite_path)
+    import app as app_module
+    from budgets import ROUTE_BUDGETS, CallTrace
+
+    rng = random.Random(args.seed)
+    practitioner_uids, patient_uids = seed(app_module.repos, rng, **BUDGET_VOLUMES)
+    app_module.backfill_slot_reservations()
+    app_module.backfill_practitioner_stats()
+    seed_therapy_plans(app_module.repos)
+    env = BudgetEnvironment(app_module, practitioner_uids, patient_uids)
+
+    trace = CallTrace()
+    app_module.db.listeners.append(trace)
+
+    scenarios = [entry for entry in BUDGET_SCENARIOS if not args.route or entry[0] in args.route]
+    failures = check(env, trace, ROUTE_BUDGETS, scenarios, rng, args.verbose)
+
+    if not args.route:
+        covered = {endpoint for endpoint, _, _ in BUDGET_SCENARIOS}
+        for endpoint in sorted(set(ROUTE_BUDGETS) - covered):
+            print(f"FAIL  {endpoint}: budget declared but no scenario exercises it")
+            failures += 1
+        # 'endpoint:part' budgets cover their route
+        covered_views = {endpoint.split(':')[0] for endpoint in covered}
+        for endpoint in sorted(set(app_module.app.view_functions) - covered_views - UNCHECKED_ENDPOINTS):
+            print(f"FAIL  {endpoint}: route has no budget scenario")
+            failures += 1
+
+    print(f"\n{len(scenarios)} routes checked, {failures} failures")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+# clients.py
+
+import importlib
+import os
+import threading
+
+
+class LazyClient:
+    """
+    A backend client (Firestore, Firebase Admin, Razorpay) created on first
+    use rather than at import time, so importing the app opens no connections.
+
+    Attribute access is forwarded to the client, so module-level names like
+    `db` read the same in route code as a plain client would. With
+    per_process=True the client is built once per process: gRPC channels
+    opened before a fork are not safe to use in the child, so a worker forked
+    from a preloaded master builds its own on first use. A factory that
+    returns None (backend unavailable) is not retried, and the proxy is falsy.
+    The proxy's own names are load/ready/reset, so they do not shadow the
+    client's methods.
+    """
+
+    def __init__(self, name, factory, per_process=True):
+        self._name = name
+        self._factory = factory
+        self._per_process = per_process
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _current(self):
+        return self._pid is not None and (self._pid == os.getpid() or not self._per_process)
+
+    def load(self):
+        """Returns the client, creating it first if this process has none."""
+        if not self._current():
+            with self._lock:
+                if not self._current():
+                    self._client = self._factory()
+                    self._pid = os.getpid()
+        return self._client
+
+    @property
+    def ready(self):
+        """True once the client exists in this process."""
+        return self._current()
+
+    def reset(self):
+        with self._lock:
+            self._client, self._pid = None, None
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __bool__(self):
+        return self.load() is not None
+
+    def __repr__(self):
+        return f"<LazyClient {self._name} {'ready' if self._current() else 'not created'}>"
+
+
+def lazy_module(name):
+    """A module imported on first attribute access, for SDKs that are slow to import."""
+    return LazyClient(name, lambda: importlib.import_module(name), per_process=False)
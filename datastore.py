@@ -0,0 +1,699 @@
+# datastore.py
+
+import base64
+import json
+import os
+import random
+import sqlite3
+import string
+import math
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from copy import deepcopy
+from datetime import datetime, timezone
+from functools import wraps
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+from clients import lazy_module
+
+# The Firestore SDK takes several hundred milliseconds to import; only sentinel writes need it here
+firestore = lazy_module('google.cloud.firestore')
+transforms = lazy_module('google.cloud.firestore_v1.transforms')
+
+ASCENDING = 'ASCENDING'
+DESCENDING = 'DESCENDING'
+
+AUTO_ID_CHARS = string.ascii_letters + string.digits
+# Field path of the document id, as in Firestore's FieldPath.document_id()
+DOCUMENT_ID = '__name__'
+
+
+# --- Field paths and values ---
+
+def split_field_path(field_path):
+    return [part.strip('`') for part in field_path.split('.')]
+
+
+def lookup_field(data, parts):
+    """Returns (found, value) for the nested field at `parts`."""
+    value = data
+    for part in parts:
+        if not isinstance(value, dict) or part not in value:
+            return False, None
+        value = value[part]
+    return True, value
+
+
+def normalize_value(value):
+    """Stores values the way Firestore returns them: lists for tuples, UTC-aware datetimes."""
+    if isinstance(value, dict):
+        return {key: normalize_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize_value(item) for item in value]
+    if isinstance(value, datetime):
+        # Firestore reads naive datetimes as UTC
+        if value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc)
+    return value
+
+
+def type_rank(value):
+    # Firestore orders values of different types by type first
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, datetime):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, bytes):
+        return 5
+    if isinstance(value, list):
+        return 7
+    return 8
+
+
+def sort_key(value):
+    rank = type_rank(value)
+    if rank == 7:
+        return (rank, tuple(sort_key(item) for item in value))
+    if rank == 8:
+        return (rank, tuple((key, sort_key(item)) for key, item in sorted(value.items())))
+    return (rank, value)
+
+
+def comparable(a, b):
+    return a is not None and b is not None and type_rank(a) == type_rank(b)
+
+
+FILTER_OPS = {
+    '==': lambda a, b: a == b and type_rank(a) == type_rank(b),
+    '!=': lambda a, b: a is not None and not (a == b and type_rank(a) == type_rank(b)),
+    '<': lambda a, b: comparable(a, b) and sort_key(a) < sort_key(b),
+    '<=': lambda a, b: comparable(a, b) and sort_key(a) <= sort_key(b),
+    '>': lambda a, b: comparable(a, b) and sort_key(a) > sort_key(b),
+    '>=': lambda a, b: comparable(a, b) and sort_key(a) >= sort_key(b),
+    'in': lambda a, b: any(FILTER_OPS['=='](a, item) for item in b),
+    'not-in': lambda a, b: a is not None and not any(FILTER_OPS['=='](a, item) for item in b),
+    'array_contains': lambda a, b: isinstance(a, list) and any(FILTER_OPS['=='](item, b) for item in a),
+    'array_contains_any': lambda a, b: isinstance(a, list) and any(FILTER_OPS['=='](item, v) for item in a for v in b),
+}
+
+
+def apply_field(data, parts, value):
+    """Writes one leaf, resolving Firestore sentinels and transforms against the current value."""
+    parent = data
+    for part in parts[:-1]:
+        if not isinstance(parent.get(part), dict):
+            parent[part] = {}
+        parent = parent[part]
+    key = parts[-1]
+    current = parent.get(key)
+
+    if value is transforms.DELETE_FIELD:
+        parent.pop(key, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        parent[key] = datetime.now(timezone.utc)
+    elif isinstance(value, transforms.Increment):
+        parent[key] = (current if type_rank(current) == 2 else 0) + value.value
+    elif isinstance(value, transforms.Maximum):
+        parent[key] = max(current, value.value) if type_rank(current) == 2 else value.value
+    elif isinstance(value, transforms.Minimum):
+        parent[key] = min(current, value.value) if type_rank(current) == 2 else value.value
+    elif isinstance(value, transforms.ArrayUnion):
+        items = list(current) if isinstance(current, list) else []
+        for item in normalize_value(value.values):
+            if item not in items:
+                items.append(item)
+        parent[key] = items
+    elif isinstance(value, transforms.ArrayRemove):
+        removed = normalize_value(value.values)
+        parent[key] = [item for item in current if item not in removed] if isinstance(current, list) else []
+    else:
+        parent[key] = normalize_value(value)
+
+
+def flatten(data, prefix=()):
+    """Yields (parts, value) for every leaf of a nested dict; empty dicts count as leaves."""
+    for key, value in data.items():
+        parts = prefix + (key,)
+        if isinstance(value, dict) and value:
+            yield from flatten(value, parts)
+        else:
+            yield parts, value
+
+
+# --- Storage ---
+
+class MemoryStorage:
+    """
+    Documents kept in process memory: {collection_path: {doc_id: data}}.
+    Stored dicts are replaced on every write, never changed in place, so
+    reads can hand them out without copying.
+    """
+
+    def __init__(self):
+        self._collections = {}
+
+    def get(self, collection, doc_id):
+        return self._collections.get(collection, {}).get(doc_id)
+
+    def put(self, collection, doc_id, data):
+        self._collections.setdefault(collection, {})[doc_id] = deepcopy(data)
+
+    def delete(self, collection, doc_id):
+        self._collections.get(collection, {}).pop(doc_id, None)
+
+    def scan(self, collection, equals=()):
+        return list(self._collections.get(collection, {}).items())
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def encode_json(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"Cannot store {type(value).__name__} values")
+
+
+def decode_json(obj):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    if '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+class SQLiteStorage:
+    """
+    Documents stored as JSON in a single SQLite table. Equality filters on
+    plain values are pushed down with json_extract; everything else is
+    evaluated by the query engine, as with MemoryStorage.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # SQLite connections must not be shared across a fork
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            if self.path != ':memory:':
+                self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS documents ('
+                'collection TEXT NOT NULL, doc_id TEXT NOT NULL, data TEXT NOT NULL, '
+                'PRIMARY KEY (collection, doc_id))'
+            )
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, collection, doc_id):
+        row = self.conn.execute(
+            'SELECT data FROM documents WHERE collection = ? AND doc_id = ?', (collection, doc_id)).fetchone()
+        return json.loads(row[0], object_hook=decode_json) if row else None
+
+    def put(self, collection, doc_id, data):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO documents (collection, doc_id, data) VALUES (?, ?, ?)',
+            (collection, doc_id, json.dumps(data, default=encode_json)))
+
+    def delete(self, collection, doc_id):
+        self.conn.execute('DELETE FROM documents WHERE collection = ? AND doc_id = ?', (collection, doc_id))
+
+    def scan(self, collection, equals=()):
+        sql, params = 'SELECT doc_id, data FROM documents WHERE collection = ?', [collection]
+        for parts, value in equals:
+            if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+                sql += ' AND json_extract(data, ?) = ?'
+                params += ['$.' + '.'.join(json.dumps(part) for part in parts), value]
+        return [(doc_id, json.loads(data, object_hook=decode_json))
+                for doc_id, data in self.conn.execute(sql, params)]
+
+    def begin(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def commit(self):
+        self.conn.execute('COMMIT')
+
+    def rollback(self):
+        self.conn.execute('ROLLBACK')
+
+
+# --- Documents and queries ---
+
+class LocalDocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return deepcopy(self._data)
+
+    def get(self, field_path):
+        found, value = lookup_field(self._data or {}, split_field_path(field_path))
+        if not found:
+            raise KeyError(field_path)
+        return deepcopy(value)
+
+
+class LocalDocumentReference:
+    def __init__(self, client, collection_path, doc_id):
+        self._client = client
+        self._collection_path = collection_path
+        self.id = doc_id
+
+    @property
+    def path(self):
+        return f"{self._collection_path}/{self.id}"
+
+    @property
+    def parent(self):
+        return LocalCollectionReference(self._client, self._collection_path)
+
+    def __eq__(self, other):
+        return isinstance(other, LocalDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def collection(self, collection_id):
+        return LocalCollectionReference(self._client, f"{self.path}/{collection_id}")
+
+    def get(self, field_paths=None, transaction=None):
+        started = time.perf_counter()
+        snapshot = self._client._snapshot(self, self._client._read(self._collection_path, self.id), field_paths)
+        self._client._record('get', self._collection_path, reads=1, started=started)
+        return snapshot
+
+    def create(self, document_data):
+        return self._client._commit([('create', self, document_data)])
+
+    def set(self, document_data, merge=False):
+        return self._client._commit([('set', self, document_data, merge)])
+
+    def update(self, field_updates):
+        return self._client._commit([('update', self, field_updates)])
+
+    def delete(self):
+        return self._client._commit([('delete', self)])
+
+
+class LocalQuery:
+    def __init__(self, client, collection_path, filters=(), orders=(), limit=None, offset=0,
+                 cursor=None, projection=None):
+        self._client = client
+        self._collection_path = collection_path
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._offset = offset
+        self._cursor = cursor
+        self._projection = projection
+
+    def _copy(self, **changes):
+        fields = dict(filters=self._filters, orders=self._orders, limit=self._limit, offset=self._offset,
+                      cursor=self._cursor, projection=self._projection)
+        fields.update(changes)
+        return LocalQuery(self._client, self._collection_path, **fields)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in FILTER_OPS:
+            raise ValueError(f"Unsupported operator {op_string!r}")
+        return self._copy(filters=self._filters + ((split_field_path(field_path), op_string, normalize_value(value)),))
+
+    def order_by(self, field_path, direction=ASCENDING):
+        return self._copy(orders=self._orders + ((split_field_path(field_path), direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def offset(self, num_to_skip):
+        return self._copy(offset=num_to_skip)
+
+    def select(self, field_paths):
+        return self._copy(projection=[split_field_path(path) for path in field_paths])
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(cursor=(document_fields_or_snapshot, False))
+
+    def start_at(self, document_fields_or_snapshot):
+        return self._copy(cursor=(document_fields_or_snapshot, True))
+
+    def count(self, alias=None):
+        return LocalAggregationQuery(self, alias or 'field_1')
+
+    def stream(self, transaction=None):
+        return iter(self._execute())
+
+    def get(self, transaction=None):
+        return self._execute()
+
+    def _cursor_values(self):
+        values, inclusive = self._cursor
+        if isinstance(values, LocalDocumentSnapshot):
+            values = {**values.to_dict(), DOCUMENT_ID: values.id}
+        if isinstance(values, dict):
+            values = [lookup_field(values, parts)[1] for parts, _ in self._orders]
+        # Firestore takes a document id or a reference as the value for the id
+        values = [getattr(value, 'id', value) if parts == [DOCUMENT_ID] else value
+                  for (parts, _), value in zip(self._orders, values)]
+        return [normalize_value(value) for value in values], inclusive
+
+    @staticmethod
+    def _lookup(row, parts):
+        if parts == [DOCUMENT_ID]:
+            return True, row[0]
+        return lookup_field(row[1], parts)
+
+    def _execute(self, record=True):
+        started = time.perf_counter()
+        equals = [(parts, value) for parts, op, value in self._filters if op == '==']
+        rows = self._client._scan(self._collection_path, equals)
+
+        matched = []
+        for doc_id, data in rows:
+            if all(FILTER_OPS[op](*lookup_field(data, parts)[1:], value) for parts, op, value in self._filters):
+                if all(self._lookup((doc_id, data), parts)[0] for parts, _ in self._orders):
+                    matched.append((doc_id, data))
+
+        # Ties fall back to document id, as in Firestore
+        matched.sort(key=lambda row: row[0])
+        for parts, direction in reversed(self._orders):
+            matched.sort(key=lambda row: sort_key(self._lookup(row, parts)[1]), reverse=(direction == DESCENDING))
+
+        if self._cursor is not None:
+            cursor, inclusive = self._cursor_values()
+            matched = [row for row in matched if self._after_cursor(row, cursor, inclusive)]
+
+        matched = matched[self._offset:]
+        if self._limit is not None:
+            matched = matched[:self._limit]
+
+        snapshots = []
+        for doc_id, data in matched:
+            reference = LocalDocumentReference(self._client, self._collection_path, doc_id)
+            snapshots.append(self._client._snapshot(reference, data, self._projection))
+        if record:
+            # Firestore bills a query at least one read even when it matches nothing
+            self._client._record('query', self._collection_path, reads=max(1, len(snapshots)), started=started)
+        return snapshots
+
+    def _after_cursor(self, row, cursor, inclusive):
+        for (parts, direction), cursor_value in zip(self._orders, cursor):
+            a, b = sort_key(self._lookup(row, parts)[1]), sort_key(cursor_value)
+            if a != b:
+                return (a > b) if direction != DESCENDING else (a < b)
+        return inclusive
+
+
+class LocalCollectionReference(LocalQuery):
+    def __init__(self, client, collection_path):
+        super().__init__(client, collection_path)
+
+    @property
+    def id(self):
+        return self._collection_path.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        document_id = document_id or ''.join(random.choices(AUTO_ID_CHARS, k=20))
+        return LocalDocumentReference(self._client, self._collection_path, document_id)
+
+    def add(self, document_data, document_id=None):
+        reference = self.document(document_id)
+        update_time = reference.create(document_data)
+        return update_time, reference
+
+
+class LocalAggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class LocalAggregationQuery:
+    def __init__(self, query, alias):
+        self._query = query
+        self._alias = alias
+
+    def get(self, transaction=None):
+        started = time.perf_counter()
+        count = len(self._query._copy(projection=[])._execute(record=False))
+        # Aggregations are billed one read per 1000 index entries
+        self._query._client._record('count', self._query._collection_path, reads=max(1, math.ceil(count / 1000)), started=started)
+        return [[LocalAggregationResult(self._alias, count)]]
+
+
+# --- Writes ---
+
+class LocalWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def create(self, reference, document_data):
+        self._writes.append(('create', reference, document_data))
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge))
+
+    def update(self, reference, field_updates):
+        self._writes.append(('update', reference, field_updates))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        return self._client._commit(writes)
+
+    def __len__(self):
+        return len(self._writes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+
+class LocalTransaction(LocalWriteBatch):
+    """Writes are buffered and committed when the transactional function returns."""
+
+    def __init__(self, client, max_attempts=5, read_only=False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+
+
+def transactional(func):
+    """
+    Drop-in for firestore.transactional that also accepts a LocalTransaction.
+    Local transactions hold the client's lock for their whole run, so they
+    are serialized rather than retried.
+    """
+    @wraps(func)
+    def wrapper(transaction, *args, **kwargs):
+        if not isinstance(transaction, LocalTransaction):
+            # firestore's wrapper keeps per-run state, so it is not shared between threads
+            return firestore.transactional(func)(transaction, *args, **kwargs)
+        with transaction._client._atomic():
+            try:
+                result = func(transaction, *args, **kwargs)
+                transaction.commit()
+                return result
+            finally:
+                transaction._writes = []
+    return wrapper
+
+
+# --- Client ---
+
+def collection_paths(references):
+    return ','.join(sorted({reference._collection_path for reference in references}))
+
+
+class LocalClient:
+    """
+    The subset of the Firestore client API the app relies on, backed by a
+    MemoryStorage or SQLiteStorage. Queries are evaluated in Python, so no
+    composite indexes are needed, and the returned values match what
+    Firestore returns (UTC-aware datetimes, lists, KeyError on missing fields).
+
+    `calls` counts every backend call by kind ('get', 'get_all', 'query',
+    'count', 'commit') along with the 'reads' and 'writes' Firestore would
+    bill for them. Callables appended to `listeners` are also told about each
+    call as listener(kind, collection_path, reads, writes, seconds).
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._lock = threading.RLock()
+        self._depth = 0
+        self.calls = Counter()
+        self._calls_lock = threading.Lock()
+        self.listeners = []
+
+    def _record(self, kind, collection_path, reads=0, writes=0, started=None):
+        with self._calls_lock:
+            self.calls[kind] += 1
+            self.calls['reads'] += reads
+            self.calls['writes'] += writes
+        if self.listeners:
+            seconds = time.perf_counter() - started if started is not None else 0.0
+            for listener in self.listeners:
+                listener(kind, collection_path, reads, writes, seconds)
+
+    def snapshot_calls(self):
+        with self._calls_lock:
+            return Counter(self.calls)
+
+    def collection(self, *collection_path):
+        return LocalCollectionReference(self, '/'.join(collection_path))
+
+    def document(self, *document_path):
+        collection_path, doc_id = '/'.join(document_path).rsplit('/', 1)
+        return LocalDocumentReference(self, collection_path, doc_id)
+
+    def batch(self):
+        return LocalWriteBatch(self)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return LocalTransaction(self, max_attempts=max_attempts, read_only=read_only)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        started = time.perf_counter()
+        references = list(references)
+        with self._lock:
+            snapshots = [self._snapshot(ref, self._storage.get(ref._collection_path, ref.id), field_paths)
+                         for ref in references]
+        self._record('get_all', collection_paths(references), reads=len(references), started=started)
+        return iter(snapshots)
+
+    @contextmanager
+    def _atomic(self):
+        with self._lock:
+            outermost = self._depth == 0
+            if outermost:
+                self._storage.begin()
+            self._depth += 1
+            try:
+                yield
+            except BaseException:
+                self._depth -= 1
+                if outermost:
+                    self._storage.rollback()
+                raise
+            self._depth -= 1
+            if outermost:
+                self._storage.commit()
+
+    def _read(self, collection_path, doc_id):
+        with self._lock:
+            return self._storage.get(collection_path, doc_id)
+
+    def _scan(self, collection_path, equals):
+        with self._lock:
+            return self._storage.scan(collection_path, equals)
+
+    def _snapshot(self, reference, data, field_paths=None):
+        if data is not None and field_paths is not None:
+            projected = {}
+            for parts in field_paths:
+                parts = split_field_path(parts) if isinstance(parts, str) else parts
+                found, value = lookup_field(data, parts)
+                if found:
+                    apply_field(projected, parts, value)
+            data = projected
+        return LocalDocumentSnapshot(reference, data)
+
+    def _commit(self, writes):
+        """Applies the writes all-or-nothing. Raises AlreadyExists / NotFound like Firestore."""
+        started = time.perf_counter()
+        try:
+            return self._apply_writes(writes)
+        finally:
+            self._record('commit', collection_paths(write[1] for write in writes), writes=len(writes), started=started)
+
+    def _apply_writes(self, writes):
+        with self._atomic():
+            staged = {}
+
+            def current(reference):
+                key = (reference._collection_path, reference.id)
+                if key not in staged:
+                    staged[key] = self._storage.get(*key)
+                return staged[key]
+
+            for write in writes:
+                kind, reference = write[0], write[1]
+                key = (reference._collection_path, reference.id)
+                existing = current(reference)
+                if kind == 'create':
+                    if existing is not None:
+                        raise AlreadyExists(f"Document already exists: {reference.path}")
+                    data = {}
+                    for parts, value in flatten(write[2]):
+                        apply_field(data, list(parts), value)
+                elif kind == 'set':
+                    data = deepcopy(existing) if write[3] and existing is not None else {}
+                    for parts, value in flatten(write[2]):
+                        apply_field(data, list(parts), value)
+                elif kind == 'update':
+                    if existing is None:
+                        raise NotFound(f"No document to update: {reference.path}")
+                    data = deepcopy(existing)
+                    for field_path, value in write[2].items():
+                        parts = split_field_path(field_path)
+                        if isinstance(value, dict):
+                            apply_field(data, parts, {})
+                            for sub_parts, sub_value in flatten(value):
+                                apply_field(data, parts + list(sub_parts), sub_value)
+                        else:
+                            apply_field(data, parts, value)
+                else:
+                    data = None
+                staged[key] = data
+
+            for (collection_path, doc_id), data in staged.items():
+                if data is None:
+                    self._storage.delete(collection_path, doc_id)
+                else:
+                    self._storage.put(collection_path, doc_id, data)
+        return datetime.now(timezone.utc)
+
+
+def build_local_client(backend, sqlite_path='local.db'):
+    """'memory' or 'sqlite'; the data of the memory backend lasts as long as the process."""
+    if backend == 'memory':
+        return LocalClient(MemoryStorage())
+    if backend == 'sqlite':
+        return LocalClient(SQLiteStorage(sqlite_path))
+    raise ValueError(f"Unknown datastore backend {backend!r}")
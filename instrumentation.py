@@ -0,0 +1,388 @@
+# instrumentation.py
+
+import contextvars
+import hmac
+import threading
+import time
+from functools import wraps
+
+from flask import Response, abort, before_render_template, g, request, session, template_rendered
+
+# Latency buckets in seconds, Prometheus' defaults
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Phases shown in Server-Timing, in this order; time not spent in any of them is reported as 'app'
+PHASES = ('firestore', 'auth', 'razorpay', 'sms', 'email', 'render')
+
+METRICS_HELP = {
+    'app_requests_total': ('counter', 'Requests handled, by route, method and status.'),
+    'app_request_duration_seconds': ('histogram', 'Request latency, by route.'),
+    'app_phase_calls_total': ('counter', 'Backend and rendering calls, by phase, operation and route.'),
+    'app_phase_duration_seconds': ('histogram', 'Latency of backend and rendering calls, by phase and operation.'),
+    'app_firestore_reads_total': ('counter', 'Firestore document reads, by route.'),
+    'app_firestore_writes_total': ('counter', 'Firestore document writes, by route.'),
+}
+
+_current_request = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Time and call counts per phase for the request being handled."""
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.reads = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds, reads=0, writes=0):
+        # Dashboard loaders report from pool threads concurrently
+        with self._lock:
+            total, calls = self.phases.get(phase, (0.0, 0))
+            self.phases[phase] = (total + seconds, calls + 1)
+            self.reads += reads
+            self.writes += writes
+
+    def server_timing(self, total):
+        entries, accounted = [], 0.0
+        for phase in PHASES:
+            if phase not in self.phases:
+                continue
+            seconds, calls = self.phases[phase]
+            accounted += seconds
+            desc = f"{calls} calls"
+            if phase == 'firestore':
+                desc += f", {self.reads} reads, {self.writes} writes"
+            entries.append(f'{phase};dur={seconds * 1000:.1f};desc="{desc}"')
+        # Parallel calls can add up to more than the wall time
+        entries.append(f'app;dur={max(0.0, total - accounted) * 1000:.1f}')
+        entries.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(entries)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + '}'
+
+
+class Registry:
+    """Counters and histograms kept in process, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            key = (name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            key = (name, labels)
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def counter_value(self, name, labels):
+        with self._lock:
+            return self._counters.get((name, labels), 0)
+
+    def render(self):
+        with self._lock:
+            by_name = {}
+            for (name, labels), value in self._counters.items():
+                by_name.setdefault(name, []).append(('counter', labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                by_name.setdefault(name, []).append(('histogram', labels, histogram))
+
+            lines = []
+            for name in sorted(by_name):
+                metric_type, help_text = METRICS_HELP.get(name, (by_name[name][0][0], name))
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for kind, labels, value in sorted(by_name[name], key=lambda item: item[1]):
+                    if kind == 'counter':
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets, value.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{format_labels(labels, ("le", bound))} {cumulative}')
+                    lines.append(f'{name}_bucket{format_labels(labels, ("le", "+Inf"))} {value.count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {value.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {value.count}')
+            return '\n'.join(lines) + '\n'
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, instrumentation, phase, operation):
+        self.instrumentation = instrumentation
+        self.phase = phase
+        self.operation = operation
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.record(self.phase, self.operation, time.perf_counter() - self.started)
+        return False
+
+
+class _TimedStream:
+    """Wraps a streaming RPC response, timing it until it is used up and counting documents."""
+
+    def __init__(self, instrumentation, operation, stream, started, count_reads, min_reads):
+        self._instrumentation = instrumentation
+        self._operation = operation
+        self._stream = stream
+        self._started = started
+        self._count_reads = count_reads
+        self._min_reads = min_reads
+        self._reads = 0
+        self._finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            response = next(self._stream)
+        except BaseException:
+            self._finish()
+            raise
+        self._reads += self._count_reads(response)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def _finish(self):
+        if not self._finished:
+            self._finished = True
+            self._instrumentation.record('firestore', self._operation, time.perf_counter() - self._started,
+                                         reads=max(self._min_reads, self._reads))
+
+
+def _has_field(response, field):
+    pb = getattr(response, '_pb', response)
+    try:
+        return 1 if pb.HasField(field) else 0
+    except ValueError:
+        return 0
+
+
+def _count_writes(kwargs):
+    request_ = kwargs.get('request')
+    writes = request_.get('writes') if isinstance(request_, dict) else getattr(request_, 'writes', None)
+    return len(writes or [])
+
+
+# (counts reads in one response, minimum reads billed per call)
+FIRESTORE_STREAMS = {
+    'batch_get_documents': (lambda response: 1 if _has_field(response, 'found') or _has_field(response, 'missing') else 0, 0),
+    'run_query': (lambda response: _has_field(response, 'document'), 1),
+    'run_aggregation_query': (lambda response: 0, 1),
+}
+FIRESTORE_UNARY = ('commit', 'begin_transaction', 'rollback')
+# The RPC methods above are private to google-cloud-firestore, so they are
+# only wrapped on the major version they were written against
+FIRESTORE_MAJOR_VERSION = 2
+
+
+def firestore_rpc_layer(client):
+    """The client's RPC layer; raises RuntimeError if it is not the one FIRESTORE_STREAMS/UNARY expect."""
+    from google.cloud import firestore_v1
+    version = getattr(firestore_v1, '__version__', '')
+    api = getattr(client, '_firestore_api', None)
+    missing = [name for name in (*FIRESTORE_STREAMS, *FIRESTORE_UNARY) if not callable(getattr(api, name, None))]
+    if version.split('.')[0] != str(FIRESTORE_MAJOR_VERSION) or api is None or missing:
+        raise RuntimeError(
+            f"Cannot instrument google-cloud-firestore {version or '(unknown version)'}: written for "
+            f"{FIRESTORE_MAJOR_VERSION}.x, missing {', '.join(missing) or 'nothing'}. "
+            f"Update instrumentation.py or set INSTRUMENTATION_ENABLED=0.")
+    return api
+
+
+class Instrumentation:
+    """
+    Times every backend call and the template render of each request.
+
+    Per request it sums time and calls per phase (Firestore, Firebase Auth,
+    Razorpay, SMS/email, rendering) for the Server-Timing header; across
+    requests it keeps Prometheus counters and histograms served at /metrics.
+    Calls made outside a request (background workers) are counted under the
+    route 'background'. When disabled nothing is wrapped or registered and
+    timed() hands back a shared no-op context manager.
+
+    /metrics is served to signed-in admins, and to scrapers sending
+    `Authorization: Bearer <metrics_token>` when a token is configured.
+    """
+
+    def __init__(self, enabled=True, metrics_token=None):
+        self.enabled = enabled
+        self.metrics_token = metrics_token
+        self.registry = Registry()
+
+    # --- Recording ---
+
+    def record(self, phase, operation, seconds, reads=0, writes=0):
+        metrics = _current_request.get()
+        route = metrics.route if metrics else 'background'
+        if metrics:
+            metrics.add(phase, seconds, reads, writes)
+        self.registry.inc('app_phase_calls_total', (('operation', operation), ('phase', phase), ('route', route)))
+        self.registry.observe('app_phase_duration_seconds', (('operation', operation), ('phase', phase)), seconds)
+        if reads:
+            self.registry.inc('app_firestore_reads_total', (('route', route),), reads)
+        if writes:
+            self.registry.inc('app_firestore_writes_total', (('route', route),), writes)
+
+    def timed(self, phase, operation):
+        """Context manager timing one call: `with instrumentation.timed('auth', 'verify_id_token'):`"""
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, phase, operation)
+
+    def wrap(self, phase, operation, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(self, phase, operation):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def instrument_methods(self, obj, phase, names):
+        """Replaces obj.<name> for each name with a timed wrapper."""
+        if not self.enabled or obj is None:
+            return
+        for name in names:
+            if hasattr(obj, name):
+                setattr(obj, name, self.wrap(phase, name, getattr(obj, name)))
+
+    def instrument_firestore(self, client):
+        """
+        Hooks the Firestore client at its RPC layer, so every document get,
+        query, aggregation and commit is timed and its reads and writes
+        counted, whichever code path issued it. Local datastore clients
+        report through their listener list instead.
+        """
+        if not self.enabled or client is None:
+            return
+        if hasattr(client, 'listeners'):
+            client.listeners.append(
+                lambda kind, collection_path, reads, writes, seconds: self.record('firestore', kind, seconds, reads, writes))
+            return
+
+        api = firestore_rpc_layer(client)
+        for name, (count_reads, min_reads) in FIRESTORE_STREAMS.items():
+            setattr(api, name, self._wrap_stream(name, getattr(api, name), count_reads, min_reads))
+        for name in FIRESTORE_UNARY:
+            setattr(api, name, self._wrap_unary(name, getattr(api, name)))
+
+    def _wrap_stream(self, name, method, count_reads, min_reads):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            return _TimedStream(self, name, iter(method(*args, **kwargs)), started, count_reads, min_reads)
+        return wrapper
+
+    def _wrap_unary(self, name, method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                writes = _count_writes(kwargs) if name == 'commit' else 0
+                self.record('firestore', name, time.perf_counter() - started, writes=writes)
+        return wrapper
+
+    # --- Flask integration ---
+
+    def init_app(self, app):
+        if not self.enabled:
+            return
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def _start_request(self):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics = RequestMetrics(route)
+        g._request_metrics = metrics
+        g._request_metrics_token = _current_request.set(metrics)
+
+    def _finish_request(self, response):
+        metrics = g.get('_request_metrics')
+        if metrics is None:
+            return response
+        total = time.perf_counter() - metrics.started
+        self.registry.inc('app_requests_total', (('method', request.method), ('route', metrics.route),
+                                                 ('status', str(response.status_code))))
+        self.registry.observe('app_request_duration_seconds', (('route', metrics.route),), total)
+        response.headers['Server-Timing'] = metrics.server_timing(total)
+        return response
+
+    def _teardown_request(self, exc):
+        token = g.pop('_request_metrics_token', None)
+        if token is not None:
+            _current_request.reset(token)
+
+    def _render_started(self, sender, template, context, **extra):
+        g._render_started = time.perf_counter()
+
+    def _render_finished(self, sender, template, context, **extra):
+        started = g.pop('_render_started', None)
+        if started is not None:
+            self.record('render', template.name or 'template', time.perf_counter() - started)
+
+    def metrics_view(self):
+        # Constant-time, since the endpoint is reachable by anyone
+        scraper = bool(self.metrics_token) and hmac.compare_digest(
+            request.headers.get('Authorization', '').encode('utf-8'), f'Bearer {self.metrics_token}'.encode('utf-8'))
+        if not scraper and session.get('user_role') != 'admin':
+            abort(403)
+        return Response(self.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def run_in_request_context(func):
+    """Binds func to the caller's request metrics so work on pool threads is attributed to it."""
+    context = contextvars.copy_context()
+    return lambda: context.run(func)
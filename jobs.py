@@ -0,0 +1,79 @@
+# jobs.py
+
+import os
+import queue
+import threading
+import time
+
+from cache import TTLCache
+
+
+class JobQueue:
+    """
+    Runs work off the request thread on a few daemon worker threads.
+
+    Every job carries an idempotency key. A key that is already queued, or
+    that finished recently, is not queued again, and failed jobs are retried
+    with exponential backoff before being given up on. Jobs themselves
+    should still be safe to run twice, since a crash can lose the record of
+    a finished job.
+    """
+
+    def __init__(self, workers=2, max_retries=3, backoff=1.0, done_ttl=3600):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._done = TTLCache(maxsize=10000, ttl=done_ttl)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queues func(*args, **kwargs) unless `key` is queued or already done. Returns True if queued."""
+        self._ensure_started()
+        with self._lock:
+            if key in self._pending or key in self._done:
+                return False
+            self._pending.add(key)
+        self._queue.put((key, func, args, kwargs))
+        return True
+
+    def flush(self):
+        """Blocks until every queued job has finished or run out of retries."""
+        self._queue.join()
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._pending = set()
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            key, func, args, kwargs = self._queue.get()
+            try:
+                for attempt in range(1, self.max_retries + 1):
+                    try:
+                        func(*args, **kwargs)
+                        with self._lock:
+                            self._done.set(key, True)
+                        break
+                    except Exception as e:
+                        if attempt == self.max_retries:
+                            print(f"Job {key} failed after {attempt} attempts: {e}")
+                            break
+                        delay = self.backoff * 2 ** (attempt - 1)
+                        print(f"Job {key} failed (attempt {attempt}), retrying in {delay}s: {e}")
+                        time.sleep(delay)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                self._queue.task_done()
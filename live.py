@@ -0,0 +1,263 @@
+# live.py
+
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+DESCENDING = 'DESCENDING'
+
+# Browsers wait this long before reconnecting a dropped stream (milliseconds)
+RECONNECT_DELAY_MS = 3000
+
+
+class ChangeFeed:
+    """
+    One shared snapshot listener on the `window` most recently changed
+    documents of a collection, newest `field` first. `field` is a timestamp
+    every write to the collection sets, so any change moves the document into
+    the window. `route(doc_id, data)` returns (user_ids, item) for a changed
+    document; the hub hands `item` to those users' streams under `topic`.
+
+    Documents already in the window when the listener starts are not
+    reported, and neither are writes that leave `field` unchanged. Clients
+    without snapshot listeners (the memory / SQLite clients in datastore.py)
+    fall back to polling for documents whose `field` passed the newest value
+    seen.
+    """
+
+    def __init__(self, topic, get_collection, field, route, window=100, poll_interval=5):
+        self.topic = topic
+        self.get_collection = get_collection
+        self.field = field
+        self.route = route
+        self.window = window
+        self.poll_interval = poll_interval
+        self._emit = None
+        self._watch = None
+        self._stopped = None
+        self._seen = {}
+        self._primed = False
+
+    def start(self, emit):
+        self._emit = emit
+        self._seen, self._primed = {}, False
+        collection = self.get_collection()
+        try:
+            query = collection.order_by(self.field, direction=DESCENDING).limit(self.window)
+            self._watch = query.on_snapshot(self._on_snapshot)
+        except Exception as e:
+            print(f"Warning: Could not watch {self.topic}, polling every {self.poll_interval}s instead. Error: {e}")
+            # A fresh event per start, so a poller left over from an earlier start cannot be revived
+            self._stopped = threading.Event()
+            threading.Thread(target=self._poll, args=(collection, self._stopped), daemon=True).start()
+
+    def stop(self):
+        if self._watch is not None:
+            try:
+                self._watch.unsubscribe()
+            except Exception as e:
+                print(f"Warning: Could not stop the {self.topic} listener: {e}")
+            self._watch = None
+        if self._stopped is not None:
+            self._stopped.set()
+            self._stopped = None
+
+    def _on_snapshot(self, docs, changes, read_time):
+        # The first snapshot is the window as it stood when the listener started
+        if not self._primed:
+            self._seen = {doc.id: doc.to_dict().get(self.field) for doc in docs}
+            self._primed = True
+            return
+        for change in changes:
+            doc = change.document
+            if change.type.name == 'REMOVED':
+                # Pushed out of the window by newer changes, or deleted
+                self._seen.pop(doc.id, None)
+                continue
+            data = doc.to_dict()
+            if self._seen.get(doc.id) == data.get(self.field):
+                continue
+            self._seen[doc.id] = data.get(self.field)
+            self._report(doc.id, data)
+
+    def _poll(self, collection, stopped):
+        newest = datetime.now(timezone.utc)
+        while not stopped.wait(self.poll_interval):
+            try:
+                docs = list(collection.where(self.field, '>', newest).order_by(self.field).limit(self.window).stream())
+            except Exception as e:
+                print(f"Error polling {self.topic} for changes: {e}")
+                continue
+            for doc in docs:
+                data = doc.to_dict()
+                newest = max(newest, data[self.field])
+                self._report(doc.id, data)
+
+    def _report(self, doc_id, data):
+        try:
+            user_ids, item = self.route(doc_id, data)
+            self._emit(user_ids, self.topic, item)
+        except Exception as e:
+            print(f"Error routing {self.topic} change {doc_id}: {e}")
+
+
+class Subscriber:
+    """
+    One open event stream for `user_id`. The hub puts events from listener
+    threads without blocking; when the queue is full the stream tells the
+    browser to reload everything rather than apply a partial set of changes.
+    """
+
+    def __init__(self, user_id, maxsize=100):
+        self.user_id = user_id
+        self.events = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def drain(self, timeout, settle):
+        """Waits up to `timeout` for an event, then `settle` more seconds; returns everything queued."""
+        try:
+            events = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        time.sleep(settle)
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+
+class LiveUpdates:
+    """
+    Pushes dashboard changes to signed-in users over Server-Sent Events.
+
+    Each process runs one listener per feed (sessions, notifications) while
+    any stream is open, however many tabs are connected, and routes each
+    change in memory to the streams of the users it concerns. `on_change`
+    is called first with (user_ids, topic) so the process can drop what it
+    has cached for them. Changes to topics no feed watches (profile,
+    availability, journeys, ...) reach only the streams of the process that
+    made them, through publish().
+
+    The listeners are started by the first subscriber and stopped
+    `idle_timeout` seconds after the last one leaves, so tabs reconnecting
+    after a stream's `lifetime` do not restart them.
+    """
+
+    def __init__(self, feeds, on_change=None, heartbeat=20, lifetime=300, settle=0.2, idle_timeout=60):
+        self.feeds = feeds
+        self.on_change = on_change
+        self.heartbeat = heartbeat
+        self.lifetime = lifetime
+        self.settle = settle
+        self.idle_timeout = idle_timeout
+        self.topics = {feed.topic for feed in feeds}
+        self._subscribers = {}
+        self._running = False
+        self._idle_timer = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, subscriber):
+        with self._lock:
+            # Listener threads do not survive a fork; each process opens its own
+            if self._pid != os.getpid():
+                self._subscribers, self._running, self._idle_timer, self._pid = {}, False, None, os.getpid()
+            self._subscribers.setdefault(subscriber.user_id, set()).add(subscriber)
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            if not self._running:
+                self._running = True
+                for feed in self.feeds:
+                    feed.start(self._feed_changed)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_id, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(subscriber.user_id, None)
+            if not self._subscribers and self._running and self._idle_timer is None:
+                self._idle_timer = threading.Timer(self.idle_timeout, self._stop_if_idle)
+                self._idle_timer.daemon = True
+                self._idle_timer.start()
+
+    def _stop_if_idle(self):
+        with self._lock:
+            self._idle_timer = None
+            if self._subscribers or not self._running:
+                return
+            self._running = False
+            for feed in self.feeds:
+                feed.stop()
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def _feed_changed(self, user_ids, topic, item):
+        if self.on_change:
+            self.on_change(user_ids, topic)
+        self._deliver(user_ids, topic, item)
+
+    def publish(self, user_ids, topics):
+        """Tells `user_ids` about changes this process made to topics no feed watches."""
+        for topic in set(topics) - self.topics:
+            self._deliver(user_ids, topic, None)
+
+    def _deliver(self, user_ids, topic, item):
+        event = {'topic': topic, 'item': item}
+        with self._lock:
+            targets = [subscriber for user_id in set(user_ids) if user_id
+                       for subscriber in self._subscribers.get(user_id, ())]
+        for subscriber in targets:
+            subscriber.put(event)
+
+    # --- Streams ---
+
+    def stream(self, subscriber):
+        """The text/event-stream body for `subscriber`; holds a worker thread while open."""
+        self.subscribe(subscriber)
+        try:
+            yield f"retry: {RECONNECT_DELAY_MS}\n\n"
+            deadline = time.monotonic() + self.lifetime
+            while time.monotonic() < deadline:
+                chunk = self.format(subscriber, subscriber.drain(self.heartbeat, self.settle))
+                yield chunk
+        finally:
+            self.unsubscribe(subscriber)
+
+    def format(self, subscriber, events):
+        """One message per topic for a batch of events; a comment line keeps an idle stream open."""
+        if subscriber.overflowed:
+            subscriber.overflowed = False
+            return format_event('reload', {'items': []})
+        if not events:
+            return ": keep-alive\n\n"
+        return ''.join(format_event(topic, {'items': items}) for topic, items in coalesce(events).items())
+
+
+def coalesce(events):
+    """Merges queued events into one entry per topic, keeping their items in order."""
+    merged = {}
+    for event in events:
+        items = merged.setdefault(event['topic'], [])
+        if event['item'] is not None:
+            items.append(event['item'])
+    return merged
+
+
+def format_event(topic, data):
+    return f"event: {topic}\ndata: {json.dumps(data, default=str)}\n\n"
@@ -0,0 +1,233 @@
+# notifications.py
+
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+# Firestore accepts at most 500 writes per batch
+MAX_BATCH_WRITES = 500
+
+
+# --- Senders ---
+
+class SmsSender:
+    def send(self, phone, message):
+        raise NotImplementedError
+
+
+class EmailSender:
+    def send(self, email, subject, body):
+        raise NotImplementedError
+
+
+class ConsoleSmsSender(SmsSender):
+    """Local stand-in that prints messages instead of sending them."""
+
+    def send(self, phone, message):
+        print(f"[sms] to {phone}: {message}")
+
+
+class ConsoleEmailSender(EmailSender):
+    """Local stand-in that prints messages instead of sending them."""
+
+    def send(self, email, subject, body):
+        print(f"[email] to {email}: {subject} - {body}")
+
+
+class MemorySmsSender(SmsSender):
+    """Keeps sent messages in memory so tests can assert on them."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, phone, message):
+        self.sent.append((phone, message))
+
+
+class MemoryEmailSender(EmailSender):
+    """Keeps sent messages in memory so tests can assert on them."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, email, subject, body):
+        self.sent.append((email, subject, body))
+
+
+SMS_SENDERS = {'console': ConsoleSmsSender, 'memory': MemorySmsSender}
+EMAIL_SENDERS = {'console': ConsoleEmailSender, 'memory': MemoryEmailSender}
+
+
+def build_senders():
+    """Picks the SMS and email senders named by NOTIFICATION_SMS_SENDER / NOTIFICATION_EMAIL_SENDER."""
+    sms_sender = SMS_SENDERS[os.environ.get('NOTIFICATION_SMS_SENDER', 'console')]()
+    email_sender = EMAIL_SENDERS[os.environ.get('NOTIFICATION_EMAIL_SENDER', 'console')]()
+    return sms_sender, email_sender
+
+
+# --- Outbox ---
+
+class NotificationOutbox:
+    """
+    Request handlers enqueue notification events and return immediately. A
+    small pool of worker threads drains the queue, writes each batch of
+    in-app notifications with one Firestore commit and then delivers SMS and
+    email copies according to each recipient's saved preferences.
+
+    `get_db` returns the Firestore client and `resolve_contacts(uids)` returns
+    {uid: profile} so phone numbers and emails can be looked up in bulk.
+    `on_written(recipient_ids)`, if given, is called after each batch is
+    committed.
+
+    The queue lives only in this process. close() runs at exit: it gives the
+    workers `shutdown_timeout` seconds to write what is queued, then logs
+    every event it has to drop. A batch whose write fails after its retries
+    is logged the same way.
+    """
+
+    def __init__(self, get_db, resolve_contacts, sms_sender, email_sender,
+                 workers=2, batch_size=100, flush_interval=0.2, max_retries=3, on_written=None,
+                 shutdown_timeout=10):
+        self.get_db = get_db
+        self.resolve_contacts = resolve_contacts
+        self.on_written = on_written
+        self.sms_sender = sms_sender
+        self.email_sender = email_sender
+        self.workers = workers
+        self.batch_size = min(batch_size, MAX_BATCH_WRITES)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.shutdown_timeout = shutdown_timeout
+        self._queue = queue.Queue()
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, recipient_id, message, notification_type='info'):
+        self._ensure_started()
+        self._queue.put({
+            'recipient_id': recipient_id, 'message': message,
+            'type': notification_type, 'read': False, 'created_at': datetime.now(timezone.utc)
+        })
+
+    def flush(self):
+        """Blocks until every event enqueued so far has been processed."""
+        self._queue.join()
+
+    def close(self):
+        """Waits up to shutdown_timeout for the queue to drain, then logs and drops what is left."""
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + self.shutdown_timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks and time.monotonic() < deadline:
+                self._queue.all_tasks_done.wait(deadline - time.monotonic())
+            unfinished = self._queue.unfinished_tasks
+        dropped = []
+        while True:
+            try:
+                dropped.append(self._queue.get_nowait())
+                self._queue.task_done()
+            except queue.Empty:
+                break
+        self._log_dropped(dropped, "still queued at shutdown")
+        if unfinished > len(dropped):
+            print(f"Warning: {unfinished - len(dropped)} notifications were still being written at shutdown.")
+
+    def _log_dropped(self, events, reason):
+        if not events:
+            return
+        print(f"Error: Dropping {len(events)} notifications ({reason}):")
+        for event in events:
+            print(f"  to {event['recipient_id']} [{event['type']}] at {event['created_at'].isoformat()}: {event['message']}")
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._threads = [
+                threading.Thread(target=self._run, name=f'notification-outbox-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def _next_batch(self):
+        events = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(events) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                events.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return events
+
+    def _run(self):
+        while True:
+            events = self._next_batch()
+            try:
+                try:
+                    self._write(events)
+                except Exception as e:
+                    self._log_dropped(events, f"write failed: {e}")
+                    continue
+                if self.on_written:
+                    self.on_written({event['recipient_id'] for event in events})
+                self._deliver(events)
+            except Exception as e:
+                print(f"Error delivering {len(events)} notifications: {e}")
+            finally:
+                for _ in events:
+                    self._queue.task_done()
+
+    def _write(self, events):
+        db = self.get_db()
+        notifications_ref = db.collection('notifications')
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                batch = db.batch()
+                for event in events:
+                    batch.set(notifications_ref.document(), event)
+                batch.commit()
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Retrying notification batch after error: {e}")
+                time.sleep(0.5 * 2 ** (attempt - 1))
+
+    def _deliver(self, events):
+        db = self.get_db()
+        recipients = {event['recipient_id'] for event in events}
+        settings_refs = [db.collection('notifications').document(uid) for uid in recipients]
+        settings = {doc.id: doc.to_dict() for doc in db.get_all(settings_refs) if doc.exists}
+
+        wanted = {uid for uid in recipients if settings.get(uid, {}).get('sms') or settings.get(uid, {}).get('email')}
+        if not wanted:
+            return
+        contacts = self.resolve_contacts(wanted)
+
+        for event in events:
+            uid = event['recipient_id']
+            if uid not in wanted:
+                continue
+            user_settings, contact = settings[uid], contacts.get(uid, {})
+            phone = contact.get('number') or contact.get('contact', {}).get('phone')
+            email = contact.get('email') or contact.get('contact', {}).get('email')
+            try:
+                if user_settings.get('sms') and phone:
+                    self.sms_sender.send(phone, event['message'])
+                if user_settings.get('email') and email:
+                    self.email_sender.send(email, "Panchakarma Wellness notification", event['message'])
+            except Exception as e:
+                print(f"Error sending notification to {uid}: {e}")
@@ -0,0 +1,166 @@
+# repositories.py
+
+from datetime import timezone
+
+# Firestore caps the number of documents fetched in one batched read
+GET_ALL_BATCH_SIZE = 100
+
+
+class Repository:
+    """
+    One collection, reached through whichever client is configured
+    (Firestore, or the memory / SQLite clients in datastore.py). Query
+    methods return unexecuted queries so callers can still page, count or
+    stream them.
+    """
+
+    collection_name = None
+
+    def __init__(self, client):
+        self.client = client
+        self.collection = client.collection(self.collection_name)
+
+    def ref(self, doc_id=None):
+        return self.collection.document(doc_id)
+
+    def get(self, doc_id, transaction=None):
+        return self.ref(doc_id).get(transaction=transaction)
+
+    def get_many(self, doc_ids):
+        """Returns {doc_id: data} for the documents that exist, in batched reads."""
+        doc_ids = list(doc_ids)
+        found = {}
+        for i in range(0, len(doc_ids), GET_ALL_BATCH_SIZE):
+            refs = [self.ref(doc_id) for doc_id in doc_ids[i:i + GET_ALL_BATCH_SIZE]]
+            for doc in self.client.get_all(refs):
+                if doc.exists:
+                    found[doc.id] = doc.to_dict()
+        return found
+
+
+class UserRepository(Repository):
+    collection_name = 'users'
+
+
+class PractitionerRepository(Repository):
+    collection_name = 'practitioners'
+
+    def pending_review(self):
+        return self.collection.where('verification_status', '==', 'Pending Review')
+
+    def verified(self):
+        return self.collection.where('verification_status', '==', 'Verified')
+
+
+class RoleRepository(Repository):
+    collection_name = 'user_roles'
+
+
+class SessionRepository(Repository):
+    collection_name = 'sessions'
+
+    def for_user(self, user_role, user_id):
+        field = 'practitioner_uid' if user_role == 'practitioner' else 'patient_uid'
+        return self.collection.where(field, '==', user_id)
+
+    def for_practitioner_between(self, practitioner_uid, start, end):
+        return self.collection.where('practitioner_uid', '==', practitioner_uid)\
+                              .where('date', '>=', start)\
+                              .where('date', '<', end)
+
+    def between(self, start, end):
+        return self.collection.where('date', '>=', start).where('date', '<', end)
+
+    def starting_from(self, start):
+        return self.collection.where('date', '>=', start)
+
+    def patient_uids_for(self, practitioner_uid):
+        return self.collection.where('practitioner_uid', '==', practitioner_uid).select(['patient_uid'])
+
+    def by_order_id(self, order_id):
+        return self.collection.where('razorpay_order.id', '==', order_id).limit(1)
+
+
+class NotificationRepository(Repository):
+    """Holds both notifications and, under each user's uid, their delivery settings."""
+
+    collection_name = 'notifications'
+
+    def for_recipient(self, recipient_id):
+        return self.collection.where('recipient_id', '==', recipient_id)
+
+
+class FeedbackRepository(Repository):
+    collection_name = 'feedback'
+
+    def for_practitioner(self, practitioner_uid):
+        return self.collection.where('practitioner_uid', '==', practitioner_uid)
+
+
+class AvailabilityRepository(Repository):
+    collection_name = 'practitioner_availability'
+
+
+class AvailabilityOverrideRepository(Repository):
+    collection_name = 'availability_overrides'
+
+    def ref_for(self, practitioner_uid, date_str):
+        """One document per practitioner and date ('YYYY-MM-DD'), so a date is read and written on its own."""
+        return self.ref(f"{practitioner_uid}_{date_str}")
+
+    def for_practitioner(self, practitioner_uid):
+        return self.collection.where('practitioner_uid', '==', practitioner_uid)
+
+    def from_date(self, date_str):
+        return self.collection.where('date', '>=', date_str)
+
+    def before(self, date_str):
+        return self.collection.where('date', '<', date_str)
+
+
+class PractitionerStatsRepository(Repository):
+    collection_name = 'practitioner_stats'
+
+
+class SlotReservationRepository(Repository):
+    collection_name = 'slot_reservations'
+
+    def ref_for(self, practitioner_uid, slot_datetime):
+        """One document per practitioner and slot start, so create() claims the slot."""
+        slot_key = slot_datetime.astimezone(timezone.utc).strftime('%Y%m%dT%H%MZ')
+        return self.ref(f"{practitioner_uid}_{slot_key}")
+
+
+class JourneyRepository(Repository):
+    collection_name = 'patient_journeys'
+
+    def for_patient(self, patient_uid):
+        return self.collection.where('patient_uid', '==', patient_uid)
+
+
+class TherapyPlanRepository(Repository):
+    collection_name = 'therapy_plans'
+
+
+class PaymentEventRepository(Repository):
+    collection_name = 'payment_events'
+
+
+class Repositories:
+    """Every collection the app uses, bound to one client."""
+
+    def __init__(self, client):
+        self.client = client
+        self.users = UserRepository(client)
+        self.practitioners = PractitionerRepository(client)
+        self.roles = RoleRepository(client)
+        self.sessions = SessionRepository(client)
+        self.notifications = NotificationRepository(client)
+        self.feedback = FeedbackRepository(client)
+        self.availability = AvailabilityRepository(client)
+        self.availability_overrides = AvailabilityOverrideRepository(client)
+        self.practitioner_stats = PractitionerStatsRepository(client)
+        self.slot_reservations = SlotReservationRepository(client)
+        self.journeys = JourneyRepository(client)
+        self.therapy_plans = TherapyPlanRepository(client)
+        self.payment_events = PaymentEventRepository(client)
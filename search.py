@@ -0,0 +1,203 @@
+# search.py
+
+import bisect
+import heapq
+import threading
+
+VERIFIED = 'Verified'
+
+# Profile fields that can be filtered by range
+PRICE_FIELDS = ('appointment_price', 'session_price')
+
+# Addresses are indexed by character trigrams; shorter location queries scan the other matches instead
+GRAM = 3
+
+
+def normalize(text):
+    """Lower-cased with runs of whitespace collapsed, so 'Navi  Mumbai' matches 'navi mumbai'."""
+    return ' '.join(str(text or '').lower().split())
+
+
+def trigrams(text):
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+def to_price(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def specialty_list(value):
+    """Specialties are saved as a list; older profiles may hold a comma-separated string."""
+    if isinstance(value, str):
+        value = value.split(',')
+    return [name.strip() for name in value or [] if name and name.strip()]
+
+
+class IndexedPractitioner:
+    __slots__ = ('name', 'address', 'specialties', 'prices', 'verified', 'order')
+
+    def __init__(self, data):
+        self.name = normalize(data.get('name'))
+        self.address = normalize(data.get('address'))
+        self.specialties = {normalize(name) for name in specialty_list(data.get('specialties'))}
+        self.prices = {field: to_price(data.get(field)) for field in PRICE_FIELDS}
+        self.verified = data.get('verification_status') == VERIFIED
+        # Rank when nothing in the query tells practitioners apart
+        self.order = (not self.verified, self.name)
+
+
+class PractitionerIndex:
+    """
+    Search index over the practitioner directory listing ({uid: profile} as
+    kept by DirectoryCache): uids by specialty, the verified set, each price
+    field as a sorted list for range lookups and address trigrams for
+    substring matches, so a search touches only the matching practitioners.
+
+    sync(listing) brings the index up to date with the current listing.
+    DirectoryCache replaces listings copy-on-write and carries unchanged
+    profiles over as the same objects, so after a profile edit or an approval
+    only that practitioner is re-indexed; a refilled listing is indexed anew.
+    """
+
+    def __init__(self):
+        self._listing = None
+        self._docs = {}
+        self._entries = {}
+        self._by_specialty = {}
+        self._specialty_names = {}
+        self._verified = set()
+        self._prices = {field: [] for field in PRICE_FIELDS}
+        self._grams = {}
+        self._lock = threading.Lock()
+
+    # --- Maintenance ---
+
+    def sync(self, listing):
+        with self._lock:
+            if listing is self._listing:
+                return
+            changed = [uid for uid, data in listing.items() if self._docs.get(uid) is not data]
+            if len(changed) > len(listing) // 2:
+                self._rebuild(listing)
+            else:
+                for uid in [uid for uid in self._docs if uid not in listing]:
+                    self._remove(uid)
+                for uid in changed:
+                    self._remove(uid)
+                    self._add(uid, listing[uid])
+            self._listing = listing
+
+    def _rebuild(self, listing):
+        self._docs, self._entries, self._by_specialty, self._specialty_names = {}, {}, {}, {}
+        self._verified, self._grams = set(), {}
+        self._prices = {field: [] for field in PRICE_FIELDS}
+        for uid, data in listing.items():
+            self._add(uid, data, keep_sorted=False)
+        for prices in self._prices.values():
+            prices.sort()
+
+    def _add(self, uid, data, keep_sorted=True):
+        entry = IndexedPractitioner(data)
+        self._docs[uid], self._entries[uid] = data, entry
+        for raw_name in specialty_list(data.get('specialties')):
+            self._by_specialty.setdefault(normalize(raw_name), set()).add(uid)
+            self._specialty_names.setdefault(normalize(raw_name), raw_name)
+        if entry.verified:
+            self._verified.add(uid)
+        for field, price in entry.prices.items():
+            if keep_sorted:
+                bisect.insort(self._prices[field], (price, uid))
+            else:
+                self._prices[field].append((price, uid))
+        for gram in trigrams(entry.address):
+            self._grams.setdefault(gram, set()).add(uid)
+
+    def _remove(self, uid):
+        entry = self._entries.pop(uid, None)
+        self._docs.pop(uid, None)
+        if entry is None:
+            return
+        for name in entry.specialties:
+            self._discard(self._by_specialty, name, uid)
+            if name not in self._by_specialty:
+                self._specialty_names.pop(name, None)
+        self._verified.discard(uid)
+        for field, price in entry.prices.items():
+            prices = self._prices[field]
+            position = bisect.bisect_left(prices, (price, uid))
+            if position < len(prices) and prices[position] == (price, uid):
+                del prices[position]
+        for gram in trigrams(entry.address):
+            self._discard(self._grams, gram, uid)
+
+    @staticmethod
+    def _discard(index, key, uid):
+        uids = index.get(key)
+        if uids is not None:
+            uids.discard(uid)
+            if not uids:
+                del index[key]
+
+    # --- Queries ---
+
+    def specialties(self):
+        """Every specialty offered, as first written, for the filter options."""
+        with self._lock:
+            return sorted(self._specialty_names.values(), key=str.lower)
+
+    def search(self, specialties=(), price_ranges=None, location='', verified_only=False, offset=0, limit=20):
+        """
+        Returns ([(uid, profile)], total) for one page of the practitioners
+        offering any of `specialties`, within every (low, high) range in
+        `price_ranges` ({field: range}, either bound may be None), whose
+        address contains `location`, and only verified ones if asked.
+
+        Ranked by: verified first, then the most requested specialties
+        offered, then addresses where `location` starts a word, then name.
+        """
+        wanted = {normalize(name) for name in specialties if normalize(name)}
+        location = normalize(location)
+        with self._lock:
+            candidates = None
+
+            def narrow(uids):
+                nonlocal candidates
+                candidates = set(uids) if candidates is None else candidates & uids
+
+            if verified_only:
+                narrow(self._verified)
+            if wanted:
+                narrow(set().union(*(self._by_specialty.get(name, set()) for name in wanted)))
+            for field, (low, high) in (price_ranges or {}).items():
+                narrow(self._price_range(field, low, high))
+            if len(location) >= GRAM:
+                grams = sorted((self._grams.get(gram, set()) for gram in trigrams(location)), key=len)
+                narrow(grams[0].intersection(*grams[1:]))
+            if candidates is None:
+                candidates = set(self._entries)
+            if location:
+                candidates = {uid for uid in candidates if location in self._entries[uid].address}
+
+            if wanted or location:
+                rank = lambda uid: self._rank(uid, wanted, location)
+            else:
+                entries = self._entries
+                rank = lambda uid: (entries[uid].order, uid)
+            # Only the rows up to the end of the requested page need ordering
+            ranked = heapq.nsmallest(offset + limit, candidates, key=rank)
+            return [(uid, self._docs[uid]) for uid in ranked[offset:]], len(candidates)
+
+    def _price_range(self, field, low, high):
+        prices = self._prices[field]
+        start = 0 if low is None else bisect.bisect_left(prices, (low, ''))
+        # (high, chr(0x10ffff)) sorts after every uid priced exactly `high`
+        end = len(prices) if high is None else bisect.bisect_right(prices, (high, chr(0x10ffff)))
+        return {uid for _, uid in prices[start:end]}
+
+    def _rank(self, uid, wanted, location):
+        entry = self._entries[uid]
+        word_start = not location or entry.address.startswith(location) or f' {location}' in entry.address
+        return (entry.order[0], -len(wanted & entry.specialties), not word_start, entry.name, uid)
@@ -0,0 +1,167 @@
+# slots.py
+
+import bisect
+import hashlib
+import heapq
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+# Indexed by date.weekday()
+DAY_NAMES = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+def to_minutes(time_str):
+    """'09:30' -> 570. Raises ValueError for anything that is not HH:MM."""
+    hours, minutes = time_str.strip().split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"Invalid time '{time_str}'")
+    return hours * 60 + minutes
+
+
+def format_minutes(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+class CompiledSchedule:
+    """
+    A practitioner's availability with the recurring rules expanded once into
+    sorted tuples of slot start times (minutes past midnight) per weekday, and
+    the date overrides parsed the same way. `version` fingerprints the
+    compiled slots, so two workers compiling the same document agree on it.
+    """
+
+    __slots__ = ('weekly', 'overrides', 'version')
+
+    def __init__(self, weekly, overrides):
+        self.weekly = weekly
+        self.overrides = overrides
+        self.version = hashlib.sha1(repr((weekly, sorted(overrides.items()))).encode('utf-8')).hexdigest()[:16]
+
+    def slots_for(self, day, date_str=None):
+        date_str = date_str or day.isoformat()
+        if date_str in self.overrides:
+            return self.overrides[date_str]
+        return self.weekly[day.weekday()]
+
+    def expand(self, start_date, days, booked=None):
+        """
+        Returns {date_str: ['HH:MM', ...]} of the free slots for `days` days
+        from `start_date`, leaving out the minutes listed in booked[date_str].
+        """
+        booked = booked or {}
+        final_slots = {}
+        for i in range(days):
+            current_date = start_date + timedelta(days=i)
+            date_str = current_date.isoformat()
+            day_slots = self.slots_for(current_date, date_str)
+            if not day_slots:
+                continue
+            booked_for_day = booked.get(date_str)
+            if booked_for_day:
+                day_slots = [slot for slot in day_slots if slot not in booked_for_day]
+            if day_slots:
+                final_slots[date_str] = [format_minutes(slot) for slot in day_slots]
+        return final_slots
+
+    def free_datetimes(self, start_date, days, booked=None, not_before=None):
+        """The free slots of expand() as a sorted list of UTC datetimes."""
+        free = []
+        for date_str, times in self.expand(start_date, days, booked).items():
+            day = datetime.strptime(date_str, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+            for time_str in times:
+                slot = day + timedelta(minutes=to_minutes(time_str))
+                if not_before is None or slot >= not_before:
+                    free.append(slot)
+        return free
+
+
+def compile_rule(rule):
+    start = to_minutes(rule['start'])
+    end = to_minutes(rule['end'])
+    interval = int(rule.get('interval') or 60)
+    if interval <= 0:
+        raise ValueError(f"Invalid interval {interval}")
+    return tuple(range(start, end, interval))
+
+
+def compile_schedule(availability_data, overrides=None):
+    """
+    Compiles a practitioner_availability document into a CompiledSchedule.
+    `overrides` ({date_str: times}, from the per-date override documents) win
+    over dates left in the document's older `overrides` map.
+    """
+    recurring_rules = availability_data.get('recurring') or {}
+    overrides = {**(availability_data.get('overrides') or {}), **(overrides or {})}
+
+    weekly = []
+    for day_name in DAY_NAMES:
+        rule = recurring_rules.get(day_name)
+        day_slots = ()
+        if rule and rule.get('start') and rule.get('end'):
+            try:
+                day_slots = compile_rule(rule)
+            except (ValueError, TypeError, AttributeError) as e:
+                print(f"Warning: Skipping recurring rule for {day_name} due to malformed data: {rule}. Error: {e}")
+        weekly.append(day_slots)
+
+    compiled_overrides = {}
+    for date_str, times in overrides.items():
+        day_slots = set()
+        for time_str in times or []:
+            try:
+                day_slots.add(to_minutes(time_str))
+            except (ValueError, AttributeError):
+                print(f"Warning: Skipping malformed override time {time_str!r} on {date_str}.")
+        compiled_overrides[date_str] = tuple(sorted(day_slots))
+
+    return CompiledSchedule(tuple(weekly), compiled_overrides)
+
+
+class FreeSlotIndex:
+    """
+    Free slots across many practitioners, each kept as a sorted list of UTC
+    datetimes so a time window can be cut out with bisect and the earliest
+    matches merged across practitioners without scanning everything.
+    """
+
+    def __init__(self, ttl):
+        self.expires_at = time.monotonic() + ttl
+        self._slots = {}
+        self._stale = set()
+        self._lock = threading.Lock()
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def set_practitioner(self, uid, slots):
+        with self._lock:
+            self._slots[uid] = slots
+            self._stale.discard(uid)
+
+    def mark_stale(self, uid):
+        with self._lock:
+            self._stale.add(uid)
+
+    def stale_uids(self):
+        with self._lock:
+            return set(self._stale)
+
+    def needs_refresh(self, uids):
+        with self._lock:
+            return [uid for uid in uids if uid in self._stale or uid not in self._slots]
+
+    def earliest(self, uids, start, end, limit):
+        """Returns up to `limit` (datetime, uid) pairs in [start, end), earliest first."""
+        with self._lock:
+            windows = []
+            for uid in uids:
+                slots = self._slots.get(uid, [])
+                lo, hi = bisect.bisect_left(slots, start), bisect.bisect_left(slots, end)
+                # No practitioner can contribute more than `limit` results
+                if lo < hi:
+                    windows.append([(slot, uid) for slot in slots[lo:min(hi, lo + limit)]])
+        return list(islice(heapq.merge(*windows), limit))